@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generate a synthetic group for benchmarking.
+
+    python -m benchmarks.generate [options] GROUP
+
+The group is created under ~/.settle (set $HOME to put it somewhere else)
+and filled with random payments written through `store_payment`.
+"""
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from settle import FILE_CHARSET
+from settle.group import Group
+from settle.payment import Payment
+from settle.reader import find_payment_files, store_payment, write
+
+# share templates for the `%` modifier, they must sum up to 1 exactly
+_SHARES = [('1',), ('0.5', '0.5'), ('0.25', '0.75'), ('0.2', '0.3', '0.5'),
+           ('0.1', '0.2', '0.3', '0.4')]
+
+
+def parse_mix(s):
+    """Parse a mix like `EUR:3,USD:1` into a list of (name, weight) pairs"""
+    mix = []
+    for part in s.split(','):
+        name, _, weight = part.partition(':')
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def choose(rnd, mix):
+    names, weights = zip(*mix)
+    return rnd.choices(names, weights)[0]
+
+
+def generate_group(name, users=20, payments=1000, list_depth=2,
+                   currencies=(('EUR', 1),), modifiers=(('*', 1),),
+                   days=365, seed=0):
+    """
+    Create group `name` with `users` persons, `list_depth` levels of nested
+    lists and `payments` random payments. `currencies` and `modifiers` are
+    lists of (value, weight) pairs controlling the mix of payments.
+    """
+    rnd = random.Random(seed)
+    people = ['user%d' % i for i in range(users)]
+
+    os.makedirs(Group._path(name, 'payments'))
+    with open(Group._path(name, 'config'), 'w', encoding=FILE_CHARSET) as f:
+        write(f, {'default_currency': currencies[0][0]})
+    with open(Group._path(name, 'localconfig'), 'w', encoding=FILE_CHARSET) as f:
+        write(f, {'default_giver': people[0]})
+
+    # list0 contains some people, listN contains %list(N-1) and some more
+    lists = {}
+    for depth in range(list_depth):
+        members = rnd.sample(people, min(len(people), rnd.randint(2, 6)))
+        if depth > 0:
+            members.append('%%list%d' % (depth - 1))
+        lists['list%d' % depth] = ' '.join(members)
+    with open(Group._path(name, 'lists'), 'w', encoding=FILE_CHARSET) as f:
+        write(f, lists)
+
+    group = Group.load(name)
+    receivers_pool = people + ['%' + l for l in lists]
+    start = datetime(2000, 1, 1)
+
+    for _ in range(payments):
+        modifier = choose(rnd, modifiers)
+        amount = Decimal(rnd.randint(1, 50000)) / 100
+
+        if modifier == '%':
+            shares = rnd.choice(_SHARES)
+            names = rnd.sample(receivers_pool, len(shares))
+            receivers = ' '.join('%s%%%s' % (n, s) for (n, s) in zip(names, shares))
+        else:
+            names = rnd.sample(receivers_pool, rnd.randint(1, min(5, len(receivers_pool))))
+            if modifier == '=':
+                amount = None
+                receivers = ' '.join('%s=%s' % (n, Decimal(rnd.randint(1, 10000)) / 100)
+                                     for n in names)
+            else:
+                receivers = ' '.join(n if rnd.random() < 0.8 else '%s*%d' % (n, rnd.randint(2, 3))
+                                     for n in names)
+
+        currency = choose(rnd, currencies)
+        date = start + timedelta(days=rnd.randrange(days), minutes=rnd.choice((0, rnd.randrange(1440))))
+        payment = Payment(group, rnd.choice(people), receivers, amount,
+                          currency=None if currency == group.default_currency else currency,
+                          date=date, comment=rnd.choice((None, None, 'generated')))
+        store_payment(payment)
+
+    # make the files look old, so the payment cache does not skip them as
+    # possibly still being modified
+    old = time.time() - 86400
+    for f in find_payment_files(group):
+        os.utime(f, (old, old))
+
+    return group
+
+
+def add_arguments(p):
+    p.add_argument('--users', type=int, default=20)
+    p.add_argument('--payments', type=int, default=1000)
+    p.add_argument('--list-depth', type=int, default=2)
+    p.add_argument('--currencies', type=parse_mix, default='EUR:4,USD:1',
+                   help='currency mix, e.g. EUR:4,USD:1')
+    p.add_argument('--modifiers', type=parse_mix, default='*:8,=:1,%:1',
+                   help='receiver modifier mix, e.g. *:8,=:1,%%:1')
+    p.add_argument('--days', type=int, default=365,
+                   help='spread payment dates over this many days')
+    p.add_argument('--seed', type=int, default=0)
+
+
+def main():
+    p = argparse.ArgumentParser('generate benchmark group')
+    p.add_argument('group')
+    add_arguments(p)
+    args = p.parse_args()
+    generate_group(args.group, args.users, args.payments, args.list_depth,
+                   args.currencies, args.modifiers, args.days, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time the stages of reading and settling a synthetic group.
+
+    python -m benchmarks.run [options] [--output FILE] [--baseline FILE]
+
+A group is generated in a temporary $HOME (see `benchmarks.generate`), then
+every stage is run `--repeat` times. Results are printed and can be saved as
+JSON; with `--baseline`, each stage is compared against a previous result.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from benchmarks.generate import add_arguments, generate_group
+
+# a stage counts as regressed if it is this much slower than the baseline
+REGRESSION_THRESHOLD = 1.10
+
+
+def timed(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return dict(min=min(times), median=statistics.median(times), runs=times)
+
+
+@contextmanager
+def environ(**values):
+    """Set environment variables for the duration of the block"""
+    old = {k: os.environ.get(k) for k in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def run_stages(group, users, repeat, settle_users, sum_payments):
+    from settle.balance import get_balances, settle_currency
+    from settle.reader import find_payment_files, read_payment
+
+    files = list(find_payment_files(group))
+    results = {}
+
+    def aggregate(cache):
+        with environ(SETTLE_CACHE='1' if cache else '0'):
+            get_balances(group)
+
+    results['scan'] = timed(lambda: list(find_payment_files(group)), repeat)
+    results['parse'] = timed(lambda: [read_payment(f, group) for f in files], repeat)
+    results['aggregate'] = timed(lambda: aggregate(False), repeat)
+    aggregate(True) # fill the cache
+    results['aggregate_cached'] = timed(lambda: aggregate(True), repeat)
+
+    balances = get_balances(group)
+    results['settle'] = timed(lambda: [list(settle_currency(c, b))
+                                       for (c, b) in balances.items()], repeat)
+
+    rnd = random.Random(0)
+    values = [Decimal(rnd.randint(-100000, 100000)) / 100 for _ in range(settle_users - 1)]
+    values.append(-sum(values))
+    many = {'user%d' % i: v for (i, v) in enumerate(values)}
+    results['settle_%d_users' % settle_users] = timed(
+        lambda: list(settle_currency('EUR', many)), repeat)
+
+    results.update(sum_minor_stages(group, users, repeat, sum_payments))
+    return results
+
+
+def sum_minor_stages(group, users, repeat, payments):
+    """
+    Sum up `payments` balances of the `minor` engine with both backends. The
+    receivers are drawn from a few fixed ones, like the lists of a real group.
+    """
+    from settle.balance import _get_balances_minor
+    from settle.group import Group
+    from settle.payment import Payment
+    from settle.reader import PaymentRecord
+
+    minor = Group.load(group.name)
+    minor.engine = 'minor'
+    rnd = random.Random(0)
+    people = ['user%d' % i for i in range(users)] # as in `generate_group`
+    pool = ['%' + l for l in minor.lists]
+    pool += [' '.join(rnd.sample(people, rnd.randint(1, min(10, users)))) for _ in range(8)]
+    records = [PaymentRecord.from_payment(None, Payment(
+        minor, rnd.choice(people), rnd.choice(pool), Decimal(rnd.randint(1, 50000)) / 100))
+               for _ in range(payments)]
+
+    results = {}
+    for backend in ('python', 'numpy'):
+        with environ(SETTLE_BACKEND=backend):
+            results['sum_minor_%s' % backend] = timed(
+                lambda: _get_balances_minor(minor, records), repeat)
+    return results
+
+
+def compare(results, baseline):
+    """Print the change of every stage against `baseline`, return True on regressions"""
+    regressed = False
+    print('%-24s %10s %10s %8s' % ('stage', 'baseline', 'now', 'ratio'))
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        old, new = baseline[stage]['min'], result['min']
+        ratio = new / old if old else float('inf')
+        mark = ''
+        if ratio > REGRESSION_THRESHOLD:
+            mark = ' REGRESSION'
+            regressed = True
+        print('%-24s %9.4fs %9.4fs %7.2fx%s' % (stage, old, new, ratio, mark))
+    return regressed
+
+
+def main():
+    p = argparse.ArgumentParser('run benchmarks')
+    add_arguments(p)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--settle-users', type=int, default=10000,
+                   help='number of users for the settlement scaling stage')
+    p.add_argument('--sum-payments', type=int, default=100000,
+                   help='number of payments for the minor engine summing stages')
+    p.add_argument('-o', '--output', help='write results as JSON to this file')
+    p.add_argument('--baseline', help='compare against this JSON result file')
+    args = p.parse_args()
+
+    home = tempfile.mkdtemp(prefix='settle-bench-')
+    try:
+        with environ(HOME=home, XDG_CACHE_HOME=os.path.join(home, '.cache')):
+            group = generate_group('bench', args.users, args.payments, args.list_depth,
+                                   args.currencies, args.modifiers, args.days, args.seed)
+            results = run_stages(group, args.users, args.repeat, args.settle_users,
+                                 args.sum_payments)
+    finally:
+        shutil.rmtree(home)
+
+    for stage, result in results.items():
+        print('%-24s %9.4fs (median %.4fs)' % (stage, result['min'], result['median']))
+
+    data = dict(
+        params={k: v for (k, v) in vars(args).items() if k not in ('output', 'baseline')},
+        python=platform.python_version(),
+        platform=platform.platform(),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(results, baseline):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
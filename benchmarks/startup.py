@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the cold-start wall time of common commands.
+
+    python -m benchmarks.startup [options] [--output FILE] [--baseline FILE]
+
+Every command is run as a new `python -m settle.commands` process against a
+synthetic group (see `benchmarks.generate`), after one warm-up run that
+fills the caches. Output and baseline comparison work like
+`benchmarks.run`.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from benchmarks.generate import add_arguments, generate_group
+from benchmarks.run import compare, environ, timed
+
+COMMANDS = [
+    ['print-balances'],
+    ['settle-balances'],
+    ['print-payments'],
+    ['print-balances', '--since', '2000-06-01'],
+]
+
+
+def main():
+    p = argparse.ArgumentParser('run startup benchmarks')
+    add_arguments(p)
+    p.add_argument('--repeat', type=int, default=10)
+    p.add_argument('-o', '--output', help='write results as JSON to this file')
+    p.add_argument('--baseline', help='compare against this JSON result file')
+    args = p.parse_args()
+
+    home = tempfile.mkdtemp(prefix='settle-bench-')
+    cache = os.path.join(home, '.cache')
+    env = dict(os.environ, HOME=home, XDG_CACHE_HOME=cache, SETTLE_DAEMON='0')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env.get('PYTHONPATH')]))
+
+    results = {}
+    try:
+        with environ(HOME=home, XDG_CACHE_HOME=cache):
+            generate_group('bench', args.users, args.payments, args.list_depth,
+                           args.currencies, args.modifiers, args.days, args.seed)
+        results['python'] = timed(lambda: subprocess.run(
+            [sys.executable, '-c', 'pass'], env=env, check=True), args.repeat)
+        for command in COMMANDS:
+            argv = [sys.executable, '-m', 'settle.commands', 'bench'] + command
+            run = lambda: subprocess.run(argv, env=env, check=True,
+                                         stdout=subprocess.DEVNULL)
+            run() # warm up the caches
+            results[' '.join(command)] = timed(run, args.repeat)
+    finally:
+        shutil.rmtree(home)
+
+    for stage, result in results.items():
+        print('%-40s %9.4fs (median %.4fs)' % (stage, result['min'], result['median']))
+
+    data = dict(
+        params={k: v for (k, v) in vars(args).items() if k not in ('output', 'baseline')},
+        python=platform.python_version(),
+        platform=platform.platform(),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(results, baseline):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
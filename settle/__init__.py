@@ -1,7 +1,38 @@
 DEFAULT_CURRENCY = 'EUR'
 MAX_LIST_RESOLVER_RECURSION_DEPTH = 16
+OPTIMAL_SETTLE_MAX_USERS = 16
+OPTIMAL_SETTLE_TIME_BUDGET = 1.0
+PARALLEL_CHUNK_SIZE = 256
+CHECKPOINT_INTERVAL_DAYS = 30
+IMPORT_BATCH_SIZE = 1000
+ENGINES = ('decimal', 'minor')
+BACKENDS = ('auto', 'python', 'numpy')
+# flat: all payments in payments/, sharded: dated ones in payments/YYYY/MM/
+LAYOUTS = ('flat', 'sharded')
+# directory: one file per payment, sqlite: <group>/payments.sqlite
+STORAGES = ('directory', 'sqlite')
+# async: list, stat and read payment files concurrently, see settle.aio
+IO_MODES = ('sync', 'async')
+ASYNC_IO_INFLIGHT = 32
+VECTORIZE_MIN_RECORDS = 10000
+# seconds to wait for the daemon before running a command without it
+DAEMON_TIMEOUT = 30.0
+# decimal places of the minor unit for the `minor` engine
+DEFAULT_MINOR_UNIT_DIGITS = 2
+MINOR_UNIT_DIGITS = {'BHD': 3, 'CLP': 0, 'IQD': 3, 'ISK': 0, 'JOD': 3, 'JPY': 0,
+                     'KRW': 0, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'TND': 3, 'VND': 0}
 IDENTIFIER_RE = r'[A-Za-z][-_A-Za-z0-9]*'
 IDENTIFIER_SPLIT_RE = ',?[ \t\r\n]+'
 FILE_CHARSET = 'utf-8'
 
-from settle import balance, commands, group, payment, reader, util
+_SUBMODULES = ('aio', 'archive', 'balance', 'cache', 'check', 'checkpoint',
+               'commands', 'daemon', 'export', 'gitrev', 'group', 'importer',
+               'index', 'multigroup', 'payment', 'profiling', 'reader',
+               'storage', 'util', 'vectorized')
+
+def __getattr__(name):
+    # import submodules on first access only, to keep startup fast
+    if name in _SUBMODULES:
+        import importlib
+        return importlib.import_module('settle.' + name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
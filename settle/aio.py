@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous reading of payment files, for groups on storage with a high
+latency per request, like network filesystems. It is used if `io` is set to
+`async` in the group config or by $SETTLE_IO.
+
+An asyncio event loop runs directory listings, stat calls and file reads in
+a pool of threads, with up to $SETTLE_IO_INFLIGHT (or ASYNC_IO_INFLIGHT) of
+them at a time. All shard directories are listed as soon as they are found,
+and files are read ahead of the parser, which still gets them in the order
+they are found in, just like from `find_payment_files`. The event loop is
+driven by the generators below, so nothing runs while they are not iterated
+but the requests already handed to the threads.
+"""
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from settle import FILE_CHARSET, profiling
+from settle.cache import stat_key
+from settle.util import debug, env_int
+
+
+def inflight_count(inflight=None):
+    """
+    The number of requests to run at a time: `inflight` if given, else
+    $SETTLE_IO_INFLIGHT, else ASYNC_IO_INFLIGHT.
+    """
+    from settle import ASYNC_IO_INFLIGHT
+    if inflight is None:
+        inflight = env_int('SETTLE_IO_INFLIGHT', ASYNC_IO_INFLIGHT)
+    return max(inflight, 1)
+
+
+def read_payments_async(group, query=None, inflight=None):
+    """Yield the `Payment` of every file matching the names `query`"""
+    from settle.reader import parse_text, payment_from_dict
+
+    async def fetch(run, f):
+        return f, await _read_text(run, f)
+
+    for f, text in read_ahead(group, query, fetch, inflight):
+        yield payment_from_dict(parse_text(text), group, f)
+
+
+def read_records_async(group, query=None, cache=None, inflight=None):
+    """
+    Yield (file, `PaymentRecord`) for every file matching the names `query`.
+    With `cache` (a `PaymentCache`), files are only read if their size or
+    mtime changed.
+    """
+    from settle.reader import parse_text, record_from_dict
+
+    async def fetch(run, f):
+        if cache is None:
+            return f, None, None, await _read_text(run, f)
+        key = stat_key(await run(os.stat, f))
+        record = cache.get(f, key)
+        if record is not None:
+            return f, key, record, None
+        return f, key, None, await _read_text(run, f)
+
+    for f, key, record, text in read_ahead(group, query, fetch, inflight):
+        if record is None:
+            profiling.count('cache_misses')
+            debug('parsing payment: %s', f)
+            record = record_from_dict(parse_text(text), group, f)
+            if cache is not None:
+                cache.set(f, key, record)
+        else:
+            profiling.count('cache_hits')
+        yield f, record
+
+
+def read_ahead(group, query, fetch, inflight=None):
+    """
+    Yield the result of the coroutine `fetch(run, f)` for every payment file
+    `f` of `group` matching the names `query`, in the order they are found.
+    `run(func, *args)` runs `func` in the thread pool. Up to `inflight`
+    results are fetched ahead.
+    """
+    from settle.archive import archived_files
+
+    inflight = inflight_count(inflight)
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(inflight, thread_name_prefix='settle-io')
+
+    def run(func, *args):
+        return loop.run_in_executor(executor, func, *args)
+
+    debug('reading payments of %s with %d requests in flight', group.name, inflight)
+    files = _walk(_list_tree(run, group.path('payments'), query), archived_files(group))
+    results = _read_ahead(files, lambda f: fetch(run, f), inflight)
+    try:
+        while True:
+            try:
+                with profiling.timer('io_wait'):
+                    result = loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+            yield result
+    finally:
+        loop.run_until_complete(_cancel(results))
+        loop.close()
+        executor.shutdown(wait=False)
+
+
+async def _cancel(results):
+    # when the generator is closed early, drop what has been read ahead
+    await results.aclose()
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _read_ahead(files, fetch, inflight):
+    pending = deque()
+    async for f in files:
+        pending.append(asyncio.ensure_future(fetch(f)))
+        # hand out what is done, even while waiting for more listings
+        while pending and (len(pending) >= inflight or pending[0].done()):
+            yield await pending.popleft()
+    while pending:
+        yield await pending.popleft()
+
+
+async def _list_tree(run, dir, query, shard=()):
+    """
+    List `dir` and start listing its shards right away. Return the paths of
+    its files and the tasks listing its shards, in the order of `os.scandir`.
+    """
+    from settle.reader import _shard_res
+
+    items = []
+    for name, path, is_file, is_dir in await run(_list_dir, dir):
+        if name[0] == '.':
+            debug('skip %s', path)
+        elif is_file:
+            profiling.count('files_scanned')
+            if query is not None and query.match_filename(name) is False:
+                profiling.count('files_skipped')
+                continue
+            items.append(path)
+        elif len(shard) < len(_shard_res) and _shard_res[len(shard)].match(name) and is_dir:
+            shard_ = shard + (int(name),)
+            if query is not None and query.match_shard(*shard_) is False:
+                debug('skip shard %s', path)
+                profiling.count('shards_skipped')
+                continue
+            items.append(asyncio.ensure_future(_list_tree(run, path, query, shard_)))
+        else:
+            debug('skip %s', path)
+    return items
+
+
+async def _walk(items, archived):
+    for item in await items:
+        if isinstance(item, str):
+            if item in archived:
+                debug('skip archived %s', item)
+            else:
+                yield item
+        else:
+            async for f in _walk(item, archived):
+                yield f
+
+
+def _list_dir(dir):
+    with os.scandir(dir) as entries:
+        return [(e.name, e.path, e.is_file(), e.is_dir()) for e in entries]
+
+
+async def _read_text(run, f):
+    text, size = await run(_read_file, f)
+    if size is not None:
+        profiling.count('files_read')
+        profiling.count('bytes_read', size)
+    return text
+
+
+def _read_file(f):
+    with open(f, encoding=FILE_CHARSET) as fh:
+        # one more request per file, only made when profiling
+        size = os.fstat(fh.fileno()).st_size if profiling.enabled else None
+        return fh.read(), size
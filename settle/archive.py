@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Archiving of old payments, see `settle archive`.
+
+All payments dated before a given day are packed into
+<group>/archives/<name>.tar.xz and removed from payments/. They are replaced
+by <group>/archives/<name>.summary, holding the totals of every person per
+currency (in all the archived payments, in those of every giver and in those
+of every receiver), the dates of the first and last archived payment, the
+names of the archived files, the sha256 of the archive and a digest over all
+these fields, which is checked whenever the summary is read. The summary is
+read as a single payment record (without giver, dated on the last archived
+day), so the balances stay the same while the payments no longer need to be
+parsed. Queries selecting only some of the archived payments by date, or by
+both giver and receiver, are refused.
+
+The summary is put in place before the payments are removed (and removed
+after they are restored). Payment files listed in a summary are skipped
+while they are still there, so an interrupted archive or restore neither
+loses nor double-counts a payment.
+"""
+import hashlib
+import os
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from functools import lru_cache
+from settle import FILE_CHARSET
+from settle.cache import stat_key
+from settle.reader import (PaymentQuery, PaymentRecord, parse_payment_date, read_all_records,
+                           read_file, write)
+from settle.util import MinorMoney, Money, debug, generate_random_filename
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def archive_payments(group, before, dry_run=False):
+    """
+    Archive all payments of `group` dated before `before` (a `date`). Return
+    the name of the archive (None if there was nothing to archive) and the
+    number of payments archived.
+    """
+    import tarfile
+
+    last = before - timedelta(days=1)
+    records = list(read_all_records(group, PaymentQuery(until=last), archived=False))
+    if not records or dry_run:
+        return None, len(records)
+
+    # (giver, receiver) -> currency -> user -> total, with '*' for any
+    # giver or receiver, to answer --giver and --receiver queries
+    totals = defaultdict(lambda: defaultdict(lambda: defaultdict(Decimal)))
+    for record in records:
+        receivers = {name for (name, _) in record.balances[:-1]}
+        for key in [('*', '*'), (record.giver, '*')] + [('*', r) for r in sorted(receivers)]:
+            for user, money in record.balances:
+                totals[key][money.currency][user] += money.value
+
+    dates = sorted(record.date.date() for record in records)
+    files = [os.path.relpath(record.file, group.path()) for record in records]
+    name = generate_random_filename(last.isoformat())
+    os.makedirs(group.path('archives'), exist_ok=True)
+    tar = group.path('archives', name + '.tar.xz')
+    with tarfile.open(tar + '.tmp', 'x:xz') as t:
+        for record, f in zip(records, files):
+            t.add(record.file, f)
+    os.replace(tar + '.tmp', tar)
+
+    summary = group.path('archives', name + '.summary')
+    d = {
+        'archive': name + '.tar.xz',
+        'sha256': _sha256(tar),
+        'first': dates[0].isoformat(),
+        'last': dates[-1].isoformat(),
+        'payments': len(records),
+        'files': '\n'.join(files),
+        'totals': '\n'.join('%s %s %s %s %s' % (giver, receiver, user, value, currency)
+                            for ((giver, receiver), currencies) in totals.items()
+                            for (currency, values) in currencies.items()
+                            for (user, value) in values.items()),
+    }
+    d['digest'] = _digest(d)
+    with open(summary + '.tmp', 'x', encoding=FILE_CHARSET) as f:
+        write(f, d)
+    # from now on the summary counts instead of the files it lists
+    os.replace(summary + '.tmp', summary)
+    for record in records:
+        os.unlink(record.file)
+    debug('archived %d payments to %s', len(records), tar)
+    return name, len(records)
+
+
+def restore_archive(group, name):
+    """
+    Move the payments of archive `name` back to payments/ and remove the
+    archive and its summary. Return the number of payments restored.
+    """
+    import tarfile
+
+    summary = group.path('archives', name + '.summary')
+    d = _read_summary(summary)
+    tar = group.path('archives', d['archive'])
+    if _sha256(tar) != d['sha256']:
+        raise ArchiveError('Checksum mismatch, %s has been modified' % tar)
+
+    listed = set(d['files'].splitlines())
+    with tarfile.open(tar, 'r:xz') as t:
+        members = []
+        for m in t.getmembers():
+            path = os.path.normpath(m.name)
+            if not m.isfile() or path.startswith('..') or os.path.isabs(path) or \
+                    path.split(os.sep)[0] != 'payments':
+                raise ArchiveError('Unexpected file in archive: %r' % m.name)
+            with t.extractfile(m) as src:
+                data = src.read()
+            members.append((m, group.path(path), data))
+            if os.path.exists(group.path(path)):
+                # left behind by an interrupted archive or restore
+                with open(group.path(path), 'rb') as f:
+                    if path not in listed or f.read() != data:
+                        raise ArchiveError('File already exists: %r' % group.path(path))
+        # the payments are skipped until the summary is gone
+        for m, path, data in members:
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'xb') as dst:
+                dst.write(data)
+            os.utime(path, (m.mtime, m.mtime))
+    os.unlink(summary)
+    os.unlink(tar)
+    return len(members)
+
+
+def list_archives(group):
+    """Yield the name and summary fields of every archive of `group`"""
+    for f in _summary_files(group):
+        yield os.path.basename(f)[:-len('.summary')], _read_summary(f)
+
+
+def read_summaries(group, query=None):
+    """
+    Yield the summary of every archive of `group` whose payments match
+    `query` as `PaymentRecord`, see `summary_matches`.
+    """
+    for f in _summary_files(group):
+        d = _read_summary(f)
+        if summary_matches(d, query, f):
+            yield summary_record(d, group, f, query)
+
+
+def archived_files(group):
+    """
+    The paths of the payment files listed in the summaries of `group`. Those
+    still there were left behind by an interrupted archive or restore, they
+    are counted by the summary and skipped by `find_payment_files`.
+    """
+    files = set()
+    for f in _summary_files(group):
+        files.update(group.path(p) for p in _read_summary(f)['files'].splitlines())
+    return files
+
+
+def summary_matches(d, query, f):
+    """
+    Check if the payments archived in the summary `d` (from file `f`) match
+    `query`. The summary has their totals per giver and per receiver, but
+    not by date or by both, so a query matching only some of them by date,
+    or filtering by giver and receiver, raises `ArchiveError`.
+    """
+    if query is None:
+        return True
+    first = parse_payment_date(d['first']).date()
+    last = parse_payment_date(d['last']).date()
+    if ((query.since is not None and query.since > last) or
+            (query.until is not None and query.until < first)):
+        return False
+    if ((query.since is not None and query.since > first) or
+            (query.until is not None and query.until < last) or
+            (query.giver is not None and query.receiver is not None)):
+        raise ArchiveError('%s only has the totals of the payments archived from %s to %s, '
+                           'restore the archive to select some of them'
+                           % (f, d['first'], d['last']))
+    return True
+
+
+def summary_record(d, group, f=None, query=None):
+    """
+    Build the `PaymentRecord` of the summary fields `d` from file `f`, with
+    the totals of the payments matching the giver or receiver of `query`
+    """
+    key = ('*' if query is None or query.giver is None else query.giver,
+           '*' if query is None or query.receiver is None else query.receiver)
+    balances = []
+    for line in d['totals'].splitlines():
+        giver, receiver, user, value, currency = line.split(' ', 4)
+        if (giver, receiver) != key:
+            continue
+        if group.engine == 'minor':
+            balances.append((user, MinorMoney.from_decimal(Decimal(value), currency)))
+        else:
+            balances.append((user, Money(Decimal(value), currency)))
+    return PaymentRecord(f, None, d['last'], balances)
+
+
+def verify_summary(d, f):
+    """Raise `ArchiveError` if the summary fields `d` (from file `f`) were modified"""
+    if d.get('digest') != _digest(d):
+        raise ArchiveError('Checksum mismatch, %s has been modified' % f)
+
+
+def _read_summary(f):
+    return _read_summary_cached(f, stat_key(os.stat(f)))
+
+
+@lru_cache(maxsize=64)
+def _read_summary_cached(f, key):
+    # summaries are read for every scan of the payments, see `archived_files`
+    d = read_file(f)
+    verify_summary(d, f)
+    return d
+
+
+def _digest(d):
+    # multi-line values are read back with a trailing newline
+    h = hashlib.sha256()
+    for k in sorted(d):
+        if k != 'digest':
+            h.update(('%s: %s\n' % (k, str(d[k]).rstrip('\n'))).encode(FILE_CHARSET))
+    return h.hexdigest()
+
+
+def _summary_files(group):
+    try:
+        names = os.listdir(group.path('archives'))
+    except FileNotFoundError:
+        return []
+    return [group.path('archives', n) for n in sorted(names) if n.endswith('.summary')]
+
+
+def _sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.hexdigest()
@@ -1,47 +1,233 @@
 # -*- coding: utf-8 -*-
 from collections import defaultdict, deque, namedtuple
 from decimal import Decimal
-from functools import partial
+from heapq import heappop, heappush
+from itertools import count
+import os
+import time
 from operator import itemgetter
-from settle.reader import read_all_payments
-from settle.util import Money
+from settle import profiling
+from settle.util import Money, debug, from_minor
 
 Balance = namedtuple('Balance', ('name', 'value'))
 Transfer = namedtuple('Transfer', ('giver', 'receiver', 'value'))
 
-def get_balances(group):
+def get_balances(group, query=None, jobs=None, rev=None):
+    """
+    Return the balances of all payments of `group` matching `query` as
+    {currency: {name: Decimal}}. With `rev`, the payments are read from that
+    git revision of the group, see `settle.gitrev`. Storages which can sum
+    up balances themselves do so, see `settle.storage`.
+    """
+    if rev is not None:
+        from settle.gitrev import Revision
+        revision = Revision(group, rev)
+        group, records = revision.group, revision.records(query)
+    else:
+        from settle.storage import get_storage
+        storage = get_storage(group)
+        balances = storage.balances(query)
+        if balances is not None:
+            return balances
+        records = storage.records(query, jobs=jobs)
+
+    if group.engine == 'minor':
+        return _get_balances_minor(group, records)
+
     currencies = defaultdict(lambda: defaultdict(Decimal))
-    for payment in read_all_payments(group):
-        for user, money in payment.balances:
-            currencies[money.currency][user] += money.value
+    with profiling.timer('get_balances'):
+        for record in records:
+            for user, money in record.balances:
+                currencies[money.currency][user] += money.value
 
     return currencies
 
-def settle_balances(group):
-    all_balances = get_balances(group)
-    balancesorted = partial(sorted, key=itemgetter(1))
+def _get_balances_minor(group, records):
+    """
+    `get_balances` for the `minor` engine, summing up ints. Large groups are
+    summed up with NumPy, see `balance_backend`.
+    """
+    from settle import VECTORIZE_MIN_RECORDS
+
+    with profiling.timer('get_balances'):
+        backend = balance_backend(group)
+        if backend == 'auto':
+            records = list(records)
+            backend = 'numpy' if len(records) >= VECTORIZE_MIN_RECORDS else 'python'
+
+        if backend == 'numpy':
+            from settle.vectorized import sum_minor
+            minor = sum_minor(records)
+        else:
+            minor = defaultdict(lambda: defaultdict(int))
+            for record in records:
+                for user, money in record.balances:
+                    minor[money.currency][user] += money.minor
+
+    currencies = defaultdict(lambda: defaultdict(Decimal))
+    for currency, values in minor.items():
+        for user, value in values.items():
+            currencies[currency][user] = from_minor(value, currency)
+    return currencies
+
+def balance_backend(group):
+    """
+    The backend to sum up balances of the `minor` engine with: $SETTLE_BACKEND
+    or the group's `backend` setting. 'auto' uses NumPy for groups with at
+    least VECTORIZE_MIN_RECORDS payments. Without NumPy it is always 'python'.
+    """
+    from settle import BACKENDS
+    from settle.util import SettingError
+
+    backend = os.environ.get('SETTLE_BACKEND') or group.backend
+    if backend not in BACKENDS:
+        raise SettingError('$SETTLE_BACKEND must be one of %s, not %r'
+                           % (', '.join(BACKENDS), backend))
+    if backend != 'python':
+        try:
+            import numpy
+        except ImportError:
+            debug('NumPy is not installed, using the python backend')
+            return 'python'
+    return backend
+
+def settle_balances(group, optimal=False, time_budget=None, query=None, jobs=None, rev=None):
+    """Generate the transfers needed to settle all balances of `group`"""
+    return settle(get_balances(group, query, jobs=jobs, rev=rev), optimal, time_budget)
+
+def settle(all_balances, optimal=False, time_budget=None):
+    """
+    Generate the transfers needed to settle `all_balances` as returned by
+    `get_balances`.
+
+    If `optimal` is True, try to minimize the number of transfers within
+    `time_budget` seconds, see `settle_currency_optimal`.
+    """
+    from settle import OPTIMAL_SETTLE_TIME_BUDGET
+    if time_budget is None:
+        time_budget = OPTIMAL_SETTLE_TIME_BUDGET
+    # as a generator, this only runs once the balances have been computed, so
+    # reading the payments does not count against the budget
+    deadline = time.monotonic() + time_budget
+
     for currency, raw_balances in all_balances.items():
-        balances = balancesorted(raw_balances.items())
-        balances = [Balance(n,v) for (n,v) in balances]
-
-        for _ in range(len(balances)): # ensure termination
-            poorest = balances.pop(0)
-            richest = balances.pop() #last
-            transfer = min(abs(richest.value), abs(poorest.value))
-            yield Transfer(poorest.name, richest.name, Money(transfer, currency))
-
-            richest = Balance(richest.name, richest.value - transfer)
-            poorest = Balance(poorest.name, poorest.value + transfer)
-            # there may be rounding problems (e.g. 1/3) where we won't get zero
-            if round(richest.value, 10) != 0:
-                balances.append(richest)
-            if round(poorest.value, 10) != 0:
-                balances.append(poorest)
-
-            balances = balancesorted(balances)
-
-            if not balances:
-                break
-
-        if balances:
-            raise RuntimeError('balances left. this should not happen')
+        if optimal:
+            yield from settle_currency_optimal(currency, raw_balances, deadline)
+        else:
+            yield from settle_currency(currency, raw_balances)
+
+def settle_currency(currency, raw_balances):
+    """
+    Greedily settle the balances of one currency by repeatedly letting the
+    poorest pay the richest.
+
+    Debtors and creditors are kept in two heaps. Ties are broken by insertion
+    order (the first of the poorest pays the last of the richest), so the
+    result is the same as with a list that is stably re-sorted after every
+    transfer.
+    """
+    debtors = []   # (value, seq, Balance), poorest first
+    creditors = [] # (-value, -seq, Balance), richest first
+    seq = count()
+
+    def push(balance):
+        # there may be rounding problems (e.g. 1/3) where we won't get zero
+        if round(balance.value, 10) == 0:
+            return
+        if balance.value < 0:
+            heappush(debtors, (balance.value, next(seq), balance))
+        else:
+            heappush(creditors, (-balance.value, -next(seq), balance))
+
+    for name, value in sorted(raw_balances.items(), key=itemgetter(1)):
+        push(Balance(name, value))
+
+    for _ in range(len(debtors) + len(creditors)): # ensure termination
+        if not debtors or not creditors:
+            break
+
+        profiling.count('settle_iterations')
+        poorest = heappop(debtors)[2]
+        richest = heappop(creditors)[2]
+        transfer = min(abs(richest.value), abs(poorest.value))
+        yield Transfer(poorest.name, richest.name, Money(transfer, currency))
+
+        push(Balance(richest.name, richest.value - transfer))
+        push(Balance(poorest.name, poorest.value + transfer))
+
+    if debtors or creditors:
+        raise RuntimeError('balances left. this should not happen')
+
+def settle_currency_optimal(currency, raw_balances, deadline=None):
+    """
+    Settle the balances of one currency with as few transfers as possible.
+
+    The users are partitioned into the maximum number of subgroups whose
+    balances sum up to zero, each of which is then settled on its own with
+    one transfer less than it has members. Fall back to `settle_currency` if
+    there are too many users or `deadline` (see `time.monotonic`) passes.
+    """
+    from settle import OPTIMAL_SETTLE_MAX_USERS
+
+    balances = [(n, v) for (n, v) in raw_balances.items() if round(v, 10) != 0]
+    groups = None
+    if len(balances) <= OPTIMAL_SETTLE_MAX_USERS:
+        with profiling.timer('settle_optimal'):
+            groups = _zero_sum_groups([v for (_, v) in balances], deadline)
+
+    if groups is None:
+        debug('optimal settlement not possible for %d %s balances, '
+              'falling back to greedy', len(balances), currency)
+        yield from settle_currency(currency, raw_balances)
+        return
+
+    for group in groups:
+        yield from settle_currency(currency, dict(balances[i] for i in group))
+
+def _zero_sum_groups(values, deadline=None):
+    """
+    Partition `values` into the maximum number of zero-sum groups.
+
+    Returns a list of lists of indexes into `values`, or None if `deadline`
+    passed. Uses a DP over all subsets: best[mask] is the maximum number of
+    zero-sum groups a chain of subsets removing one element at a time from
+    `mask` passes through.
+    """
+    n = len(values)
+    full = (1 << n) - 1
+    # compare in units of 1e-10 and allow for one unit of rounding error per
+    # value (as in settle_currency, 1/3 splits won't sum up to exactly zero)
+    scaled = [int(v.scaleb(10).to_integral_value()) for v in values]
+    sums = [0] * (full + 1)
+    best = [0] * (full + 1)
+    removed = [0] * (full + 1)
+
+    for mask in range(1, full + 1):
+        if mask & 0x3fff == 0 and deadline is not None and time.monotonic() > deadline:
+            return None
+
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + scaled[low.bit_length() - 1]
+
+        best_bit, best_count = 0, -1
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            if best[mask ^ bit] > best_count:
+                best_bit, best_count = bit, best[mask ^ bit]
+            rest ^= bit
+        best[mask] = best_count + (abs(sums[mask]) <= n)
+        removed[mask] = best_bit
+
+    groups = []
+    group = []
+    mask = full
+    while mask:
+        bit = removed[mask]
+        group.append(bit.bit_length() - 1)
+        mask ^= bit
+        if mask == 0 or abs(sums[mask]) <= n:
+            groups.append(group)
+            group = []
+
+    return groups
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import pickle
+import time
+from settle.util import debug
+
+CACHE_VERSION = 7
+# files modified more recently than this (in ns) are not cached, as a later
+# modification within the same mtime tick would go unnoticed
+RACY_MTIME_WINDOW = 2 * 10**9
+
+
+class PaymentCache:
+    """
+    On-disk cache of a `PaymentRecord` for every payment file of a group.
+
+    Entries are keyed by file name and validated against the size and mtime
+    of the file. The whole cache is dropped when the group's `config`,
+    `localconfig` or `lists` change, as these influence how balances are
+    resolved.
+    """
+    def __init__(self, group):
+        self.group = group
+        self.filename = cache_path(group.name, 'payments')
+        self.fingerprint = group_fingerprint(group)
+        self.entries = {}
+        self.changed = False
+        self.load()
+
+    def __repr__(self):
+        return '<PaymentCache group=%s, %d entries>' % (self.group.name, len(self.entries))
+
+    def load(self):
+        entries = load_cache_file(self.filename, CACHE_VERSION, self.fingerprint)
+        if entries is None:
+            self.changed = os.path.exists(self.filename)
+        else:
+            self.entries = entries
+
+    def get(self, f, key):
+        """Return the cached value for file `f` if it is still valid for `key`"""
+        entry = self.entries.get(f)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        return None
+
+    def set(self, f, key, value):
+        if time.time_ns() - key[1] < RACY_MTIME_WINDOW:
+            self.discard(f)
+            return
+        self.entries[f] = (key, value)
+        self.changed = True
+
+    def discard(self, f):
+        if self.entries.pop(f, None) is not None:
+            self.changed = True
+
+    def prune(self, seen):
+        """Drop the entries of all files not contained in `seen`"""
+        for f in set(self.entries) - seen:
+            self.discard(f)
+
+    def save(self):
+        if self.changed and save_cache_file(self.filename, CACHE_VERSION,
+                                            self.fingerprint, self.entries):
+            self.changed = False
+
+
+def load_cache_file(filename, version, fingerprint):
+    """
+    Load the data of a cache file written by `save_cache_file`. Return None
+    if it does not exist, is corrupt or does not match `version` and
+    `fingerprint`.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            version_, fingerprint_, data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        debug('dropping corrupt cache %s: %r', filename, e)
+        return None
+
+    if version_ != version or fingerprint_ != fingerprint:
+        debug('dropping stale cache %s', filename)
+        return None
+    return data
+
+
+def save_cache_file(filename, version, fingerprint, data):
+    """Atomically write a cache file. Return False if that failed."""
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            pickle.dump((version, fingerprint, data), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    except OSError as e:
+        debug('could not write cache %s: %r', filename, e)
+        return False
+    return True
+
+
+def group_fingerprint(group):
+    """Fingerprint of the group files that influence how balances are resolved"""
+    return fingerprint(group.path('config'), group.path('localconfig'), group.path('lists'))
+
+
+def cache_path(name, *parts):
+    """
+    The path of cache file `parts` of group `name`, below
+    $XDG_CACHE_HOME/settle (default: ~/.cache/settle). Caches are pickles,
+    which can run code when loaded, so they are kept out of the group
+    directory, which is usually shared through git.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'settle', name, *parts)
+
+
+def cache_enabled():
+    return os.environ.get('SETTLE_CACHE') != '0'
+
+
+def stat_key(st):
+    return (st.st_size, st.st_mtime_ns)
+
+
+def fingerprint(*filenames):
+    """Hash the contents of all given files. Missing files count as empty."""
+    h = hashlib.sha1()
+    for filename in filenames:
+        try:
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        except FileNotFoundError:
+            pass
+        h.update(b'\0')
+    return h.hexdigest()
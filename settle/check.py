@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Validation of all payment files of a group, see `settle check`.
+"""
+import os
+import time
+from collections import Counter, defaultdict
+from functools import partial
+from settle import profiling
+from settle.cache import (RACY_MTIME_WINDOW, cache_enabled, cache_path, group_fingerprint,
+                          load_cache_file, save_cache_file, stat_key)
+from settle.reader import ReaderError, find_payment_files, read_payment
+from settle.util import debug, jobs_count
+
+CHECK_STATE_VERSION = 1
+
+
+def check_group(group, incremental=False, jobs=None):
+    """
+    Validate every payment file of `group` and return all problems found as
+    list of (file, message) pairs, in file order.
+
+    Files which passed are remembered with their size and mtime in the
+    group's `check` cache (see `cache_path`). With `incremental`, these are
+    not read again as long as they and the group's configuration are
+    unchanged.
+    """
+    filename = cache_path(group.name, 'check')
+    fingerprint = group_fingerprint(group)
+    state = {}
+    if incremental and cache_enabled():
+        state = load_cache_file(filename, CHECK_STATE_VERSION, fingerprint) or {}
+
+    files = []
+    todo = []
+    currencies = {}
+    for f in find_payment_files(group):
+        key = stat_key(os.stat(f))
+        files.append((f, key))
+        entry = state.get(f)
+        if entry is not None and entry[0] == key:
+            currencies[f] = entry[1]
+        else:
+            todo.append(f)
+    debug('checking %d of %d payment files', len(todo), len(files))
+    profiling.count('check_skipped', len(files) - len(todo))
+
+    errors = defaultdict(list)
+    for f, (error, currency) in zip(todo, _check_files(group, todo, jobs_count(jobs))):
+        if error is None:
+            currencies[f] = currency
+        else:
+            errors[f].append(error)
+
+    # the same currency spelt differently ends up in separate balances, the
+    # default currency or else the most common spelling is taken as correct
+    spellings = defaultdict(Counter)
+    for currency in currencies.values():
+        spellings[currency.upper()][currency] += 1
+    for f, currency in currencies.items():
+        counts = spellings[currency.upper()]
+        if len(counts) > 1:
+            if group.default_currency in counts:
+                correct = group.default_currency
+            else:
+                correct = counts.most_common(1)[0][0]
+            if currency != correct:
+                errors[f].append('Currency %r is spelt %r in %d other payments'
+                                 % (currency, correct, counts[correct]))
+
+    if cache_enabled():
+        now = time.time_ns()
+        passed = {f: (key, currencies[f]) for (f, key) in files
+                  if f not in errors and now - key[1] >= RACY_MTIME_WINDOW}
+        if passed != state:
+            save_cache_file(filename, CHECK_STATE_VERSION, fingerprint, passed)
+
+    return [(f, error) for (f, _) in files for error in errors.get(f, ())]
+
+
+def check_file(f, group):
+    """Return the error message (or None) and the currency of payment file `f`"""
+    try:
+        payment = read_payment(f, group)
+    except (ReaderError, ValueError, ArithmeticError, OSError) as e:
+        return str(e) or type(e).__name__, None
+    return None, payment.currency
+
+
+def _check_files(group, files, jobs):
+    from settle import PARALLEL_CHUNK_SIZE
+    from concurrent.futures import ProcessPoolExecutor
+
+    if jobs <= 1 or len(files) <= PARALLEL_CHUNK_SIZE:
+        return [check_file(f, group) for f in files]
+
+    chunks = [files[i:i + PARALLEL_CHUNK_SIZE]
+              for i in range(0, len(files), PARALLEL_CHUNK_SIZE)]
+    with ProcessPoolExecutor(jobs) as executor:
+        return [result for results in executor.map(partial(_check_chunk, group), chunks)
+                for result in results]
+
+
+def _check_chunk(group, files):
+    return [check_file(f, group) for f in files]
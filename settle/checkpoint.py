@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+from collections import defaultdict, namedtuple
+from datetime import date
+from decimal import Decimal
+from settle import profiling
+from settle.cache import (PaymentCache, cache_enabled, cache_path, group_fingerprint, load_cache_file,
+                          save_cache_file, stat_key)
+from settle.reader import PaymentQuery, find_payment_files, payment_filename_date, read_records
+from settle.storage import get_storage
+from settle.util import debug
+
+CHECKPOINTS_VERSION = 2
+
+Checkpoint = namedtuple('Checkpoint', ('date', 'digest', 'totals'))
+
+
+def get_balances_as_of(group, as_of, jobs=None):
+    """
+    Return the balances of `group` (like `get_balances`) counting only the
+    payments dated on or before `as_of`. Payments without date are ignored.
+
+    Storages which sum up balances themselves are simply queried. Otherwise
+    cumulative totals are checkpointed every CHECKPOINT_INTERVAL_DAYS in the
+    group's `checkpoints` cache. A query starts from the latest checkpoint
+    before `as_of` and only reads the payments after it. Every checkpoint
+    carries a digest over the names, sizes and mtimes of all payment files
+    dated before it, so it is validated without reading them, and adding,
+    changing or removing such a file invalidates it. As with --until, the
+    date in a file name as generated by `store_payment` is trusted, only
+    files named otherwise are read to find their date. An `as_of` within the
+    dates of an archive raises `ArchiveError`, see `settle.archive`.
+    """
+    from settle import CHECKPOINT_INTERVAL_DAYS
+    from settle.archive import read_summaries
+
+    query = PaymentQuery(until=as_of)
+    balances = get_storage(group).balances(query)
+    if balances is not None:
+        return balances
+
+    cache = None
+    records = {}
+    def read(files):
+        nonlocal cache
+        files = [(f, key) for (f, key) in files if f not in records]
+        if files:
+            if cache is None and cache_enabled():
+                cache = PaymentCache(group)
+            records.update(read_records(group, files, cache, jobs))
+
+    files = [] # (day, file, stat key)
+    unnamed = []
+    with profiling.timer('scan'):
+        for f in find_payment_files(group, query):
+            key = stat_key(os.stat(f))
+            day = payment_filename_date(os.path.basename(f))
+            if day is None:
+                unnamed.append((f, key))
+            else:
+                files.append((day, f, key))
+    read(unnamed)
+    for record in read_summaries(group, query):
+        records[record.file] = record
+        unnamed.append((record.file, stat_key(os.stat(record.file))))
+    for f, key in unnamed:
+        d = records[f].date
+        if d is not None and d.date() <= as_of:
+            files.append((d.date(), f, key))
+    files.sort(key=lambda e: (e[0], e[1]))
+
+    # the digest of the files before every boundary where a checkpoint would
+    # be (i.e. could be) taken, and the index of the first file after it
+    h = hashlib.sha1()
+    boundaries = {}
+    for i, (day, f, key) in enumerate(files):
+        boundary = _boundary(day, CHECKPOINT_INTERVAL_DAYS)
+        if boundary not in boundaries:
+            boundaries[boundary] = (h.hexdigest(), i)
+        h.update(repr((os.path.relpath(f, group.path()), key)).encode())
+
+    filename = cache_path(group.name, 'checkpoints')
+    fingerprint = group_fingerprint(group)
+    stored = {}
+    if cache_enabled():
+        stored = {c.date: c for c in load_cache_file(
+            filename, CHECKPOINTS_VERSION, fingerprint) or ()}
+
+    valid = [c for c in stored.values() if c.date > as_of]
+    start = 0
+    totals = defaultdict(lambda: defaultdict(Decimal))
+    for boundary, (digest, i) in boundaries.items():
+        c = stored.get(boundary)
+        if c is not None and c.digest == digest:
+            valid.append(c)
+            start = i
+            totals = defaultdict(lambda: defaultdict(Decimal),
+                                 {k: defaultdict(Decimal, v) for (k, v) in c.totals.items()})
+    debug('checkpoints: %d stored, %d valid, replaying %d of %d payments',
+          len(stored), len(valid), len(files) - start, len(files))
+    profiling.count('checkpoint_replayed', len(files) - start)
+
+    new = {i: (boundary, digest) for (boundary, (digest, i)) in boundaries.items()
+           if i > start}
+    read((f, key) for (_, f, key) in files[start:])
+    # a payment dated differently than its file name breaks the order
+    # checkpoints rely on, none are taken after it
+    trusted = True
+    for i in range(start, len(files)):
+        if i in new and trusted:
+            boundary, digest = new[i]
+            valid.append(Checkpoint(boundary, digest,
+                                    {k: dict(v) for (k, v) in totals.items()}))
+        day, f, _ = files[i]
+        record = records[f]
+        if record.date is None or record.date.date() != day:
+            trusted = False
+        if record.date is not None and record.date.date() <= as_of:
+            for user, money in record.balances:
+                totals[money.currency][user] += money.value
+
+    if cache is not None:
+        cache.save()
+    if cache_enabled() and ({(c.date, c.digest) for c in valid} !=
+                            {(c.date, c.digest) for c in stored.values()}):
+        save_cache_file(filename, CHECKPOINTS_VERSION, fingerprint,
+                        sorted(valid, key=lambda c: c.date))
+
+    return totals
+
+
+def _boundary(d, interval):
+    """The latest checkpoint date on or before `d`"""
+    return date.fromordinal(d.toordinal() - d.toordinal() % interval)
@@ -1,27 +1,90 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import argparse
 import os
 import re
 import sys
-from dateutil.parser import parse as parse_date
-from datetime import datetime
-from settle import IDENTIFIER_RE, IDENTIFIER_SPLIT_RE, FILE_CHARSET
-from settle.balance import get_balances, settle_balances
-from settle.group import Group
-from settle.payment import Payment
-from settle.reader import read_all_payments, store_payment
-from settle.util import ask, debug, format_decimal
+from settle import IDENTIFIER_RE, IDENTIFIER_SPLIT_RE, FILE_CHARSET, OPTIMAL_SETTLE_TIME_BUDGET
+from settle import profiling
+from settle.util import ask, debug, format_decimal, parse_date
+
+# Everything else (including argparse) is imported where it is used, so
+# that commands forwarded to the daemon or served from the caches start fast.
 
 _identifier_re = re.compile(r'^%s$' % IDENTIFIER_RE)
 _identifiers_re = re.compile(r'^(%%?%s%s)*%%?%s$' % (IDENTIFIER_RE, IDENTIFIER_SPLIT_RE, IDENTIFIER_RE))
 
+def _add_jobs_argument(p):
+    p.add_argument('-j', '--jobs', type=int, metavar='N',
+                   help='parse payments in N processes, 0 for one per CPU '
+                   '[$SETTLE_JOBS or 1]')
+
+def _argument_parser(prog):
+    import argparse
+    return argparse.ArgumentParser(prog)
+
+def _date_argument(s):
+    import argparse
+    try:
+        return parse_date(s).date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid date: %r' % s)
+
+def _add_query_arguments(p):
+    p.add_argument('--since', type=_date_argument, metavar='DATE',
+                   help='only payments on or after DATE')
+    p.add_argument('--until', type=_date_argument, metavar='DATE',
+                   help='only payments on or before DATE')
+    p.add_argument('--giver', help='only payments by GIVER')
+    p.add_argument('--receiver', help='only payments for RECEIVER')
+
+def _add_format_argument(p):
+    from settle.export import FORMATS
+    p.add_argument('--format', choices=('text',) + FORMATS, default='text',
+                   help='output format, amounts are exported with full '
+                   'precision [%(default)s]')
+
+def _add_rev_argument(p):
+    p.add_argument('--rev', metavar='COMMIT',
+                   help='read the payments from git revision COMMIT of the group')
+
+def _read_payments(group, query, rev):
+    if rev is None:
+        from settle.storage import get_storage
+        return get_storage(group).payments(query)
+    from settle.gitrev import Revision
+    return Revision(group, rev).payments(query)
+
+def _require_directory_storage(p, group):
+    if group.storage != 'directory':
+        p.error('not supported with %s storage, see migrate-storage' % group.storage)
+
+def _payment_query(args):
+    from settle.reader import PaymentQuery
+    if args.since is None and args.until is None and args.giver is None and \
+            args.receiver is None:
+        return None
+    return PaymentQuery(since=args.since, until=args.until, giver=args.giver,
+                        receiver=args.receiver)
+
 class Commands:
     _funcdict = None
+    in_daemon = False
+
+    def load_group(self, name):
+        from settle.group import Group
+        return Group.load(name)
+
+    def get_balances(self, group, query=None, jobs=None, rev=None):
+        from settle.balance import get_balances
+        return get_balances(group, query, jobs=jobs, rev=rev)
 
     def do_new(self, group, raw_args):
-        p = argparse.ArgumentParser('create new payment')
+        from datetime import datetime
+        from settle.payment import Payment
+        from settle.storage import get_storage
+
+        p = _argument_parser('create new payment')
         p.add_argument('amount', nargs='?')
         p.add_argument('receivers', nargs='*')
         args = p.parse_args(raw_args)
@@ -39,8 +102,8 @@ class Commands:
                             'list of people. ', require=_identifiers_re)
             #TODO: verify if the names are valid receivers
         else:
-            receivers = args.receivers
-            print('Receivers:', ' '.join(receivers))
+            receivers = ' '.join(args.receivers)
+            print('Receivers:', receivers)
 
         giver = ask('Who payed? ', default=group.default_giver)
 
@@ -61,43 +124,267 @@ class Commands:
         comment = ask('Comment? ', blank=True)
 
         p = Payment(group, giver, receivers, amount, date=date, comment=comment)
-        debug('%r\n  %r' % (p, p.receivers.to_string()))
-        store_payment(p)
-
-    def do_print_balances(self, group, args):
-        if len(args) > 1:
-            raise ValueError('Too many arguments')
+        debug('%r\n  %r', p, p.receivers.to_string())
+        get_storage(group).store([p])
+
+    def do_print_balances(self, group, raw_args):
+        from settle.checkpoint import get_balances_as_of
+
+        p = _argument_parser('print balances')
+        p.add_argument('name', nargs='?')
+        p.add_argument('--as-of', type=_date_argument, metavar='DATE',
+                       help='balances at the end of DATE, ignoring payments '
+                       'without date')
+        _add_query_arguments(p)
+        _add_rev_argument(p)
+        _add_jobs_argument(p)
+        _add_format_argument(p)
+        args = p.parse_args(raw_args)
 
-        balances = get_balances(group)
+        query = _payment_query(args)
+        if args.as_of is not None:
+            if query is not None or args.rev is not None:
+                p.error('--as-of cannot be combined with a query or --rev')
+            balances = get_balances_as_of(group, args.as_of, jobs=args.jobs)
+        else:
+            balances = self.get_balances(group, query, jobs=args.jobs, rev=args.rev)
 
-        filter_name = None
-        if len(args) == 1:
-            filter_name = args[0]
-        elif len(args) > 1:
-            raise ValueError('Too many arguments')
+        if args.format != 'text':
+            from settle.export import export_balances
+            export_balances(balances, args.format, sys.stdout, args.name)
+            return
 
         for currency in balances:
             for name, val in balances[currency].items():
-                if filter_name is None or name == filter_name:
+                if args.name is None or name == args.name:
                     print('%-12s %s %s' % (name, format_decimal(val), currency))
 
-    def do_print_payments(self, group, args):
-        if args:
-            raise ValueError('Too many arguments')
-        for payment in read_all_payments(group):
+    def do_print_payments(self, group, raw_args):
+        p = _argument_parser('print payments')
+        _add_query_arguments(p)
+        _add_rev_argument(p)
+        _add_format_argument(p)
+        args = p.parse_args(raw_args)
+
+        payments = _read_payments(group, _payment_query(args), args.rev)
+        if args.format != 'text':
+            from settle.export import export_payments
+            export_payments(payments, args.format, sys.stdout)
+            return
+
+        for payment in payments:
             print('%-14s %s%s' % (payment.giver, payment.datestr or '',
                   ('\n%s' % payment.comment if payment.comment else '')))
             for user, money in payment.balances:
                 print('  %-12s %s' % (user, money))
             print()
 
-    def do_settle_balances(self, group, args):
-        for giver, receiver, money in settle_balances(group):
+    def do_statement(self, group, raw_args):
+        from settle.index import statement
+        from settle.util import shorten
+
+        p = _argument_parser('statement')
+        p.add_argument('name')
+        args = p.parse_args(raw_args)
+        _require_directory_storage(p, group)
+
+        for payment, share, balance in statement(group, args.name):
+            print('%-16s %-12s %s %-4s %s %s  %s' % (
+                payment.datestr or '-', payment.giver,
+                format_decimal(payment.amount, sign=False), payment.currency,
+                format_decimal(share), format_decimal(balance),
+                shorten(payment.comment, 40)))
+
+    def do_settle_balances(self, group, raw_args):
+        from settle.balance import settle
+
+        p = _argument_parser('settle balances')
+        p.add_argument('--optimal', action='store_true',
+                       help='minimize the number of transfers (falls back '
+                       'to the default method for large groups)')
+        p.add_argument('--time-budget', type=float, metavar='SECONDS',
+                       help='give up on --optimal after this time '
+                       '[%s]' % OPTIMAL_SETTLE_TIME_BUDGET)
+        _add_query_arguments(p)
+        _add_rev_argument(p)
+        _add_jobs_argument(p)
+        _add_format_argument(p)
+        args = p.parse_args(raw_args)
+
+        balances = self.get_balances(group, _payment_query(args), jobs=args.jobs,
+                                     rev=args.rev)
+        transfers = settle(balances, args.optimal, args.time_budget)
+        if args.format != 'text':
+            from settle.export import export_transfers
+            export_transfers(transfers, args.format, sys.stdout)
+            return
+
+        for giver, receiver, money in transfers:
             print('%-12s -> %-12s %s %s' % (giver, receiver,
                 format_decimal(money.value, sign=False), money.currency))
 
+    def do_export(self, group, raw_args):
+        from settle.balance import settle
+        from settle.export import FORMATS, export_balances, export_payments, export_transfers
+
+        p = _argument_parser('export payments, balances or transfers')
+        p.add_argument('what', choices=('payments', 'balances', 'transfers'))
+        p.add_argument('--format', choices=FORMATS, default='ndjson',
+                       help='output format [%(default)s]')
+        p.add_argument('-o', '--output', metavar='FILE',
+                       help='write to FILE instead of stdout')
+        _add_query_arguments(p)
+        _add_rev_argument(p)
+        _add_jobs_argument(p)
+        args = p.parse_args(raw_args)
+
+        query = _payment_query(args)
+        if args.output is None:
+            out = sys.stdout
+        else:
+            out = open(args.output, 'w', encoding=FILE_CHARSET, newline='')
+
+        try:
+            if args.what == 'payments':
+                export_payments(_read_payments(group, query, args.rev), args.format, out)
+            else:
+                balances = self.get_balances(group, query, jobs=args.jobs, rev=args.rev)
+                if args.what == 'balances':
+                    export_balances(balances, args.format, out)
+                else:
+                    export_transfers(settle(balances), args.format, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    def do_check(self, group, raw_args):
+        from settle.check import check_group
+
+        p = _argument_parser('check')
+        p.add_argument('-i', '--incremental', action='store_true',
+                       help='only check files changed since they last passed')
+        _add_jobs_argument(p)
+        args = p.parse_args(raw_args)
+        _require_directory_storage(p, group)
+
+        errors = check_group(group, args.incremental, jobs=args.jobs)
+        for f, error in errors:
+            print('%s: %s' % (os.path.relpath(f, group.path()), error))
+        if errors:
+            print('%d errors in %d files' % (len(errors), len({f for (f, _) in errors})),
+                  file=sys.stderr)
+            return 1
+
+    def do_migrate_layout(self, group, raw_args):
+        from settle import LAYOUTS
+        from settle.reader import migrate_layout
+
+        p = _argument_parser('migrate layout')
+        p.add_argument('layout', choices=LAYOUTS,
+                       help='flat: all payments in payments/, sharded: dated '
+                       'payments in payments/YYYY/MM/')
+        p.add_argument('-n', '--dry-run', action='store_true',
+                       help='only count the files to be moved')
+        args = p.parse_args(raw_args)
+        _require_directory_storage(p, group)
+
+        moved = migrate_layout(group, args.layout, dry_run=args.dry_run)
+        print('%s %d payment files' % ('Would move' if args.dry_run else 'Moved', moved),
+              file=sys.stderr)
+
+    def do_migrate_storage(self, group, raw_args):
+        from settle import STORAGES
+        from settle.storage import StorageError, migrate_storage
+
+        p = _argument_parser('migrate storage')
+        p.add_argument('storage', choices=STORAGES,
+                       help='directory: one file per payment, sqlite: all '
+                       'payments in payments.sqlite')
+        p.add_argument('-n', '--dry-run', action='store_true',
+                       help='only count the payments to be migrated')
+        args = p.parse_args(raw_args)
+
+        try:
+            migrated = migrate_storage(group, args.storage, dry_run=args.dry_run)
+        except StorageError as e:
+            print('Error: %s' % e, file=sys.stderr)
+            return 1
+        print('%s %d payments' % ('Would migrate' if args.dry_run else 'Migrated', migrated),
+              file=sys.stderr)
+
+    def do_archive(self, group, raw_args):
+        from settle.archive import archive_payments, list_archives, restore_archive
+
+        p = _argument_parser('archive')
+        action = p.add_mutually_exclusive_group(required=True)
+        action.add_argument('--before', type=_date_argument, metavar='DATE',
+                            help='archive all payments dated before DATE')
+        action.add_argument('--restore', metavar='NAME',
+                            help='move the payments of archive NAME back')
+        action.add_argument('--list', action='store_true',
+                            help='list the archives')
+        p.add_argument('-n', '--dry-run', action='store_true',
+                       help='only count the payments to be archived')
+        args = p.parse_args(raw_args)
+        _require_directory_storage(p, group)
+
+        if args.list:
+            for name, d in list_archives(group):
+                print('%s  %s payments from %s to %s' % (name, d['payments'], d['first'],
+                                                         d['last']))
+        elif args.restore is not None:
+            restored = restore_archive(group, args.restore)
+            print('Restored %d payments' % restored, file=sys.stderr)
+        else:
+            name, archived = archive_payments(group, args.before, args.dry_run)
+            if args.dry_run:
+                print('Would archive %d payments' % archived, file=sys.stderr)
+            elif name is None:
+                print('No payments to archive', file=sys.stderr)
+            else:
+                print('Archived %d payments to %s' % (archived, name), file=sys.stderr)
+
+    def do_import(self, group, raw_args):
+        from settle.importer import FORMATS, import_payments, iter_rows
+
+        p = _argument_parser('import payments')
+        p.add_argument('file', help='CSV file with header line or JSON Lines '
+                       'file with the fields of a payment, - for stdin')
+        p.add_argument('--format', choices=FORMATS,
+                       help='file format [from file extension]')
+        p.add_argument('--batch-size', type=int, metavar='N',
+                       help='store payments in batches of N')
+        p.add_argument('-n', '--dry-run', action='store_true',
+                       help='only validate the rows')
+        args = p.parse_args(raw_args)
+
+        format = args.format
+        if format is None:
+            ext = os.path.splitext(args.file)[1].lstrip('.').lower()
+            format = {'json': 'jsonl', 'ndjson': 'jsonl'}.get(ext, ext)
+            if format not in FORMATS:
+                p.error('cannot guess format of %r, use --format' % args.file)
+
+        if args.file == '-':
+            f = sys.stdin
+        else:
+            f = open(args.file, encoding=FILE_CHARSET, newline='')
+
+        with f:
+            imported, errors = import_payments(group, iter_rows(f, format),
+                                               args.batch_size, args.dry_run)
+
+        for lno, error in errors:
+            print('%s:%d: %s' % (args.file, lno, error), file=sys.stderr)
+        print('%s %d payments, %d invalid rows' % (
+              'Validated' if args.dry_run else 'Imported', imported, len(errors)),
+              file=sys.stderr)
+        return 1 if errors else 0
+
     def do_init(self, args):
-        forbidden_groupnames = list(self.funcdict) + ['config', 'groups']
+        from settle.group import Group
+
+        forbidden_groupnames = list(self.funcdict) + ['all', 'config', 'groups', 'serve']
 
         group = None
         if len(args) == 1:
@@ -161,6 +448,19 @@ class Commands:
             f.write('localconfig\n')
 
     def run(self, args):
+        from settle.util import SettingError
+        try:
+            return self._run(args)
+        except Exception as e:
+            # imported only now, to keep startup fast
+            from settle.archive import ArchiveError
+            from settle.gitrev import GitError
+            if not isinstance(e, (SettingError, GitError, ArchiveError)):
+                raise
+            print('Error: %s' % e, file=sys.stderr)
+            return 1
+
+    def _run(self, args):
         args = args[:]
         if len(args) == 0:
             print('Error: No command given\nAvailable commands:', file=sys.stderr)
@@ -173,6 +473,11 @@ class Commands:
             self.do_init(args[1:])
             return
 
+        if args[0] == 'serve':
+            # special case, serves all groups
+            self.serve(args[1:])
+            return
+
         if args[0] in self.funcdict:
             args.insert(0, 'DEFAULTREPO') #TODO
 
@@ -182,17 +487,104 @@ class Commands:
                 print('  %s' % c, file=sys.stderr)
             return
 
-        group = Group.load(args[0])
-        cmd = args[1]
-        rest = args[2:]
+        if args[0] == 'all':
+            # pseudo-group, aggregates all groups
+            return self.run_all(args[1], args[2:])
 
+        status = self.forward(args)
+        if status is not None:
+            return status
+
+        profiling.start()
         try:
-            f = self.funcdict[cmd]
-        except KeyError:
-            print('no such command: %s' % cmd, file=sys.stderr)
+            with profiling.timer('load_group'):
+                group = self.load_group(args[0])
+            cmd = args[1]
+            rest = args[2:]
+
+            try:
+                f = self.funcdict[cmd]
+            except KeyError:
+                print('no such command: %s' % cmd, file=sys.stderr)
+            else:
+                debug('running %s(%s) with %r', cmd, rest, group)
+                return f(group, rest)
+        finally:
+            profiling.report(args)
+
+    def run_all(self, cmd, raw_args):
+        if cmd != 'print-balances':
+            print('Only print-balances is supported for all groups', file=sys.stderr)
+            return 1
+
+        profiling.start()
+        try:
+            return self.print_all_balances(raw_args)
+        finally:
+            profiling.report(['all', cmd] + raw_args)
+
+    def print_all_balances(self, raw_args):
+        from settle.multigroup import get_all_balances
+
+        p = _argument_parser('print balances of all groups')
+        p.add_argument('name', nargs='?')
+        _add_query_arguments(p)
+        _add_jobs_argument(p)
+        _add_format_argument(p)
+        args = p.parse_args(raw_args)
+
+        totals, per_group, errors = get_all_balances(
+            query=_payment_query(args), jobs=args.jobs)
+        for name, error in errors.items():
+            print('Error in group %s: %s' % (name, error), file=sys.stderr)
+
+        if args.format != 'text':
+            from settle.export import export_group_balances
+            export_group_balances(totals, per_group, args.format, sys.stdout, args.name)
         else:
-            debug('running %s(%s) with %r' % (cmd, rest, group))
-            f(group, rest)
+            sections = [('all groups', totals)] + list(per_group.items())
+            for i, (title, balances) in enumerate(sections):
+                print('%s== %s ==' % ('\n' if i else '', title))
+                for currency in balances:
+                    for name, val in balances[currency].items():
+                        if args.name is None or name == args.name:
+                            print('%-12s %s %s' % (name, format_decimal(val), currency))
+        return 1 if errors else 0
+
+    def serve(self, raw_args):
+        from settle.daemon import DEFAULT_POLL_INTERVAL, Daemon
+
+        p = _argument_parser('serve groups over a local socket')
+        p.add_argument('--poll-interval', type=float, metavar='SECONDS',
+                       default=DEFAULT_POLL_INTERVAL,
+                       help='check payments for changes this often [%(default)s]')
+        args = p.parse_args(raw_args)
+        Daemon(args.poll_interval).serve()
+
+    def forward(self, args):
+        """
+        Run the group command `args` in the daemon, if there is one running.
+        Return its exit status or None if the command has to be run here.
+        """
+        from settle.daemon import FORWARDED_COMMANDS, forward
+
+        if self.in_daemon or os.environ.get('SETTLE_DAEMON') == '0':
+            return None
+        if args[1] not in FORWARDED_COMMANDS:
+            return None
+
+        stdin = None
+        if args[1] == 'new':
+            # can't forward interactive input
+            if sys.stdin.isatty():
+                return None
+            stdin = sys.stdin.read()
+        status = forward(args, stdin)
+        if status is None and stdin is not None:
+            # run here with the input already read
+            import io
+            sys.stdin = io.StringIO(stdin)
+        return status
 
     @property
     def funcdict(self):
@@ -207,4 +599,4 @@ class Commands:
 
 
 if __name__ == '__main__':
-    Commands().run(sys.argv[1:])
+    sys.exit(Commands().run(sys.argv[1:]))
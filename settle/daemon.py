@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running server keeping loaded groups and their balances in memory.
+
+`settle serve` listens on a Unix domain socket (~/.settle/.daemon.sock or
+$SETTLE_SOCKET). `Commands.run` forwards the commands in FORWARDED_COMMANDS
+to it when it is running. Every request is one line of JSON
+{"args": [...], "stdin": "..."} and is answered with one line of JSON
+{"status": ..., "stdout": "...", "stderr": "..."}.
+"""
+import io
+import json
+import os
+import socket
+import sys
+import threading
+from settle.commands import Commands
+from settle.util import debug
+
+# The client side (`forward`) only needs the imports above, the server side
+# imports the rest when it is used.
+
+FORWARDED_COMMANDS = ('print-balances', 'print-payments', 'settle-balances', 'new')
+# forwarded commands which are run here if the daemon does not answer
+READ_ONLY_COMMANDS = ('print-balances', 'print-payments', 'settle-balances')
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+def socket_path():
+    return os.environ.get('SETTLE_SOCKET') or os.path.join(
+        os.path.expanduser('~'), '.settle', '.daemon.sock')
+
+
+def forward(args, stdin=None, timeout=None):
+    """
+    Run `args` in the daemon, copying its output to stdout and stderr.
+    Return the exit status, or None if no daemon is running or it did not
+    answer within `timeout` (DAEMON_TIMEOUT) seconds. If `args` changes the
+    group (`new`) and the daemon got it, a timeout is an error instead, as
+    it might still run.
+    """
+    from settle import DAEMON_TIMEOUT
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(DAEMON_TIMEOUT if timeout is None else timeout)
+        sock.connect(socket_path())
+    except OSError:
+        return None
+
+    sent = False
+    try:
+        with sock, sock.makefile('rwb') as f:
+            f.write(json.dumps({'args': args, 'stdin': stdin}).encode() + b'\n')
+            f.flush()
+            sent = True
+            line = f.readline()
+    except socket.timeout:
+        if sent and args[1] not in READ_ONLY_COMMANDS:
+            print('Error: the daemon did not answer in time', file=sys.stderr)
+            return 1
+        debug('daemon: no answer in time, running %s here', args[1])
+        return None
+    except OSError:
+        return None
+
+    if not line:
+        return None
+    response = json.loads(line.decode())
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['status']
+
+
+class _GroupState:
+    def __init__(self, group):
+        self.group = group
+        self.config_signature = _config_signature(group.name)
+        self.payments_mtime = _payments_mtime(group)
+        self.payments_signature = _payments_signature(group)
+        self.balances = None
+
+
+class Daemon:
+    """
+    Keeps loaded groups and the unfiltered balances of every group.
+
+    Groups are reloaded when their config files change. Balances are dropped
+    when a file is added to or removed from the payments directories (checked
+    on every request) or when any payment file changes (checked by polling
+    every `poll_interval` seconds).
+    """
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.stopped = threading.Event()
+
+    def group(self, name):
+        from settle.group import Group
+
+        with self.lock:
+            state = self.groups.get(name)
+            if state is None or state.config_signature != _config_signature(name):
+                debug('daemon: loading group %s', name)
+                state = self.groups[name] = _GroupState(Group.load(name))
+            return state.group
+
+    def balances(self, group, query=None, jobs=None, rev=None):
+        from settle.balance import get_balances
+
+        if query is not None or rev is not None:
+            return get_balances(group, query, jobs=jobs, rev=rev)
+
+        with self.lock:
+            state = self.groups[group.name]
+            mtime = _payments_mtime(group)
+            if state.payments_mtime != mtime:
+                state.payments_mtime = mtime
+                state.balances = None
+            if state.balances is None:
+                debug('daemon: aggregating balances of %s', group.name)
+                state.balances = get_balances(group, jobs=jobs)
+            return state.balances
+
+    def poll(self):
+        while not self.stopped.wait(self.poll_interval):
+            with self.lock:
+                states = list(self.groups.values())
+            for state in states:
+                try:
+                    signature = _payments_signature(state.group)
+                except OSError:
+                    signature = None
+                with self.lock:
+                    if signature != state.payments_signature:
+                        debug('daemon: payments of %s changed', state.group.name)
+                        state.payments_signature = signature
+                        state.balances = None
+
+    def handle(self, request):
+        import traceback
+        from contextlib import redirect_stderr, redirect_stdout
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        stdin = sys.stdin
+        sys.stdin = io.StringIO(request.get('stdin') or '')
+        try:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                status = DaemonCommands(self).run(request['args']) or 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            stderr.write(traceback.format_exc())
+            status = 1
+        finally:
+            sys.stdin = stdin
+        return {'status': status, 'stdout': stdout.getvalue(),
+                'stderr': stderr.getvalue()}
+
+    def serve(self):
+        import signal
+        import socketserver
+
+        path = socket_path()
+        if _is_listening(path):
+            raise RuntimeError('A daemon is already listening on %s' % path)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    return
+                response = daemon.handle(json.loads(line.decode()))
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.UnixStreamServer(path, Handler)
+        finally:
+            os.umask(umask)
+
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, terminate)
+
+        poller = threading.Thread(target=self.poll, daemon=True)
+        poller.start()
+        print('Listening on %s' % path, file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            server.server_close()
+            os.unlink(path)
+
+
+class DaemonCommands(Commands):
+    in_daemon = True
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def load_group(self, name):
+        return self.daemon.group(name)
+
+    def get_balances(self, group, query=None, jobs=None, rev=None):
+        return self.daemon.balances(group, query, jobs, rev)
+
+
+def _is_listening(path):
+    """Check if something is listening on socket `path`"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+    except OSError:
+        return False
+    return True
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _payments_mtime(group):
+    from settle.storage import get_storage
+    return get_storage(group).mtime()
+
+
+def _config_signature(name):
+    from settle.group import Group
+    return tuple(_mtime(Group._path(name, f)) for f in ('config', 'localconfig', 'lists'))
+
+
+def _payments_signature(group):
+    from settle.storage import get_storage
+    return get_storage(group).signature()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+
+FORMATS = ('json', 'ndjson', 'csv')
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+# CSV has no nesting, so payments get one line per balance entry
+_PAYMENT_FIELDS = ('giver', 'receivers', 'amount', 'currency', 'date', 'comment')
+_CSV_PAYMENT_FIELDS = _PAYMENT_FIELDS + ('name', 'value')
+_BALANCE_FIELDS = ('name', 'value', 'currency')
+_GROUP_BALANCE_FIELDS = ('group',) + _BALANCE_FIELDS
+_TRANSFER_FIELDS = ('giver', 'receiver', 'value', 'currency')
+
+
+class BufferedOutput:
+    """Collect written strings and pass them on to `out` in large chunks"""
+    def __init__(self, out, size=EXPORT_BUFFER_SIZE):
+        self.out = out
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def write(self, s):
+        self.parts.append(s)
+        self.length += len(s)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        self.out.write(''.join(self.parts))
+        self.out.flush()
+        self.parts = []
+        self.length = 0
+
+
+def _str(value):
+    # amounts are written as strings to keep the full Decimal precision
+    return None if value is None else str(value)
+
+
+def payment_rows(payments, flat=False):
+    for payment in payments:
+        row = dict(
+            giver=payment.giver,
+            receivers=payment.receivers.to_string(),
+            amount=_str(payment.amount),
+            currency=payment.currency,
+            date=payment.datestr or None,
+            comment=payment.comment or None,
+        )
+        if flat:
+            for name, money in payment.balances:
+                yield dict(row, name=name, value=_str(money.value))
+        else:
+            row['balances'] = [dict(name=name, value=_str(money.value))
+                               for (name, money) in payment.balances]
+            yield row
+
+
+def balance_rows(balances, name=None):
+    for currency in balances:
+        for name_, value in balances[currency].items():
+            if name is None or name_ == name:
+                yield dict(name=name_, value=_str(value), currency=currency)
+
+
+def group_balance_rows(totals, per_group, name=None):
+    """Rows of the combined balances (group None), then of every group"""
+    for row in balance_rows(totals, name):
+        yield dict(row, group=None)
+    for group, balances in per_group.items():
+        for row in balance_rows(balances, name):
+            yield dict(row, group=group)
+
+
+def transfer_rows(transfers):
+    for giver, receiver, money in transfers:
+        yield dict(giver=giver, receiver=receiver, value=_str(money.value),
+                   currency=money.currency)
+
+
+def write_rows(rows, format, out, fields):
+    """
+    Write the dicts `rows` to file object `out` in `format` as they are
+    generated. `fields` are the CSV columns.
+    """
+    buf = BufferedOutput(out)
+    if format == 'ndjson':
+        for row in rows:
+            buf.write(json.dumps(row))
+            buf.write('\n')
+    elif format == 'json':
+        buf.write('[')
+        first = True
+        for row in rows:
+            buf.write('\n' if first else ',\n')
+            buf.write(json.dumps(row))
+            first = False
+        buf.write('\n]\n')
+    elif format == 'csv':
+        writer = csv.DictWriter(buf, fields, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        raise ValueError('Unknown export format: %r' % format)
+    buf.flush()
+
+
+def export_payments(payments, format, out):
+    write_rows(payment_rows(payments, flat=format == 'csv'), format, out,
+               _CSV_PAYMENT_FIELDS)
+
+def export_balances(balances, format, out, name=None):
+    write_rows(balance_rows(balances, name), format, out, _BALANCE_FIELDS)
+
+def export_group_balances(totals, per_group, format, out, name=None):
+    write_rows(group_balance_rows(totals, per_group, name), format, out,
+               _GROUP_BALANCE_FIELDS)
+
+def export_transfers(transfers, format, out):
+    write_rows(transfer_rows(transfers), format, out, _TRANSFER_FIELDS)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Reading the payments of a group from a git revision, see --rev.
+
+The tree of the revision is listed with `git ls-tree` and all files are read
+through a single `git cat-file --batch` process. Parsed records are cached by
+blob hash in the group's `git` cache, separately for every version of `config`
+and `lists` (and the contents of the unversioned `localconfig`), so reading
+many revisions only parses the blobs that differ. Groups with sqlite storage
+can't be read from a revision.
+"""
+import io
+import os
+import subprocess
+from settle import FILE_CHARSET, profiling
+from settle.cache import cache_enabled, cache_path, load_cache_file, save_cache_file
+from settle.reader import PaymentRecord, payment_from_dict, read, read_file, record_from_dict
+from settle.util import debug
+
+GIT_CACHE_VERSION = 2
+# records are kept for this many versions of config and lists
+GIT_CACHE_MAX_CONFIGS = 8
+
+
+class GitError(Exception):
+    pass
+
+
+def git(group, *args, input=None):
+    """Run git in the directory of `group` and return its output"""
+    try:
+        p = subprocess.run(('git', '-C', group.path()) + args, input=input,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise GitError('git is not installed')
+    if p.returncode != 0:
+        raise GitError(p.stderr.decode(errors='replace').strip())
+    return p.stdout
+
+
+def cat_blobs(group, blobs):
+    """Return {hash: contents} of the git blobs `blobs`, read by one process"""
+    if not blobs:
+        return {}
+    out = git(group, 'cat-file', '--batch', input=b''.join(b.encode() + b'\n' for b in blobs))
+    contents = {}
+    pos = 0
+    while pos < len(out):
+        end = out.index(b'\n', pos)
+        header = out[pos:end].split()
+        if header[1] == b'missing':
+            raise GitError('Missing object %s' % header[0].decode())
+        size = int(header[2])
+        contents[header[0].decode()] = out[end + 1:end + 1 + size]
+        pos = end + 1 + size + 1
+    profiling.count('bytes_read', len(out))
+    return contents
+
+
+class Revision:
+    """
+    A git revision of a group: its payment files and the group as configured
+    in that revision. `localconfig` is not versioned and taken from the
+    working tree.
+    """
+    def __init__(self, group, rev):
+        self.rev = rev
+        self.commit = git(group, 'rev-parse', '--verify', '--end-of-options',
+                          rev + '^{commit}').decode().strip()
+
+        self.files = [] # (path, blob hash)
+        self._summary_blobs = []
+        self._summaries = None
+        config_blobs = {}
+        for entry in git(group, 'ls-tree', '-r', '-z', self.commit).split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.decode(FILE_CHARSET).split('\t', 1)
+            mode, kind, blob = info.split()
+            if kind != 'blob':
+                continue
+            if path in ('config', 'lists'):
+                config_blobs[path] = blob
+            elif path.startswith('payments/') and not os.path.basename(path).startswith('.'):
+                self.files.append((path, blob))
+            elif path.startswith('archives/') and path.endswith('.summary'):
+                self._summary_blobs.append((path, blob))
+        debug('%s: %d payment files', self.commit, len(self.files))
+
+        files = cat_blobs(group, list(config_blobs.values()))
+        def parse(name):
+            if name not in config_blobs:
+                return {}
+            return read(io.StringIO(files[config_blobs[name]].decode(FILE_CHARSET)))
+        config = parse('config')
+        localconfig = read_file(group.path('localconfig'), {})
+        config.update(localconfig)
+
+        self.fingerprint = (config_blobs.get('config'), config_blobs.get('lists'),
+                            tuple(sorted(localconfig.items())))
+        self.group = type(group).from_config(group.name, config, parse('lists'))
+        if self.group.storage != 'directory':
+            raise GitError('Payments in %s storage cannot be read from git revisions'
+                           % self.group.storage)
+
+    def __repr__(self):
+        return '<Revision %s of %s>' % (self.commit[:12], self.group.name)
+
+    @property
+    def summaries(self):
+        """(path, fields) of every archive summary"""
+        if self._summaries is None:
+            from settle.archive import verify_summary
+            blobs = dict(self._read([blob for (path, blob) in self._summary_blobs]))
+            self._summaries = [(path, blobs[blob]) for (path, blob) in self._summary_blobs]
+            for path, d in self._summaries:
+                verify_summary(d, '%s:%s' % (self.rev, path))
+        return self._summaries
+
+    def _select(self, query):
+        # files left behind by an interrupted archive, see `settle.archive`
+        archived = {p for (_, d) in self.summaries for p in d['files'].splitlines()}
+        for path, blob in self.files:
+            if path in archived:
+                continue
+            if query is not None and query.match_filename(os.path.basename(path)) is False:
+                profiling.count('files_skipped')
+                continue
+            yield '%s:%s' % (self.rev, path), blob
+
+    def _read(self, blobs):
+        for blob, data in cat_blobs(self.group, blobs).items():
+            yield blob, read(io.StringIO(data.decode(FILE_CHARSET)))
+
+    def records(self, query=None):
+        """
+        Yield a `PaymentRecord` for every payment matching `query`, after
+        those of the archive summaries.
+        """
+        from settle.archive import summary_matches, summary_record
+
+        for path, d in self.summaries:
+            f = '%s:%s' % (self.rev, path)
+            if summary_matches(d, query, f):
+                yield summary_record(d, self.group, f, query)
+
+        filename = cache_path(self.group.name, 'git')
+        cache = {}
+        if cache_enabled():
+            cache = load_cache_file(filename, GIT_CACHE_VERSION, None) or {}
+        # most recently used config last
+        entries = cache.pop(self.fingerprint, {})
+        cache[self.fingerprint] = entries
+
+        files = list(self._select(query))
+        missing = {blob: f for (f, blob) in files if blob not in entries}
+        profiling.count('cache_misses', len(missing))
+        profiling.count('cache_hits', len(files) - len(missing))
+        for blob, d in self._read(list(missing)):
+            record = record_from_dict(d, self.group, missing[blob])
+            entries[blob] = (record.giver, record.datestr, record.balances)
+
+        for f, blob in files:
+            record = PaymentRecord(f, *entries[blob])
+            if query is None or query.match(record.giver, record.date, record.balances):
+                yield record
+
+        if missing and cache_enabled():
+            for fingerprint in list(cache)[:-GIT_CACHE_MAX_CONFIGS]:
+                del cache[fingerprint]
+            save_cache_file(filename, GIT_CACHE_VERSION, None, cache)
+
+    def payments(self, query=None):
+        """Yield every `Payment` matching `query`"""
+        files = list(self._select(query))
+        blobs = dict(self._read(list({blob for (f, blob) in files})))
+        for f, blob in files:
+            payment = payment_from_dict(blobs[blob], self.group, f)
+            if query is None or query.match(payment.giver, payment.date, payment.balances):
+                yield payment
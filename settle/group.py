@@ -1,38 +1,119 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
+import time
+from settle.cache import RACY_MTIME_WINDOW, cache_enabled, cache_path, load_cache_file, save_cache_file, stat_key
 from settle.reader import read_file
 from settle.payment import Receivers
+from settle import profiling
 from settle.util import debug
 
+GROUP_CACHE_VERSION = 6
+
 class Group:
-    def __init__(self, name, default_currency, default_giver, lists=None):
+    def __init__(self, name, default_currency, default_giver, lists=None, engine='decimal',
+                 backend='auto', payments_layout='flat', storage='directory', io='sync'):
         self.name = name
-        self.default_currency = default_currency
+        self.default_currency = sys.intern(default_currency)
         self.default_giver = default_giver
         self.lists = lists or {}
+        self.engine = engine
+        self.backend = backend
+        self.payments_layout = payments_layout
+        self.storage = storage
+        self.io = io
+        self._list_vectors = {}
+        self._receivers = {}
 
     def __repr__(self):
         return 'Group(%r)' % self.name
 
     @classmethod
     def load(cls, name):
-        from settle import DEFAULT_CURRENCY
-        args = {}
-
+        """
+        Load group `name`. The parsed group, including its flattened lists,
+        is cached in the group's `group` cache (see `cache_path`) as long as
+        `config`, `localconfig` and `lists` are unchanged.
+        """
         if not os.path.isdir(Group._path(name)):
             raise NoSuchGroupError(name)
 
+        key = cache_enabled() and cls._files_key(name)
+        if key:
+            g = load_cache_file(cache_path(name, 'group'), GROUP_CACHE_VERSION, key)
+            if g is not None:
+                return g
+
+        g = cls._load(name)
+        if key:
+            save_cache_file(cache_path(name, 'group'), GROUP_CACHE_VERSION, key, g)
+        return g
+
+    @classmethod
+    def _files_key(cls, name):
+        """
+        Size and mtime of all files the group is loaded from, or None if one
+        of them was modified too recently to be sure it is unchanged.
+        """
+        key = []
+        for f in ('config', 'localconfig', 'lists'):
+            try:
+                k = stat_key(os.stat(cls._path(name, f)))
+            except FileNotFoundError:
+                k = None
+            else:
+                if time.time_ns() - k[1] < RACY_MTIME_WINDOW:
+                    return None
+            key.append(k)
+        return tuple(key)
+
+    @classmethod
+    def _load(cls, name):
         config = read_file(cls._path(name, 'config'), {})
         config.update(read_file(cls._path(name, 'localconfig'), {}))
+        lists_ = read_file(cls._path(name, 'lists'), {})
+        return cls.from_config(name, config, lists_)
+
+    @classmethod
+    def from_config(cls, name, config, lists_):
+        """
+        Build group `name` from the parsed `config` (merged with `localconfig`)
+        and `lists` files.
+        """
+        from settle import BACKENDS, DEFAULT_CURRENCY, ENGINES, IO_MODES, LAYOUTS, STORAGES
+        args = {}
         args['default_currency'] = config.get('default_currency', DEFAULT_CURRENCY)
         args['default_giver'] = config.get('default_giver', None)
+        args['engine'] = config.get('engine', 'decimal')
+        if args['engine'] not in ENGINES:
+            raise ValueError('Unknown engine %r, must be one of %s'
+                             % (args['engine'], ', '.join(ENGINES)))
+        args['backend'] = config.get('backend', 'auto')
+        if args['backend'] not in BACKENDS:
+            raise ValueError('Unknown backend %r, must be one of %s'
+                             % (args['backend'], ', '.join(BACKENDS)))
+        args['payments_layout'] = config.get('payments_layout', 'flat')
+        if args['payments_layout'] not in LAYOUTS:
+            raise ValueError('Unknown payments_layout %r, must be one of %s'
+                             % (args['payments_layout'], ', '.join(LAYOUTS)))
+        args['storage'] = config.get('storage', 'directory')
+        if args['storage'] not in STORAGES:
+            raise ValueError('Unknown storage %r, must be one of %s'
+                             % (args['storage'], ', '.join(STORAGES)))
+        args['io'] = config.get('io', 'sync')
+        if args['io'] not in IO_MODES:
+            raise ValueError('Unknown io %r, must be one of %s'
+                             % (args['io'], ', '.join(IO_MODES)))
         g = cls(name, **args)
 
-        lists_ = read_file(cls._path(name, 'lists'), {})
         for name, s in lists_.items():
-            debug('parse receivers: %s' % s)
+            debug('parse receivers: %s', s)
             g.lists[name] = Receivers.from_string(g, s, is_list=True)
 
+        # flatten all lists once, rejecting undefined lists and cycles early
+        for name in g.lists:
+            g.list_vector(name)
+
         return g
 
     @classmethod
@@ -42,6 +123,81 @@ class Group:
         except NoSuchGroupError:
             return None
 
+    @classmethod
+    def find_all(cls):
+        """Return the names of all groups, i.e. of all group directories"""
+        root = cls._path('')
+        try:
+            entries = os.scandir(root)
+        except FileNotFoundError:
+            return []
+        with entries:
+            return sorted(e.name for e in entries
+                          if not e.name.startswith('.') and e.is_dir()
+                          and os.path.isdir(os.path.join(e.path, 'payments')))
+
+    def list_vector(self, name, _stack=()):
+        """
+        Return the members of list `name` with their share of it (summing up
+        to 1) as tuple of (name, share) pairs, with nested lists resolved.
+        """
+        from settle import MAX_LIST_RESOLVER_RECURSION_DEPTH
+
+        try:
+            return self._list_vectors[name]
+        except KeyError:
+            pass
+
+        if name not in self.lists:
+            raise ListResolveError('Undefined list: %%%s' % name)
+        if name in _stack:
+            raise ListResolveError('Cycle in list definitions: %s' % ' -> '.join(
+                '%' + n for n in _stack + (name,)))
+        if len(_stack) >= MAX_LIST_RESOLVER_RECURSION_DEPTH:
+            raise ListResolveError('Lists nested too deeply: %s' % ' -> '.join(
+                '%' + n for n in _stack + (name,)))
+
+        debug('resolve list: %s', name)
+        profiling.count('list_resolutions')
+        vector = self.lists[name].vector(_stack + (name,))
+        self._list_vectors[name] = vector
+        return vector
+
+    def parse_receivers(self, s):
+        """
+        Parse receivers string `s` to a `Receivers` object. The result is
+        shared between all payments with the same receivers string.
+        """
+        try:
+            return self._receivers[s]
+        except KeyError:
+            profiling.count('receivers_parsed')
+            r = self._receivers[s] = Receivers.from_string(self, s)
+            return r
+
+    def set_config(self, key, value):
+        """Set `key` in the group's `config` file, keeping all other lines"""
+        from settle import FILE_CHARSET
+        filename = self.path('config')
+        try:
+            with open(filename, encoding=FILE_CHARSET) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+
+        line = '%s: %s\n' % (key, value)
+        for i, l in enumerate(lines):
+            if l.split(':', 1)[0].strip() == key:
+                lines[i] = line
+                break
+        else:
+            lines.append(line)
+
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp, 'w', encoding=FILE_CHARSET) as f:
+            f.writelines(lines)
+        os.replace(tmp, filename)
+
     def path(self, *subdirs):
         return self.__class__._path(self.name, *subdirs)
 
@@ -55,3 +211,6 @@ class Group:
 
 class NoSuchGroupError(Exception):
     pass
+
+class ListResolveError(ValueError):
+    pass
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+from decimal import Decimal
+from settle import profiling
+from settle.reader import ReaderError, payment_from_dict
+from settle.storage import get_storage
+from settle.util import debug
+
+FORMATS = ('csv', 'jsonl')
+
+
+def iter_rows(f, format):
+    """
+    Yield (line number, fields) for every row of the CSV (with header line)
+    or JSON Lines file object `f`. Empty fields are left out.
+    """
+    if format == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, {k: v for (k, v) in row.items() if k and v}
+    elif format == 'jsonl':
+        for lno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line, parse_float=Decimal)
+            except ValueError as e:
+                yield lno, e
+                continue
+            if not isinstance(row, dict):
+                yield lno, ValueError('Expected a JSON object')
+                continue
+            yield lno, {k: str(v) for (k, v) in row.items() if v is not None and v != ''}
+    else:
+        raise ValueError('Unknown import format: %r' % format)
+
+
+def import_payments(group, rows, batch_size=None, dry_run=False):
+    """
+    Validate the (line number, fields) pairs `rows` like payment files and
+    store the valid ones in batches of `batch_size`, so that only one batch
+    of payments is held in memory.
+
+    Returns the number of imported payments and a list of (line number,
+    error message) pairs for all invalid rows.
+    """
+    from settle import IMPORT_BATCH_SIZE
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+
+    imported = 0
+    errors = []
+    batch = []
+    storage = get_storage(group)
+
+    def flush():
+        nonlocal imported
+        if not dry_run:
+            storage.store(batch)
+        imported += len(batch)
+        debug('imported %d payments', imported)
+        del batch[:]
+
+    for lno, fields in rows:
+        if isinstance(fields, Exception):
+            errors.append((lno, str(fields)))
+            continue
+        try:
+            batch.append(payment_from_dict(fields, group, 'line %d' % lno))
+        except (ReaderError, ValueError, ArithmeticError) as e:
+            errors.append((lno, str(e)))
+            continue
+        profiling.count('rows_imported')
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    return imported, errors
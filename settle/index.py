@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from settle import profiling
+from settle.cache import (RACY_MTIME_WINDOW, cache_enabled, cache_path, group_fingerprint,
+                          load_cache_file, save_cache_file, stat_key)
+from settle.reader import find_payment_files, read_payment
+from settle.util import debug
+
+INDEX_VERSION = 1
+
+
+class PersonIndex:
+    """
+    Index of the payment files affecting every person of a group, kept in the
+    group's `index` cache. Persons are those with a balance in the payment,
+    i.e. with lists resolved.
+
+    Like the payment cache, entries are validated against the size and mtime
+    of the files and the index is rebuilt when `config`, `localconfig` or
+    `lists` change.
+    """
+    def __init__(self, group):
+        self.group = group
+        self.filename = cache_path(group.name, 'index')
+        self.fingerprint = group_fingerprint(group)
+        self.files = {}   # path: (stat key, persons)
+        self.persons = {} # person: set of paths
+        self.loaded = False
+        self.changed = False
+        data = cache_enabled() and load_cache_file(self.filename, INDEX_VERSION, self.fingerprint)
+        if data:
+            self.files, self.persons = data
+            self.loaded = True
+
+    def __repr__(self):
+        return '<PersonIndex group=%s, %d files, %d persons>' % (
+            self.group.name, len(self.files), len(self.persons))
+
+    def add(self, f, payment, key=None):
+        """
+        Index payment file `f`. Like in the payment cache, a file modified
+        within RACY_MTIME_WINDOW might still change without changing its
+        size and mtime, so it is indexed without them and read again by the
+        next `reconcile`.
+        """
+        self.remove(f)
+        persons = frozenset(name for (name, money) in payment.balances)
+        key = key or stat_key(os.stat(f))
+        if time.time_ns() - key[1] < RACY_MTIME_WINDOW:
+            key = None
+        self.files[f] = (key, persons)
+        for name in persons:
+            self.persons.setdefault(name, set()).add(f)
+        self.changed = True
+
+    def remove(self, f):
+        entry = self.files.pop(f, None)
+        if entry is not None:
+            for name in entry[1]:
+                self.persons[name].discard(f)
+                if not self.persons[name]:
+                    del self.persons[name]
+            self.changed = True
+
+    def reconcile(self):
+        """Re-index all payment files added, changed or removed on disk"""
+        now = time.time_ns()
+        seen = set()
+        stale = []
+        for f in find_payment_files(self.group):
+            seen.add(f)
+            key = stat_key(os.stat(f))
+            entry = self.files.get(f)
+            if entry is None or entry[0] != key or now - key[1] < RACY_MTIME_WINDOW:
+                stale.append((f, key))
+        for f in set(self.files) - seen:
+            self.remove(f)
+
+        debug('index: %d of %d files to be read', len(stale), len(seen))
+        profiling.count('index_misses', len(stale))
+        for f, key in stale:
+            self.add(f, read_payment(f, self.group), key)
+
+    def files_of(self, name):
+        return sorted(self.persons.get(name, ()))
+
+    def save(self):
+        if cache_enabled() and self.changed and save_cache_file(
+                self.filename, INDEX_VERSION, self.fingerprint, (self.files, self.persons)):
+            self.changed = False
+
+
+def add_to_index(group, new):
+    """
+    Add the new payment files `new` ((path, payment) pairs) to the person
+    index of `group`, if there is one. Otherwise it is built when needed.
+    As this rewrites the whole index, it is done once per batch of payments
+    by `store_payments`; single payments are picked up by `reconcile`.
+    """
+    index = PersonIndex(group)
+    if index.loaded:
+        for f, payment in new:
+            index.add(f, payment)
+        index.save()
+
+
+def statement(group, name):
+    """
+    Yield (payment, share, balance) for every payment affecting `name`, in
+    order of date (undated payments first). `share` is the change of the
+    balance of `name` through the payment, `balance` the balance in the
+    payment's currency afterwards. Balances start from the totals of the
+    archives, see `settle.archive`.
+    """
+    from settle.archive import read_summaries
+
+    index = PersonIndex(group)
+    index.reconcile()
+    index.save()
+
+    payments = [read_payment(f, group) for f in index.files_of(name)]
+    payments.sort(key=lambda p: (p.date is not None, p.date or 0))
+    balances = {}
+    for record in read_summaries(group):
+        for n, money in record.balances:
+            if n == name:
+                balances[money.currency] = balances.get(money.currency, 0) + money.value
+    for payment in payments:
+        share = sum(money.value for (n, money) in payment.balances if n == name)
+        balances[payment.currency] = balances.get(payment.currency, 0) + share
+        yield payment, share, balances[payment.currency]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Balances of all groups at once, used by the `all` pseudo-group.
+"""
+import os
+from collections import defaultdict
+from decimal import Decimal
+from functools import partial
+from settle.util import debug, jobs_count
+
+
+def get_all_balances(names=None, query=None, jobs=None):
+    """
+    Load and aggregate the groups `names` (default: all groups) on a pool of
+    `jobs` worker processes. If neither `jobs` nor $SETTLE_JOBS is given, one
+    process per CPU is used, but not more than there are groups.
+
+    Return (totals, per_group, errors): the combined balances of all groups
+    (like `get_balances`), {group name: balances} and {group name: error
+    message} for the groups that could not be loaded or aggregated. A broken
+    group does not affect the others.
+    """
+    from settle.group import Group
+
+    if names is None:
+        names = Group.find_all()
+    if jobs is None and 'SETTLE_JOBS' not in os.environ:
+        jobs = max(min(os.cpu_count() or 1, len(names)), 1)
+    jobs = jobs_count(jobs)
+    if jobs <= 1 or len(names) <= 1:
+        # a single group may still use all processes for its payment files
+        results = map(partial(_group_balances, query=query, jobs=jobs), names)
+        return _merge(results)
+
+    jobs = min(jobs, len(names))
+    debug('aggregating %d groups with %d processes', len(names), jobs)
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as executor:
+        return _merge(executor.map(partial(_group_balances, query=query, jobs=1), names))
+
+
+def _group_balances(name, query, jobs):
+    from settle.balance import get_balances
+    from settle.group import Group
+
+    try:
+        balances = get_balances(Group.load(name), query, jobs=jobs)
+    except Exception as e:
+        debug('group %s failed: %r', name, e)
+        return name, None, '%s: %s' % (type(e).__name__, e)
+    return name, {k: dict(v) for (k, v) in balances.items()}, None
+
+
+def _merge(results):
+    totals = defaultdict(lambda: defaultdict(Decimal))
+    per_group = {}
+    errors = {}
+    for name, balances, error in results:
+        if error is not None:
+            errors[name] = error
+            continue
+        per_group[name] = balances
+        for currency, values in balances.items():
+            for user, value in values.items():
+                totals[currency][user] += value
+    return totals, per_group, errors
@@ -1,8 +1,10 @@
 import re
-from collections import defaultdict
+import sys
+from array import array
 from decimal import Decimal
+from fractions import Fraction
 from settle import IDENTIFIER_RE, IDENTIFIER_SPLIT_RE
-from settle.util import debug, is_list, Money, shorten, format_datetime
+from settle.util import is_list, largest_remainder, MinorMoney, Money, shorten, format_datetime, to_minor
 
 _receiver_re = re.compile(r'^(%?' + IDENTIFIER_RE + r')(?:([%=*])([0-9.]+))?$')
 _receivers_split_re = re.compile(IDENTIFIER_SPLIT_RE)
@@ -11,48 +13,23 @@ _receivers_split_re = re.compile(IDENTIFIER_SPLIT_RE)
 class Payment:
     def __init__(self, group, giver, receivers, amount=None, currency=None, date=None, comment=None):
         self.group = group
-        self.giver = giver
+        self.giver = sys.intern(giver)
         if isinstance(receivers, str):
-            self.receivers = Receivers.from_string(group, receivers)
+            self.receivers = group.parse_receivers(receivers)
         else:
             assert receivers.group == self.group
             self.receivers = receivers
-        self.amount = amount if amount is None else Decimal(amount)
         self.given_currency = currency
-        self.currency = currency or group.default_currency
+        self.currency = sys.intern(currency or group.default_currency)
         self.date = date
         self.comment = comment
-        self._calculate_balances()
+        self.balances, self.amount = calculate_balances(
+            group, self.giver, self.receivers, amount, self.currency)
 
     def __repr__(self):
         return 'Payment(group=%r, giver=%r, receivers=%r, amount=%r, currency=%r, date=%r, comment=%r)' % (
             self.group, self.giver, self.receivers, self.amount, self.currency, self.date, shorten(self.comment, 50))
 
-    def _calculate_balances(self):
-        from settle import MAX_LIST_RESOLVER_RECURSION_DEPTH
-
-        self.balances = []
-        raw_balances, self.amount = self.receivers.apply(self.amount, self.currency)
-
-        i = MAX_LIST_RESOLVER_RECURSION_DEPTH
-        while raw_balances:
-            new_raw_balances = []
-
-            debug('raw: %r' % raw_balances)
-            for name, val in raw_balances:
-                if is_list(name):
-                    bal, _amount = self.group.lists[name[1:]].apply(-val)
-                    new_raw_balances.extend(bal)
-                else:
-                    self.balances.append((name, val))
-            raw_balances = new_raw_balances
-            i -= 1
-
-            if i <= 0:
-                raise RuntimeError('Maximum list resolver recursion depth reached. Maybe there is a loop?')
-
-        self.balances.append((self.giver, Money(+self.amount, self.currency)))
-
     @property
     def datestr(self):
         return format_datetime(self.date)
@@ -68,11 +45,34 @@ class Payment:
         )
 
 
+def calculate_balances(group, giver, receivers, amount, currency):
+    """
+    Return the balances of a payment as list of (name, Money) pairs, with all
+    lists resolved, and its (possibly calculated) amount. `receivers` is a
+    `Receivers` object or string, `currency` must be given.
+    """
+    if isinstance(receivers, str):
+        receivers = group.parse_receivers(receivers)
+    try:
+        amount = amount if amount is None else Decimal(amount)
+    except ArithmeticError:
+        raise ValueError('Invalid amount: %r' % amount)
+
+    balances, amount = receivers.apply(amount, currency)
+    if group.engine == 'minor':
+        balances.append((giver, MinorMoney.from_decimal(amount, currency)))
+    else:
+        balances.append((giver, Money(+amount, currency)))
+    return balances, amount
+
+
 class Receivers:
     def __init__(self, group, raw_receivers, modifier):
         self.group = group
         self.raw_receivers = tuple(raw_receivers)
         self.modifier = modifier
+        self._vector = None
+        self._names = None
 
     def __repr__(self):
         return '<Receivers group=%s, %d receivers>' % (
@@ -102,12 +102,12 @@ class Receivers:
             else:
                 value = Decimal(value_)
 
-            if modifier is ():
+            if modifier == ():
                 modifier = mod_
             elif modifier != mod_:
                 raise ValueError('Different receiver modifiers found')
 
-            raw_receivers.append((name, value))
+            raw_receivers.append((sys.intern(name), value))
 
         if modifier == ():
             raise ValueError('No receivers given')
@@ -117,16 +117,48 @@ class Receivers:
 
         return cls(group, raw_receivers, modifier)
 
+    def vector(self, _stack=()):
+        """
+        Return a tuple of (name, factor) pairs with all lists resolved.
+
+        The factor is an exact `Fraction`: the share of the total amount for
+        the `*` and `%` modifiers and the absolute amount for the `=`
+        modifier. Persons occurring multiple times (e.g. through different
+        lists) are merged. The result is computed once and then kept.
+        """
+        if self._vector is not None:
+            return self._vector
+
+        if self.modifier == '*':
+            sumfactors = sum(v for (n, v) in self.raw_receivers)
+            factors = [(name, Fraction(value) / Fraction(sumfactors))
+                       for (name, value) in self.raw_receivers]
+        elif self.modifier in ('%', '='):
+            if self.modifier == '%' and sum(v for (n, v) in self.raw_receivers) != 1:
+                raise ValueError('Shares do not sum up to 1 (or 100%)')
+            factors = [(name, Fraction(value)) for (name, value) in self.raw_receivers]
+        else:
+            raise RuntimeError('Invalid modifier. This should not have happened')
+
+        weights = {}
+        for name, factor in factors:
+            if is_list(name):
+                for member, share in self.group.list_vector(name[1:], _stack):
+                    weights[member] = weights.get(member, 0) + factor * share
+            else:
+                weights[name] = weights.get(name, 0) + factor
+
+        self._vector = tuple(weights.items())
+        return self._vector
+
     def apply(self, amount, currency=None):
         """
-        Calculate balances for every receiver.
+        Calculate balances for every receiver, with all lists resolved.
 
         amount may be None if absolute amounts are given for every receiver.
         currency may be omitted when amount is of type `Money`.
+        Returns the list of balances and the (possibly calculated) amount.
         """
-
-        balances = []
-
         if currency is None:
             if isinstance(amount, Money):
                 currency = amount.currency
@@ -137,21 +169,11 @@ class Receivers:
         if self.modifier in ('*', '%') and amount is None:
             raise ValueError('Required field amount missing')
 
-        # balanced (default. possibly with weight factors)
-        if self.modifier == '*':
-            sumfactors = sum(v for (n, v) in self.raw_receivers)
-
-            for (name, value) in self.raw_receivers:
-                val = amount * value / sumfactors
-                balances.append((name, Money(-val, currency)))
+        vector = self.vector()
 
         # fixed per-receiver amounts given
-        elif self.modifier == '=':
-            sumamounts = 0
-
-            for (name, value) in raw_receivers:
-                balances.append((name, Money(-value, currency)))
-                sumamounts += value
+        if self.modifier == '=':
+            sumamounts = sum(v for (n, v) in self.raw_receivers)
 
             if amount is None:
                 # no total amount given, calculate it
@@ -161,20 +183,38 @@ class Receivers:
                 if amount != sumamounts:
                     raise ValueError('Sum of amounts does not match the supplied payment amount')
 
-        # manually defined shares
-        elif modifier == '%':
-            sumshares = sum(value for (_, _, value) in raw_receivers)
-
-            if sumshares != 1:
-                raise ValueError('Shares do not sum up to 1 (or 100%)')
-
-            for (name, share) in raw_receivers:
-                balances.append((name, Money(-amount * share, currency)))
-
-        else:
-            raise RuntimeError('Invalid modifier. This should not have happened')
-
-        return (balances, amount)
+            if self.group.engine == 'minor':
+                # the factors are absolute amounts, each must fit the minor unit
+                for (name, value) in self.raw_receivers:
+                    to_minor(value, currency)
+                return self._apply_minor(currency, to_minor(1, currency)), amount
+            return ([(name, Money(-Decimal(f.numerator) / f.denominator, currency))
+                     for (name, f) in vector], amount)
+
+        # balanced (possibly with weight factors) or manually defined shares
+        if self.group.engine == 'minor':
+            return self._apply_minor(currency, to_minor(amount, currency)), amount
+        return ([(name, Money(-amount * f.numerator / f.denominator, currency))
+                 for (name, f) in vector], amount)
+
+    def _apply_minor(self, currency, total):
+        """
+        Balances of the `minor` engine: the factors of the vector times `total`
+        minor units, rounded with largest remainders so they sum up exactly.
+        """
+        vector = self.vector()
+        if self._names is None:
+            self._names = tuple(name for (name, f) in vector)
+        shares = largest_remainder([-total * f for (name, f) in vector])
+        balances = VectorBalances((name, MinorMoney(share, currency))
+                                  for ((name, f), share) in zip(vector, shares))
+        try:
+            balances.minors = array('q', shares).tobytes()
+            balances.names = self._names
+        except OverflowError:
+            # too large for int64, summed up one by one
+            balances.names = None
+        return balances
 
     def to_string(self):
         res = []
@@ -188,3 +228,15 @@ class Receivers:
             for name, val in self.raw_receivers:
                 res.append('%s%s%s' % (name, self.modifier, val))
         return ' '.join(res)
+
+
+class VectorBalances(list):
+    """
+    Balances of a payment of the `minor` engine, (name, MinorMoney) pairs as
+    usual. The receivers come first, in the order of `names`, a tuple shared
+    by all payments with the same receivers (and kept shared when pickled
+    together), with their minor units packed as int64 in `minors`. `names` is
+    None if they don't fit. The giver comes last and gets the negated sum.
+    `settle.vectorized` sums up the payments of every vector as a matrix.
+    """
+    __slots__ = ('names', 'minors')
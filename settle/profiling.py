@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and phase timers for the hot paths, enabled by $SETTLE_PROFILE.
+
+If $SETTLE_PROFILE is `1` or `stderr`, a report is printed to stderr when
+the command finishes, otherwise it is written as JSON to the file named by
+it. When profiling is disabled, `count` and `timer` do (almost) nothing.
+"""
+import os
+import sys
+import time
+from collections import defaultdict
+
+_target = os.environ.get('SETTLE_PROFILE') or None
+enabled = _target is not None
+
+counters = defaultdict(int)
+timers = defaultdict(float)
+_started = None
+
+
+def count(name, n=1):
+    if enabled:
+        counters[name] += n
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        timers[self.name] += time.perf_counter() - self.start
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_timer = _NullTimer()
+
+
+def timer(name):
+    """Context manager adding the time spent in it to timer `name`"""
+    return _Timer(name) if enabled else _null_timer
+
+
+def start():
+    global _started
+    if enabled and _started is None:
+        import tracemalloc
+        tracemalloc.start()
+        _started = time.perf_counter()
+
+
+def report(command=None):
+    """Print or write the collected numbers, see module docstring"""
+    global _started
+    if not enabled or _started is None:
+        return
+
+    import json
+    import tracemalloc
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    data = dict(
+        command=command,
+        total_time=time.perf_counter() - _started,
+        timers=dict(timers),
+        counters=dict(counters),
+        peak_memory=peak,
+    )
+    _started = None
+
+    if _target in ('1', 'stderr'):
+        print('profile of %s:' % (' '.join(command) if command else '-'), file=sys.stderr)
+        print('  %-24s %10.4fs' % ('total', data['total_time']), file=sys.stderr)
+        for name, t in sorted(timers.items()):
+            print('  %-24s %10.4fs' % (name, t), file=sys.stderr)
+        for name, n in sorted(counters.items()):
+            print('  %-24s %10d' % (name, n), file=sys.stderr)
+        print('  %-24s %10.1fKiB' % ('peak memory', peak / 1024), file=sys.stderr)
+    else:
+        with open(_target, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
@@ -1,21 +1,39 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
+import io
 import os
 import re
 import sys
 from collections import namedtuple
-from dateutil.parser import parse as parse_date
-from settle import FILE_CHARSET
-from settle.payment import Payment
-from settle.util import lowercase_keys, debug, generate_random_filename, format_datetime, sort_payment_keys
+from datetime import date, datetime, timedelta
+from functools import lru_cache, partial
+from settle import FILE_CHARSET, IDENTIFIER_RE, profiling
+from settle.cache import PaymentCache, cache_enabled, stat_key
+from settle.payment import Payment, calculate_balances
+from settle.util import lowercase_keys, debug, generate_random_filename, format_datetime, sort_payment_keys, jobs_count, parse_date
 
 _confline_re = re.compile(r'^(?P<k>[^\s:]+)\s*:\s*(?P<v>.*)$')
 _key_re = re.compile(r'^[^\s:]+$')
+# <date>_<giver>_<random> as generated by `store_payment`, date is optional
+_payment_filename_re = re.compile(r'^(?:([0-9]{4}-[0-9]{2}-[0-9]{2})_)?(%s)_[a-z0-9]{8}$' % IDENTIFIER_RE)
+# shard directories of the `sharded` layout: payments/YYYY/MM/
+_shard_res = (re.compile(r'^[0-9]{4}$'), re.compile(r'^[0-9]{2}$'))
+# dates as written by `format_datetime`
+_date_re = re.compile(r'^([0-9]{4})-([0-9]{2})-([0-9]{2})(?: ([0-9]{2}):([0-9]{2})(?::([0-9]{2}))?)?$')
 KVPair = namedtuple('KVPair', ['k', 'v'])
 
 
 def read_payment(f, group):
-    d = read_file(f)
+    with profiling.timer('read_file'):
+        d = read_file(f)
+    return payment_from_dict(d, group, f)
+
+
+def payment_from_dict(d, group, f=None):
+    """
+    Build a `Payment` from the fields `d` read from file `f` (or any other
+    source, `f` is only used in error messages).
+    """
     d = lowercase_keys(d)
     args = {}
 
@@ -28,7 +46,7 @@ def read_payment(f, group):
                 raise ReaderValueError('Duplicate field %s' % k)
             args[k] = v
         elif k == 'date':
-            args[k] = parse_date(v)
+            args[k] = parse_payment_date(v)
         else:
             raise ReaderValueError('Unkown field name: %r' % k)
 
@@ -37,24 +55,393 @@ def read_payment(f, group):
             raise ReaderValueError('Required field %s missing (file %r)' % (field, f))
     # don't check amount here because it is optional with per-recipient amounts
 
-    return Payment(group, **args)
+    with profiling.timer('payment_build'):
+        return Payment(group, **args)
+
+
+def read_record(f, group):
+    with profiling.timer('read_file'):
+        d = read_file(f)
+    return record_from_dict(d, group, f)
+
+
+_payment_fields = frozenset(('giver', 'receivers', 'amount', 'currency', 'comment', 'date'))
+
+def record_from_dict(d, group, f=None):
+    """
+    Build a `PaymentRecord` from the fields `d` read from file `f`, doing
+    only what is needed for balances: no `Payment` is built, the date is
+    kept as string and the comment is ignored. Raises the same errors as
+    `payment_from_dict`, except for invalid dates.
+    """
+    d = lowercase_keys(d)
+    if d == {}:
+        raise ReaderValueError('File is empty: %r' % f)
+    for k in d:
+        if k not in _payment_fields:
+            raise ReaderValueError('Unkown field name: %r' % k)
+    for field in 'giver', 'receivers':
+        if field not in d:
+            raise ReaderValueError('Required field %s missing (file %r)' % (field, f))
+
+    giver = sys.intern(d['giver'])
+    currency = sys.intern(d.get('currency') or group.default_currency)
+    with profiling.timer('payment_build'):
+        balances, _ = calculate_balances(group, giver, d['receivers'], d.get('amount'), currency)
+    return PaymentRecord(f, giver, d.get('date'), balances)
+
 
+def read_all_payments(group, query=None):
+    """
+    Yield every `Payment` of `group` matching `query`. Files are read ahead
+    concurrently if the group uses the `async` I/O mode, see `settle.aio`.
+    """
+    if io_mode(group) == 'async':
+        from settle.aio import read_payments_async
+        payments = read_payments_async(group, query)
+    else:
+        payments = (read_payment(f, group) for f in find_payment_files(group, query))
+    for payment in payments:
+        if query is None or query.match(payment.giver, payment.date, payment.balances):
+            yield payment
 
-def read_all_payments(group):
-    for f in find_payment_files(group):
-        debug('payment found: %s' % f)
-        yield read_payment(f, group)
 
+def io_mode(group):
+    """
+    $SETTLE_IO or the group's `io` setting. `async` is implemented in
+    `settle.aio`, which is only imported then, as asyncio is slow to import.
+    """
+    from settle import IO_MODES
+    from settle.util import SettingError
+
+    mode = os.environ.get('SETTLE_IO')
+    if not mode:
+        return group.io
+    if mode not in IO_MODES:
+        raise SettingError('$SETTLE_IO must be one of %s, not %r' % (', '.join(IO_MODES), mode))
+    return mode
+
+
+def read_all_records(group, query=None, jobs=None, archived=True):
+    """
+    Yield a `PaymentRecord` for every payment of `group` matching `query`.
+    If `archived`, the summary of every archive (see `settle.archive`) comes
+    first, each as a single record. A query matching only some of the
+    archived payments raises `ArchiveError`.
+
+    Files which did not change since they were last read are served from the
+    group's payment cache instead of being parsed again. Files are read with
+    `read_record`, which skips everything not needed for balances. With
+    `jobs` > 1 (default: $SETTLE_JOBS), the files that do need parsing are
+    spread over a pool of that many processes. In the `async` I/O mode, files
+    are instead parsed as they are read, see `settle.aio`.
+    """
+    if archived:
+        from settle.archive import read_summaries
+        yield from read_summaries(group, query)
+
+    cache = PaymentCache(group) if cache_enabled() else None
+    if io_mode(group) == 'async':
+        from settle.aio import read_records_async
+        records = read_records_async(group, query, cache)
+    else:
+        files = find_payment_files(group, query)
+        if cache is None:
+            files = [(f, None) for f in files]
+        else:
+            files = [(f, stat_key(os.stat(f))) for f in files]
+        records = read_records(group, files, cache, jobs)
+    files = set()
+    for f, record in records:
+        files.add(f)
+        if query is None or query.match(record.giver, record.date, record.balances):
+            yield record
+
+    if cache is not None:
+        if query is None:
+            # files skipped by the query have not been seen
+            cache.prune(files)
+        cache.save()
+
+
+def read_records(group, files, cache=None, jobs=None):
+    """
+    Yield (file, `PaymentRecord`) for the payment files `files`, given as
+    (path, stat key) pairs. Files whose key matches their entry in `cache`
+    (a `PaymentCache`) are not read again, the others are parsed in `jobs`
+    processes (see `read_all_records`) and added to it.
+    """
+    entries = [(f, key, None if cache is None else cache.get(f, key))
+               for (f, key) in files]
+    missing = [f for (f, _, record) in entries if record is None]
+    profiling.count('cache_misses', len(missing))
+    profiling.count('cache_hits', len(entries) - len(missing))
+    parsed = _read_records(group, missing, jobs_count(jobs))
+    for f, key, record in entries:
+        if record is None:
+            record = next(parsed)
+            if cache is not None:
+                cache.set(f, key, record)
+        yield f, record
+
+
+def _read_records(group, files, jobs):
+    from settle import PARALLEL_CHUNK_SIZE
+
+    if jobs <= 1 or len(files) <= PARALLEL_CHUNK_SIZE:
+        for f in files:
+            debug('parsing payment: %s', f)
+            yield read_record(f, group)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunks = [files[i:i + PARALLEL_CHUNK_SIZE]
+              for i in range(0, len(files), PARALLEL_CHUNK_SIZE)]
+    debug('parsing %d payments in %d chunks with %d processes',
+          len(files), len(chunks), jobs)
+    with ProcessPoolExecutor(jobs) as executor:
+        for records in executor.map(partial(_read_records_chunk, group), chunks):
+            yield from records
+
+
+def _read_records_chunk(group, files):
+    return [read_record(f, group) for f in files]
+
+
+class PaymentRecord(namedtuple('PaymentRecord', ['file', 'giver', 'datestr', 'balances'])):
+    """
+    The parts of a payment needed to aggregate and filter balances. The date
+    is kept as written in the file and only parsed when `date` is used.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_payment(cls, f, payment):
+        return cls(f, payment.giver, payment.datestr or None, payment.balances)
+
+    @property
+    def date(self):
+        return None if self.datestr is None else parse_payment_date(self.datestr)
+
+
+@lru_cache(maxsize=4096)
+def parse_payment_date(s):
+    """
+    Parse the date of a payment. Dates as written by `format_datetime` are
+    parsed directly, anything else with dateutil. As many payments share
+    their date, every string is only parsed once.
+    """
+    with profiling.timer('date_parse'):
+        m = _date_re.match(s)
+        if m is not None:
+            try:
+                return datetime(*(int(g) for g in m.groups() if g is not None))
+            except ValueError:
+                pass
+        return parse_date(s)
+
+
+class PaymentQuery:
+    """
+    Select payments by giver, receiver and by date range (`since` and
+    `until` are inclusive `date`s). Payments without date never match a date
+    range. `receiver` matches payments where that person is one of the
+    receivers, with lists resolved.
+    """
+    def __init__(self, since=None, until=None, giver=None, receiver=None):
+        self.since = since
+        self.until = until
+        self.giver = giver
+        self.receiver = receiver
+
+    def __repr__(self):
+        return 'PaymentQuery(since=%r, until=%r, giver=%r, receiver=%r)' % (
+            self.since, self.until, self.giver, self.receiver)
+
+    @property
+    def has_dates(self):
+        return self.since is not None or self.until is not None
+
+    def _match_date(self, date):
+        if date is None:
+            return False
+        return ((self.since is None or date >= self.since) and
+                (self.until is None or date <= self.until))
+
+    def match(self, giver, date, balances=()):
+        """
+        Check the giver, `datetime` (or None) and balances of a payment. The
+        giver's balance comes last, as in `Payment.balances`.
+        """
+        if self.giver is not None and giver != self.giver:
+            return False
+        if self.receiver is not None and (giver is None or not any(
+                name == self.receiver for (name, money) in balances[:-1])):
+            return False
+        if self.has_dates:
+            return self._match_date(None if date is None else date.date())
+        return True
+
+    def match_filename(self, name):
+        """
+        Check a payment file name as generated by `store_payment`.
+
+        Returns True or False if the name decides the match, and None if
+        the file has to be read (custom name, or no date in the name). Names
+        without date are not trusted, as custom names like `dinner_friday12`
+        look just like <giver>_<random>.
+        """
+        m = _payment_filename_re.match(name)
+        if m is None or m.group(1) is None:
+            return None
+        date, giver = m.groups()
+        if self.giver is not None and giver != self.giver:
+            return False
+        if not self.has_dates:
+            return True if self.receiver is None else None
+        return self._match_date(datetime.strptime(date, '%Y-%m-%d').date())
+
+    def match_shard(self, year, month=None):
+        """
+        Check if the shard directory payments/`year`[/`month`] can contain
+        matching payments.
+        """
+        if not self.has_dates:
+            return True
+        try:
+            if month is None:
+                first, last = date(year, 1, 1), date(year, 12, 31)
+            else:
+                first = date(year, month, 1)
+                last = (first + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+        except ValueError:
+            return True
+        return ((self.since is None or last >= self.since) and
+                (self.until is None or first <= self.until))
+
+
+def find_payment_files(group, query=None):
+    """
+    Yield the paths of all payment files of `group`, in payments/ and in its
+    shards payments/YYYY/MM/. If `query` is given, skip files and whole
+    shards whose names show that they do not match it. Files already counted
+    by an archive summary are skipped, see `settle.archive`.
+    """
+    from settle.archive import archived_files
 
-def find_payment_files(group):
     dir = group.path('payments')
-    debug('searching for payments in %s' % dir)
-    for f_ in os.listdir(dir):
-        f = os.path.join(dir, f_)
-        if f_[0] != '.' and os.path.isfile(f):
+    debug('searching for payments in %s', dir)
+    with profiling.timer('scan'):
+        files = list(_scan_payments(dir, query))
+        archived = archived_files(group)
+    for f in files:
+        if f in archived:
+            debug('skip archived %s', f)
+        else:
             yield f
+
+
+def _scan_payments(dir, query, shard=()):
+    # os.scandir knows the file type from the directory entry, no stat needed
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name[0] == '.':
+                debug('skip %s', entry.path)
+            elif entry.is_file():
+                profiling.count('files_scanned')
+                if query is not None and query.match_filename(name) is False:
+                    profiling.count('files_skipped')
+                    continue
+                yield entry.path
+            elif (len(shard) < len(_shard_res) and _shard_res[len(shard)].match(name)
+                  and entry.is_dir()):
+                shard_ = shard + (int(name),)
+                if query is not None and query.match_shard(*shard_) is False:
+                    debug('skip shard %s', entry.path)
+                    profiling.count('shards_skipped')
+                    continue
+                yield from _scan_payments(entry.path, query, shard_)
+            else:
+                debug('skip %s', entry.path)
+
+
+def payment_filename_date(name):
+    """The date in a payment file name as generated by `store_payment`, or None"""
+    m = _payment_filename_re.match(name)
+    if m is None or m.group(1) is None:
+        return None
+    return datetime.strptime(m.group(1), '%Y-%m-%d').date()
+
+
+def payment_dirs(group):
+    """Yield payments/ and all its shard directories"""
+    def scan(dir, depth):
+        yield dir
+        if depth == len(_shard_res):
+            return
+        with os.scandir(dir) as entries:
+            subdirs = [e.path for e in entries
+                       if _shard_res[depth].match(e.name) and e.is_dir()]
+        for d in subdirs:
+            yield from scan(d, depth + 1)
+    return scan(group.path('payments'), 0)
+
+
+def prune_payment_dirs(group):
+    """Remove all empty shard directories, deepest first"""
+    for d in reversed(list(payment_dirs(group))[1:]):
+        try:
+            os.rmdir(d)
+        except OSError:
+            pass
+
+
+def payment_file_names(group):
+    """The names of all payment files of `group`, regardless of their shard"""
+    return {os.path.basename(f) for f in find_payment_files(group)}
+
+
+def payment_dir(group, date, layout=None):
+    """The directory new payments dated `date` are stored in"""
+    if (layout or group.payments_layout) == 'sharded' and date is not None:
+        return group.path('payments', '%04d' % date.year, '%02d' % date.month)
+    return group.path('payments')
+
+
+def migrate_layout(group, layout, dry_run=False):
+    """
+    Move all payment files of `group` to where `layout` stores them and set
+    `payments_layout` in the group config. Files with custom names are read
+    to find out their date. Return the number of files moved.
+    """
+    moved = 0
+    for f in list(find_payment_files(group)):
+        name = os.path.basename(f)
+        m = _payment_filename_re.match(name)
+        if m is None:
+            d = read_payment(f, group).date
+        elif m.group(1) is None:
+            d = None
         else:
-            debug('skip %s' % f)
+            d = datetime.strptime(m.group(1), '%Y-%m-%d')
+        target = os.path.join(payment_dir(group, d, layout), name)
+        if target == f:
+            continue
+        if os.path.exists(target):
+            raise ValueError('File already exists: %r' % target)
+        debug('moving %s to %s', f, target)
+        moved += 1
+        if not dry_run:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(f, target)
+
+    if not dry_run:
+        prune_payment_dirs(group)
+        group.set_config('payments_layout', layout)
+        group.payments_layout = layout
+    return moved
 
 
 def read(f):
@@ -102,6 +489,23 @@ def read(f):
 
     return d
 
+def _read_canonical(text):
+    """
+    Parse `text` like `read()` if it is a payment file as written by `write`,
+    with one `key: value` line per payment key. Return None for anything
+    else (comments, blank lines, continuations, other keys or spacing),
+    which is left to `read()`.
+    """
+    if not text.endswith('\n'):
+        return None
+    d = {}
+    for line in text[:-1].split('\n'):
+        k, sep, v = line.partition(': ')
+        if k not in _payment_fields or k in d or not v or v[0].isspace():
+            return None
+        d[k] = v
+    return d
+
 _read_file_no_default = object()
 def read_file(filename, default=_read_file_no_default):
     """
@@ -118,9 +522,21 @@ def read_file(filename, default=_read_file_no_default):
         raise
 
     try:
-        return read(f)
+        if profiling.enabled:
+            profiling.count('files_read')
+            profiling.count('bytes_read', os.fstat(f.fileno()).st_size)
+        text = f.read()
     finally:
         f.close()
+    return parse_text(text)
+
+def parse_text(text):
+    """Parse the contents of a file like `read()`"""
+    d = _read_canonical(text)
+    if d is None:
+        profiling.count('files_read_slow')
+        d = read(io.StringIO(text))
+    return d
 
 class ReaderError(Exception):
     pass
@@ -142,8 +558,9 @@ def store_payment(payment, filename=None):
 
     N.B: This is not race condition safe for python < 3.3.
     """
+    dir = payment_dir(payment.group, payment.date)
     if filename is not None:
-        path = payment.group.path('payments', filename)
+        path = os.path.join(dir, filename)
         if os.path.exists(path):
             raise ValueError('File already exists: %r' % path)
 
@@ -152,22 +569,66 @@ def store_payment(payment, filename=None):
             format_datetime(payment.date, date_only=True),
             payment.giver)
         debug(filename)
-        path = payment.group.path('payments', filename)
+        path = os.path.join(dir, filename)
 
         if os.path.exists(path):
             filename = None
 
+    os.makedirs(dir, exist_ok=True)
     mode = 'w' if sys.version_info < (3,3) else 'x'
 
     with open(path, mode, encoding=FILE_CHARSET) as f:
         write(f, payment.serialize())
+    return path
+
+def store_payments(payments, existing=None):
+    """
+    Store many Payments of one group to disk as new files with random names.
+
+    Instead of checking every generated name for existence, the payments
+    directory is scanned once, or `existing` (a set of file names, which is
+    updated) is used. Every shard directory is created once, and the person
+    index is updated once for all of them. Returns the paths of the new files.
+    """
+    from settle.index import add_to_index
+
+    paths = []
+    new = []
+    dirs = set()
+    mode = 'w' if sys.version_info < (3,3) else 'x'
+
+    for payment in payments:
+        if existing is None:
+            existing = payment_file_names(payment.group)
+
+        filename = None
+        while filename is None or filename in existing:
+            filename = generate_random_filename(
+                format_datetime(payment.date, date_only=True),
+                payment.giver)
+        existing.add(filename)
+
+        dir = payment_dir(payment.group, payment.date)
+        if dir not in dirs:
+            os.makedirs(dir, exist_ok=True)
+            dirs.add(dir)
+        path = os.path.join(dir, filename)
+        with open(path, mode, encoding=FILE_CHARSET) as f:
+            write(f, payment.serialize())
+        paths.append(path)
+        new.append((path, payment))
+
+    if new:
+        add_to_index(new[0][1].group, new)
+    return paths
 
 def write(f, data):
     for k in sort_payment_keys(data):
         if not _key_re.match(k):
             raise WriterKeyValueError('Invalid characters in key: %r' % k)
 
-        if data[k] is None:
+        if data[k] is None or data[k] == '':
+            # an empty date would not read back
             continue
 
         if '\n' in str(data[k]):
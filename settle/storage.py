@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of the payments of a group, selected by `storage` in the group
+config, see `get_storage`.
+
+`directory` (the default) keeps one file per payment in payments/, see
+`settle.reader`. `sqlite` keeps all payments in <group>/payments.sqlite
+along with their balances, with lists resolved, so that totals per currency
+and person are summed up by SQLite and queries are answered from its
+indexes. The balances are rebuilt whenever `config` or `lists` change.
+Archives and their summaries are files with either storage.
+"""
+import os
+import sys
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from decimal import Decimal
+from itertools import groupby
+from settle import profiling
+from settle.cache import group_fingerprint, stat_key
+from settle.util import MinorMoney, Money, debug, format_datetime, generate_random_filename, lowercase_keys
+
+SQLITE_SCHEMA_VERSION = 1
+
+_sqlite_schema = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+-- the fields of every payment as written, and the day of its date
+CREATE TABLE IF NOT EXISTS payments (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, giver TEXT NOT NULL,
+    receivers TEXT NOT NULL, amount TEXT, currency TEXT, date TEXT, day TEXT,
+    comment TEXT);
+CREATE INDEX IF NOT EXISTS payments_day ON payments (day);
+CREATE INDEX IF NOT EXISTS payments_giver ON payments (giver, day);
+-- the balances of every payment in order, the giver's last
+CREATE TABLE IF NOT EXISTS balances (
+    payment INTEGER NOT NULL, name TEXT NOT NULL, currency TEXT NOT NULL,
+    value TEXT NOT NULL, receiver INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS balances_payment ON balances (payment);
+CREATE INDEX IF NOT EXISTS balances_name ON balances (name, receiver);
+'''
+
+_fields = ('giver', 'receivers', 'amount', 'currency', 'date', 'comment')
+
+
+class StorageError(Exception):
+    pass
+
+
+def get_storage(group):
+    """The `Storage` of `group`"""
+    return _storages[group.storage](group)
+
+
+class Storage(ABC):
+    """
+    The payments of a group. Payments are identified by a name, unique
+    within the group.
+    """
+    def __init__(self, group):
+        self.group = group
+
+    def __repr__(self):
+        return '<%s of %s>' % (type(self).__name__, self.group.name)
+
+    @abstractmethod
+    def records(self, query=None, jobs=None):
+        """
+        Yield a `PaymentRecord` for every payment matching `query`, after
+        those of the archive summaries.
+        """
+
+    @abstractmethod
+    def payments(self, query=None):
+        """Yield every `Payment` matching `query`"""
+
+    def balances(self, query=None):
+        """
+        Return the balances of all payments matching `query` like
+        `get_balances`, or None if they are to be summed up from `records`.
+        """
+        return None
+
+    @abstractmethod
+    def store(self, payments):
+        """Store the new `Payment`s `payments` under random names"""
+
+    @abstractmethod
+    def items(self):
+        """Yield the name and the fields of every payment, as stored"""
+
+    @abstractmethod
+    def store_items(self, items):
+        """Store (name, fields) pairs as yielded by `items`, return their number"""
+
+    @abstractmethod
+    def is_empty(self):
+        """Whether there are no payments"""
+
+    @abstractmethod
+    def clear(self):
+        """Remove all payments"""
+
+    def adopt(self):
+        """Called once the group config has been switched to this storage"""
+
+    @abstractmethod
+    def mtime(self):
+        """Changes whenever a payment is added or removed, cheap to check"""
+
+    @abstractmethod
+    def signature(self):
+        """Changes whenever any payment is added, removed or modified"""
+
+
+class DirectoryStorage(Storage):
+    """One file per payment in payments/ or its shards, see `settle.reader`"""
+    name = 'directory'
+
+    def __init__(self, group):
+        super().__init__(group)
+        self._existing = None
+
+    def records(self, query=None, jobs=None):
+        from settle.reader import read_all_records
+        return read_all_records(self.group, query, jobs=jobs)
+
+    def payments(self, query=None):
+        from settle.reader import read_all_payments
+        return read_all_payments(self.group, query)
+
+    def store(self, payments):
+        from settle.reader import payment_file_names, store_payment, store_payments
+
+        if len(payments) == 1 and self._existing is None:
+            # checking a single name is cheaper than listing all payments
+            store_payment(payments[0])
+            return
+        if self._existing is None:
+            self._existing = payment_file_names(self.group)
+        store_payments(payments, self._existing)
+
+    def items(self):
+        from settle.reader import find_payment_files, read_file
+        for f in find_payment_files(self.group):
+            yield os.path.basename(f), read_file(f)
+
+    def store_items(self, items):
+        from settle import FILE_CHARSET
+        from settle.reader import parse_payment_date, payment_dir, write
+
+        n = 0
+        for name, d in items:
+            date = d.get('date')
+            dir = payment_dir(self.group, date and parse_payment_date(date))
+            os.makedirs(dir, exist_ok=True)
+            with open(os.path.join(dir, name), 'x', encoding=FILE_CHARSET) as f:
+                write(f, d)
+            n += 1
+        return n
+
+    def is_empty(self):
+        from settle.reader import find_payment_files
+        return next(find_payment_files(self.group), None) is None
+
+    def clear(self):
+        from settle.reader import find_payment_files, prune_payment_dirs
+        # payments/ itself stays, it marks the directory as group
+        for f in list(find_payment_files(self.group)):
+            os.unlink(f)
+        prune_payment_dirs(self.group)
+
+    def mtime(self):
+        from settle.reader import payment_dirs
+        return tuple((d, _mtime(d)) for d in payment_dirs(self.group))
+
+    def signature(self):
+        from settle.reader import find_payment_files
+        return frozenset((f,) + stat_key(os.stat(f))
+                         for f in find_payment_files(self.group))
+
+
+class SQLiteStorage(Storage):
+    """All payments and their balances in <group>/payments.sqlite"""
+    name = 'sqlite'
+
+    def __init__(self, group):
+        super().__init__(group)
+        self.path = group.path('payments.sqlite')
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = self._connect()
+        return self._db
+
+    def _connect(self):
+        import sqlite3
+
+        db = sqlite3.connect(self.path)
+        db.create_aggregate('decimal_sum', 1, _DecimalSum)
+        db.executescript(_sqlite_schema)
+        meta = dict(db.execute('SELECT key, value FROM meta'))
+        version = int(meta.get('version', SQLITE_SCHEMA_VERSION))
+        if version != SQLITE_SCHEMA_VERSION:
+            raise StorageError('%s has schema version %d, expected %d'
+                               % (self.path, version, SQLITE_SCHEMA_VERSION))
+        fingerprint = group_fingerprint(self.group)
+        if meta.get('fingerprint') != fingerprint:
+            self._rebuild_balances(db, fingerprint)
+        return db
+
+    def _rebuild_balances(self, db, fingerprint):
+        debug('%s: rebuilding balances', self.path)
+        with profiling.timer('sqlite_rebuild'), db:
+            db.execute('DELETE FROM balances')
+            rows = db.execute('SELECT id, name, %s FROM payments' % ', '.join(_fields))
+            for row in rows.fetchall():
+                self._insert_balances(db, row[0], _row_fields(row[2:]), row[1])
+            db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', (
+                ('version', str(SQLITE_SCHEMA_VERSION)), ('fingerprint', fingerprint)))
+
+    def _insert_balances(self, db, id, d, name):
+        from settle.reader import record_from_dict
+
+        record = record_from_dict(d, self.group, name)
+        last = len(record.balances) - 1
+        db.executemany('INSERT INTO balances VALUES (?, ?, ?, ?, ?)', [
+            (id, user, money.currency, str(money.value), i < last)
+            for (i, (user, money)) in enumerate(record.balances)])
+        return record
+
+    def _insert(self, db, name, d):
+        d = lowercase_keys(d)
+        cursor = db.execute('INSERT INTO payments (name, %s) VALUES (?%s)' % (
+            ', '.join(_fields), ', ?' * len(_fields)),
+            (name,) + tuple(d.get(k) for k in _fields))
+        record = self._insert_balances(db, cursor.lastrowid, d, name)
+        date = record.date
+        if date is not None:
+            db.execute('UPDATE payments SET day = ? WHERE id = ?',
+                       (date.date().isoformat(), cursor.lastrowid))
+
+    def _where(self, query):
+        if query is None:
+            return '', ()
+        clauses, args = [], []
+        if query.since is not None:
+            clauses.append('p.day >= ?')
+            args.append(query.since.isoformat())
+        if query.until is not None:
+            clauses.append('p.day <= ?')
+            args.append(query.until.isoformat())
+        if query.giver is not None:
+            clauses.append('p.giver = ?')
+            args.append(query.giver)
+        if query.receiver is not None:
+            clauses.append('p.id IN (SELECT payment FROM balances '
+                           'WHERE name = ? AND receiver)')
+            args.append(query.receiver)
+        return ''.join((' WHERE ' if i == 0 else ' AND ') + c
+                       for (i, c) in enumerate(clauses)), tuple(args)
+
+    def _money(self, value, currency):
+        if self.group.engine == 'minor':
+            return MinorMoney.from_decimal(Decimal(value), currency)
+        return Money(Decimal(value), currency)
+
+    def _summaries(self, query):
+        from settle.archive import read_summaries
+        return read_summaries(self.group, query)
+
+    def records(self, query=None, jobs=None):
+        from settle.reader import PaymentRecord
+
+        yield from self._summaries(query)
+        where, args = self._where(query)
+        rows = self.db.execute(
+            'SELECT p.id, p.name, p.giver, p.date, b.name, b.currency, b.value '
+            'FROM payments p JOIN balances b ON b.payment = p.id%s '
+            'ORDER BY p.id, b.rowid' % where, args)
+        for _, rows_ in groupby(rows, lambda row: row[0]):
+            rows_ = list(rows_)
+            _, name, giver, date = rows_[0][:4]
+            yield PaymentRecord('%s:%s' % (self.path, name), sys.intern(giver), date,
+                                [(sys.intern(user), self._money(value, currency))
+                                 for (_, _, _, _, user, currency, value) in rows_])
+
+    def payments(self, query=None):
+        from settle.reader import payment_from_dict
+
+        where, args = self._where(query)
+        rows = self.db.execute('SELECT p.name, %s FROM payments p%s ORDER BY p.id' % (
+            ', '.join('p.' + k for k in _fields), where), args)
+        for row in rows:
+            yield payment_from_dict(_row_fields(row[1:]), self.group,
+                                    '%s:%s' % (self.path, row[0]))
+
+    def balances(self, query=None):
+        currencies = defaultdict(lambda: defaultdict(Decimal))
+        with profiling.timer('get_balances'):
+            for record in self._summaries(query):
+                for user, money in record.balances:
+                    currencies[money.currency][user] += money.value
+            where, args = self._where(query)
+            rows = self.db.execute(
+                'SELECT b.currency, b.name, decimal_sum(b.value) '
+                'FROM balances b JOIN payments p ON p.id = b.payment%s '
+                'GROUP BY b.currency, b.name ORDER BY MIN(b.rowid)' % where, args)
+            for currency, user, value in rows:
+                currencies[currency][user] += Decimal(value)
+        return currencies
+
+    def store(self, payments):
+        import sqlite3
+
+        with self.db:
+            for payment in payments:
+                d = {k: str(v) for (k, v) in payment.serialize().items()
+                     if v is not None and v != ''}
+                while True:
+                    name = generate_random_filename(
+                        format_datetime(payment.date, date_only=True), payment.giver)
+                    try:
+                        self._insert(self.db, name, d)
+                        break
+                    except sqlite3.IntegrityError:
+                        debug('%s: name %s is taken', self.path, name)
+
+    def items(self):
+        rows = self.db.execute('SELECT name, %s FROM payments ORDER BY id'
+                               % ', '.join(_fields))
+        for row in rows:
+            yield row[0], _row_fields(row[1:])
+
+    def store_items(self, items):
+        n = 0
+        with self.db:
+            for name, d in items:
+                self._insert(self.db, name, d)
+                n += 1
+        return n
+
+    def is_empty(self):
+        if not os.path.exists(self.path):
+            return True
+        return self.db.execute('SELECT 1 FROM payments LIMIT 1').fetchone() is None
+
+    def clear(self):
+        self.close()
+        for f in (self.path, self.path + '-journal'):
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+
+    def adopt(self):
+        # only `storage` changed in the config, the balances are still valid
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                            ('fingerprint', group_fingerprint(self.group)))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def mtime(self):
+        return _mtime(self.path)
+
+    def signature(self):
+        try:
+            return stat_key(os.stat(self.path))
+        except FileNotFoundError:
+            return None
+
+
+class _DecimalSum:
+    """SQLite aggregate summing up Decimals stored as text"""
+    def __init__(self):
+        self.total = Decimal(0)
+
+    def step(self, value):
+        self.total += Decimal(value)
+
+    def finalize(self):
+        return str(self.total)
+
+
+def _row_fields(row):
+    return {k: v for (k, v) in zip(_fields, row) if v is not None}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+_storages = {s.name: s for s in (DirectoryStorage, SQLiteStorage)}
+
+
+def migrate_storage(group, storage, dry_run=False):
+    """
+    Copy all payments of `group` to `storage`, switch the group config to it
+    and remove them from the previous storage. The payments keep their
+    names. Return the number of payments migrated.
+    """
+    source = get_storage(group)
+    if source.name == storage:
+        raise StorageError('%s already uses %s storage' % (group.name, storage))
+    target = _storages[storage](group)
+    if not target.is_empty():
+        raise StorageError('%s storage of %s is not empty' % (storage, group.name))
+    if dry_run:
+        return sum(1 for _ in source.items())
+
+    try:
+        migrated = target.store_items(source.items())
+        group.set_config('storage', storage)
+    except BaseException:
+        target.clear()
+        raise
+    group.storage = storage
+    target.adopt()
+    source.clear()
+    debug('migrated %d payments of %s to %s storage', migrated, group.name, storage)
+    return migrated
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import math
 import os
 import random
 import re
@@ -20,6 +21,8 @@ def lowercase_keys(d):
 
 class Money:
     """Stores an amount of money with currency"""
+    __slots__ = ('value', 'currency')
+
     def __init__(self, value, currency):
         self.value = value
         self.currency = currency
@@ -60,9 +63,128 @@ class Money:
     def __abs__(self):
         return Money(abs(self.value), self.currency)
 
-def debug(str):
-    if os.environ.get('SETTLE_DEBUG') == '1':
-        print(str, file=sys.stderr)
+class MinorMoney(Money):
+    """
+    Amount of money stored as integer number of minor units (e.g. cents) of
+    its currency, used by the `minor` engine. `value` is the Decimal amount.
+    """
+    __slots__ = ('minor',)
+
+    def __init__(self, minor, currency):
+        self.minor = minor
+        self.currency = currency
+
+    def __repr__(self):
+        return 'MinorMoney(%r, %r)' % (self.minor, self.currency)
+
+    @property
+    def value(self):
+        return from_minor(self.minor, self.currency)
+
+    def __reduce__(self):
+        return (MinorMoney, (self.minor, self.currency))
+
+    @classmethod
+    def from_decimal(cls, value, currency):
+        return cls(to_minor(value, currency), currency)
+
+    @classmethod
+    def zero(cls, currency):
+        def zero_():
+            return MinorMoney(0, currency)
+        return zero_
+
+    def _same_currency(self, other, op):
+        if self.currency != other.currency:
+            raise ValueError('Cannot %s different currencies: %r and %r'
+                             % (op, self.currency, other.currency))
+
+    def __add__(self, other):
+        if not isinstance(other, MinorMoney):
+            return Money.__add__(self, other)
+        self._same_currency(other, 'add')
+        return MinorMoney(self.minor + other.minor, self.currency)
+
+    def __sub__(self, other):
+        if not isinstance(other, MinorMoney):
+            return Money.__sub__(self, other)
+        self._same_currency(other, 'subtract')
+        return MinorMoney(self.minor - other.minor, self.currency)
+
+    def __neg__(self):
+        return MinorMoney(-self.minor, self.currency)
+
+    def __pos__(self):
+        return MinorMoney(self.minor, self.currency)
+
+    def __abs__(self):
+        return MinorMoney(abs(self.minor), self.currency)
+
+def minor_unit_digits(currency):
+    from settle import DEFAULT_MINOR_UNIT_DIGITS, MINOR_UNIT_DIGITS
+    return MINOR_UNIT_DIGITS.get(currency, DEFAULT_MINOR_UNIT_DIGITS)
+
+def to_minor(value, currency):
+    """Convert the Decimal `value` to an int of minor units of `currency`"""
+    minor = Decimal(value).scaleb(minor_unit_digits(currency))
+    if minor != minor.to_integral_value():
+        raise ValueError('Amount %s has more than %d decimal places for %s'
+                         % (value, minor_unit_digits(currency), currency))
+    return int(minor)
+
+def from_minor(minor, currency):
+    return Decimal(minor).scaleb(-minor_unit_digits(currency))
+
+def largest_remainder(exact):
+    """
+    Round the Fractions `exact`, which sum up to an integer, to ints with the
+    same sum. Everything is rounded down first, the rest is handed out one by
+    one to the largest remainders (the first ones on ties).
+    """
+    floors = [math.floor(x) for x in exact]
+    rest = int(sum(exact) - sum(floors))
+    if rest:
+        by_remainder = sorted(range(len(exact)), key=lambda i: floors[i] - exact[i])
+        for i in by_remainder[:rest]:
+            floors[i] += 1
+    return floors
+
+_debug_enabled = os.environ.get('SETTLE_DEBUG') == '1'
+# stderr as of startup, so that messages from other threads don't end up in
+# output redirected meanwhile, like that of a request in the daemon
+_debug_stream = sys.stderr
+def debug(msg, *args):
+    """
+    Print `msg` to stderr if $SETTLE_DEBUG is 1. If `args` are given, `msg`
+    is %-formatted with them, but only when debugging is enabled.
+    """
+    if _debug_enabled:
+        print(msg % args if args else msg, file=_debug_stream)
+
+class SettingError(ValueError):
+    """Invalid value of an environment variable"""
+    pass
+
+def env_int(name, default):
+    """The int value of environment variable `name`, `default` if not set"""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise SettingError('$%s must be a whole number, not %r' % (name, value))
+
+def jobs_count(jobs=None):
+    """
+    Return the number of worker processes to use: `jobs` if given, else
+    $SETTLE_JOBS, else 1. Zero means one per CPU.
+    """
+    if jobs is None:
+        jobs = env_int('SETTLE_JOBS', 1)
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    return jobs
 
 def format_decimal(n, sign=True):
     return ('%+ 7.2f' if sign else '% 7.2f') % n
@@ -129,6 +251,11 @@ def generate_random_filename(*prefixes, randlength=8, join='_'):
                             for x in range(randlength)))
     return join.join(filter(None, prefixes))
 
+def parse_date(s):
+    """Parse a date (and time) string with dateutil, which is imported on first use"""
+    from dateutil.parser import parse
+    return parse(s)
+
 def format_datetime(dt, date_only=False):
     """
     Format a datetime object in the shortest manner possible, that is
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy backend summing up the balances of the `minor` engine.
+
+Payments for the same receivers (e.g. everyone paying for the same list)
+share their receiver vector, see `VectorBalances`. The first payment of every
+vector, giver and currency is added up like in the pure-Python path, the
+minor units of all further ones are stacked into one int64 matrix per vector
+and summed up per column. So only one lookup per payment is done in Python,
+and every user of a vector is only looked up once more. If the payments
+hardly share receivers, they are all added up like in the pure-Python path.
+"""
+from collections import defaultdict
+import numpy as np
+from settle.util import debug
+
+_INT64_LIMIT = 2**63
+# vectors to collect before checking whether payments share them
+_SAMPLE_VECTORS = 1000
+
+
+def sum_minor(records):
+    """
+    Sum up the minor units of the balances of all `records`. Return
+    {currency: {user: int}}, ordered like the pure-Python path: currencies,
+    and users within a currency, by first occurrence.
+    """
+    minor = defaultdict(lambda: defaultdict(int))
+    # (id(names), giver, currency) -> (balances of the first payment, packed
+    # minor units of the others); the balances keep `names` alive, so its id
+    # is not reused
+    vectors = {}
+    shared = True
+    for record in records:
+        balances = record.balances
+        names = getattr(balances, 'names', None) if shared else None
+        if names is not None:
+            giver, money = balances[-1]
+            key = (id(names), giver, money.currency)
+            vector = vectors.get(key)
+            if vector is not None:
+                vector[1].append(balances.minors)
+                continue
+            vectors[key] = (balances, [])
+            if len(vectors) == _SAMPLE_VECTORS and sum(
+                    len(rows) for (_, rows) in vectors.values()) < _SAMPLE_VECTORS:
+                # most payments have receivers of their own, stacking won't pay
+                debug('summing up without vectors after %d of them', _SAMPLE_VECTORS)
+                shared = False
+        # the first payment of its vector adds all its users in order
+        for user, money in balances:
+            minor[money.currency][user] += money.minor
+
+    for first, rows in vectors.values():
+        if not rows:
+            continue
+        giver, money = first[-1]
+        totals = minor[money.currency]
+        sums = _column_sums(rows, len(first.names))
+        for user, value in zip(first.names, sums):
+            totals[user] += value
+        totals[giver] -= sum(sums)
+    return minor
+
+
+def _column_sums(rows, width):
+    matrix = np.frombuffer(b''.join(rows), dtype=np.int64).reshape(len(rows), width)
+    if max(int(matrix.max()), -int(matrix.min())) * len(rows) >= _INT64_LIMIT:
+        # the sums might not fit into int64, add up exactly in Python
+        return matrix.astype(object).sum(axis=0).tolist()
+    return matrix.sum(axis=0).tolist()
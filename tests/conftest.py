@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """An empty ~/.settle in a temporary HOME, without daemon or profiling"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('SETTLE_DAEMON', '0')
+    for var in ('XDG_CACHE_HOME', 'SETTLE_CACHE', 'SETTLE_JOBS', 'SETTLE_BACKEND', 'SETTLE_IO',
+                'SETTLE_IO_INFLIGHT', 'SETTLE_SOCKET'):
+        monkeypatch.delenv(var, raising=False)
+    os.mkdir(tmp_path / '.settle')
+    return tmp_path
+
+
+@pytest.fixture
+def make_group(home):
+    """
+    Create a group directory and load it: make_group(name, config=...,
+    lists=..., payments={file name: contents}).
+    """
+    from settle.group import Group
+
+    def make_group(name='g', config='default_currency: EUR\n', lists='', payments=()):
+        path = home / '.settle' / name
+        os.makedirs(path / 'payments')
+        (path / 'config').write_text(config)
+        if lists:
+            (path / 'lists').write_text(lists)
+        for filename, text in dict(payments).items():
+            write_payment(Group._path(name), filename, text)
+        return Group.load(name)
+    return make_group
+
+
+def write_payment(group_path, filename, text):
+    """Write payment file `filename` below payments/ of the group at `group_path`"""
+    path = os.path.join(group_path, 'payments', filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+def payment(giver, receivers, amount, date=None, currency=None):
+    """The contents of a payment file"""
+    lines = ['giver: %s' % giver, 'receivers: %s' % receivers, 'amount: %s' % amount]
+    if currency is not None:
+        lines.append('currency: %s' % currency)
+    if date is not None:
+        lines.append('date: %s' % date)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import pytest
+from conftest import payment
+from settle import profiling
+from settle.balance import get_balances
+from settle.commands import Commands
+from settle.reader import read_all_payments, read_all_records
+from settle.util import SettingError
+
+
+def sharded_group(make_group):
+    payments = {}
+    for i in range(60):
+        day = '2024-%02d-%02d' % (i % 12 + 1, i % 28 + 1)
+        payments['%s/%s_p%d_%08d' % (day[:7].replace('-', '/'), day, i % 5, i)] = payment(
+            'p%d' % (i % 5), 'p%d p%d' % ((i + 1) % 5, (i + 2) % 5), i + 1, date=day)
+    payments['custom'] = payment('p0', 'p3', 7)
+    return make_group(config='default_currency: EUR\npayments_layout: sharded\n',
+                      payments=payments)
+
+
+@pytest.mark.parametrize('inflight', ['1', '4'])
+def test_async_matches_sync(make_group, monkeypatch, inflight):
+    g = sharded_group(make_group)
+    sync_records = [(r.file, r.giver, r.datestr, r.balances) for r in read_all_records(g)]
+    sync_payments = [p.serialize() for p in read_all_payments(g)]
+    monkeypatch.setenv('SETTLE_IO', 'async')
+    monkeypatch.setenv('SETTLE_IO_INFLIGHT', inflight)
+    monkeypatch.setenv('SETTLE_CACHE', '0')
+    assert [(r.file, r.giver, r.datestr, r.balances) for r in read_all_records(g)] == sync_records
+    assert [p.serialize() for p in read_all_payments(g)] == sync_payments
+
+
+def test_no_fstat_unless_profiling(make_group, monkeypatch):
+    g = sharded_group(make_group)
+    expected = get_balances(g)
+    monkeypatch.setenv('SETTLE_IO', 'async')
+    monkeypatch.setenv('SETTLE_CACHE', '0')
+    with monkeypatch.context() as m:
+        m.setattr(os, 'fstat', None)
+        assert get_balances(g) == expected
+
+    monkeypatch.setattr(profiling, 'enabled', True)
+    profiling.counters.clear()
+    get_balances(g)
+    assert profiling.counters['files_read'] == 61
+    assert profiling.counters['bytes_read'] > 0
+
+
+def test_invalid_settings(make_group, monkeypatch, capsys):
+    g = sharded_group(make_group)
+    monkeypatch.setenv('SETTLE_IO', 'threads')
+    with pytest.raises(SettingError):
+        get_balances(g)
+    monkeypatch.setenv('SETTLE_IO', 'async')
+    monkeypatch.setenv('SETTLE_IO_INFLIGHT', 'abc')
+    assert Commands().run(['g', 'print-balances']) == 1
+    assert capsys.readouterr().err == "Error: $SETTLE_IO_INFLIGHT must be a whole number, not 'abc'\n"
+
+
+def test_sync_mode_does_not_import_asyncio(make_group):
+    sharded_group(make_group)
+    code = ('import sys; from settle.commands import Commands; Commands().run(["g", "print-balances"]); '
+            'print(sorted(m for m in ("asyncio", "settle.aio", "concurrent.futures") if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                         env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    assert out.stdout.decode().splitlines()[-1] == '[]'
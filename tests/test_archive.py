@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+from datetime import date
+from decimal import Decimal
+import pytest
+from conftest import payment
+from settle.archive import ArchiveError, archive_payments, list_archives, restore_archive
+from settle.balance import get_balances
+from settle.checkpoint import get_balances_as_of
+from settle.commands import Commands
+from settle.index import statement
+from settle.reader import PaymentQuery, find_payment_files
+
+
+def plain(balances):
+    return {c: {k: v for (k, v) in b.items() if v} for (c, b) in balances.items()}
+
+
+def monthly_group(make_group):
+    payments = {}
+    for month in range(1, 7):
+        day = '2024-%02d-10' % month
+        payments['%s_alice_%08d' % (day, month)] = payment('alice', 'bob', month, date=day)
+    payments['undated'] = payment('bob', 'carol', 7)
+    return make_group(payments=payments)
+
+
+def archived_group(make_group):
+    g = monthly_group(make_group)
+    before = plain(get_balances(g))
+    name, archived = archive_payments(g, date(2024, 4, 1))
+    assert archived == 3
+    return g, name, before
+
+
+def fail_unlink(monkeypatch, after):
+    """Make os.unlink fail after `after` files"""
+    unlink = os.unlink
+    def failing(f):
+        if len(unlinked) == after:
+            raise OSError('interrupted')
+        unlinked.append(f)
+        unlink(f)
+    unlinked = []
+    monkeypatch.setattr(os, 'unlink', failing)
+
+
+def test_balances_are_kept(make_group):
+    g, name, before = archived_group(make_group)
+    assert len(list(find_payment_files(g))) == 4
+    assert plain(get_balances(g)) == before
+    (_, d), = list_archives(g)
+    assert (d['first'], d['last'], d['payments']) == ('2024-01-10', '2024-03-10', '3')
+
+    assert restore_archive(g, name) == 3
+    assert len(list(find_payment_files(g))) == 7
+    assert os.listdir(g.path('archives')) == []
+    assert plain(get_balances(g)) == before
+
+
+def test_queries_within_archive_are_refused(make_group):
+    g, _, _ = archived_group(make_group)
+    for query in (PaymentQuery(since=date(2024, 2, 1)), PaymentQuery(until=date(2024, 2, 1)),
+                  PaymentQuery(giver='alice', receiver='bob')):
+        with pytest.raises(ArchiveError):
+            get_balances(g, query)
+    with pytest.raises(ArchiveError):
+        get_balances_as_of(g, date(2024, 2, 1))
+
+    # queries selecting all or none of the archived payments are fine
+    assert plain(get_balances(g, PaymentQuery(until=date(2023, 12, 31)))) == {}
+    assert plain(get_balances_as_of(g, date(2023, 12, 31))) == {}
+    assert plain(get_balances(g, PaymentQuery(since=date(2024, 3, 11)))) == {
+        'EUR': {'alice': Decimal(15), 'bob': Decimal(-15)}}
+    assert plain(get_balances(g, PaymentQuery(since=date(2024, 1, 10),
+                                              until=date(2024, 4, 10)))) == {
+        'EUR': {'alice': Decimal(10), 'bob': Decimal(-10)}}
+    assert plain(get_balances_as_of(g, date(2024, 3, 10))) == {
+        'EUR': {'alice': Decimal(6), 'bob': Decimal(-6)}}
+
+
+@pytest.mark.parametrize('engine', ['decimal', 'minor'])
+def test_giver_and_receiver_queries(make_group, engine):
+    rnd = random.Random(3)
+    people = ['p%d' % i for i in range(6)]
+    payments = {}
+    for i in range(80):
+        receivers = rnd.choice(['%team', '%all', ' '.join(rnd.sample(people, rnd.randint(1, 4)))])
+        payments['x%03d' % i] = payment(rnd.choice(people), receivers, rnd.randint(1, 1000),
+                                        date='2024-%02d-01' % rnd.randint(1, 12))
+    g = make_group(config='default_currency: EUR\nengine: %s\n' % engine,
+                   lists='team: p0 p1*2\nall: %team p2 p3 p4 p5\n', payments=payments)
+    queries = [None] + [PaymentQuery(giver=p) for p in people + ['nobody']] + \
+        [PaymentQuery(receiver=p) for p in people + ['team']] + \
+        [PaymentQuery(since=date(2024, 7, 1), giver='p1'), PaymentQuery(until=date(2024, 6, 30))]
+    def rounded(query):
+        # thirds of the decimal engine differ in the last digit when summed
+        # up in another order
+        return {c: {k: round(v, 10) for (k, v) in b.items()}
+                for (c, b) in plain(get_balances(g, query)).items()}
+    expected = [rounded(query) for query in queries]
+    archive_payments(g, date(2024, 7, 1))
+    assert [rounded(query) for query in queries] == expected
+
+
+def test_modified_summary_is_rejected(make_group, capsys):
+    g, name, _ = archived_group(make_group)
+    summary = g.path('archives', name + '.summary')
+    with open(summary) as f:
+        text = f.read()
+    with open(summary, 'w') as f:
+        f.write(text.replace('* * alice 6 EUR', '* * alice 60 EUR'))
+    with pytest.raises(ArchiveError):
+        get_balances(g)
+    assert Commands().run(['g', 'print-balances']) == 1
+    assert capsys.readouterr().err.startswith('Error: Checksum mismatch')
+
+
+def test_refused_query_is_reported(make_group, capsys):
+    archived_group(make_group)
+    assert Commands().run(['g', 'print-balances', '--since', '2024-02-01']) == 1
+    assert capsys.readouterr().err.startswith('Error: ')
+
+
+def test_interrupted_archive(make_group, monkeypatch):
+    g = monthly_group(make_group)
+    before = plain(get_balances(g))
+    with monkeypatch.context() as m:
+        fail_unlink(m, 1)
+        with pytest.raises(OSError):
+            archive_payments(g, date(2024, 4, 1))
+    # the two payments left behind are counted by the summary only
+    assert len(os.listdir(g.path('payments'))) == 6
+    assert len(list(find_payment_files(g))) == 4
+    assert plain(get_balances(g)) == before
+    assert plain(get_balances(g, PaymentQuery(since=date(2024, 3, 11)))) == {
+        'EUR': {'alice': Decimal(15), 'bob': Decimal(-15)}}
+    monkeypatch.setenv('SETTLE_IO', 'async')
+    assert plain(get_balances(g)) == before
+    monkeypatch.delenv('SETTLE_IO')
+
+    (name, _), = list_archives(g)
+    assert restore_archive(g, name) == 3
+    assert len(list(find_payment_files(g))) == 7
+    assert plain(get_balances(g)) == before
+
+
+def test_interrupted_restore(make_group, monkeypatch):
+    g, name, before = archived_group(make_group)
+    with monkeypatch.context() as m:
+        fail_unlink(m, 0)
+        with pytest.raises(OSError):
+            restore_archive(g, name)
+    assert len(os.listdir(g.path('payments'))) == 7
+    assert plain(get_balances(g)) == before
+
+    assert restore_archive(g, name) == 3
+    assert plain(get_balances(g)) == before
+    assert plain(get_balances(g, PaymentQuery(giver='alice'))) == {
+        'EUR': {'alice': Decimal(21), 'bob': Decimal(-21)}}
+
+
+def test_statement_starts_from_archives(make_group):
+    g, _, _ = archived_group(make_group)
+    lines = [(p.datestr, share, balance) for (p, share, balance) in statement(g, 'bob')]
+    # bob owes 6 for the archived payments
+    assert lines == [('', Decimal(7), Decimal(1)),
+                     ('2024-04-10', Decimal(-4), Decimal(-3)),
+                     ('2024-05-10', Decimal(-5), Decimal(-8)),
+                     ('2024-06-10', Decimal(-6), Decimal(-14))]
+
+
+@pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+def test_revision(make_group, monkeypatch):
+    from test_gitrev import commit
+
+    g = monthly_group(make_group)
+    before = plain(get_balances(g))
+    with monkeypatch.context() as m:
+        fail_unlink(m, 1)
+        with pytest.raises(OSError):
+            archive_payments(g, date(2024, 4, 1))
+    commit(g)
+    assert plain(get_balances(g, rev='HEAD')) == before
+    assert plain(get_balances(g, PaymentQuery(giver='alice'), rev='HEAD')) == {
+        'EUR': {'alice': Decimal(21), 'bob': Decimal(-21)}}
+    with pytest.raises(ArchiveError):
+        get_balances(g, PaymentQuery(giver='alice', receiver='bob'), rev='HEAD')
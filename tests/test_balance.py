@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+from decimal import Decimal
+from functools import partial
+from operator import itemgetter
+from settle.balance import Balance, Transfer, settle_currency
+from settle.util import Money
+
+
+def settle_currency_resorting(currency, raw_balances):
+    """The original implementation, re-sorting the list after every transfer"""
+    balancesorted = partial(sorted, key=itemgetter(1))
+    balances = [Balance(n, v) for (n, v) in balancesorted(raw_balances.items())
+                if round(v, 10) != 0]
+    for _ in range(len(balances)):
+        if not balances:
+            break
+        poorest = balances.pop(0)
+        richest = balances.pop()
+        transfer = min(abs(richest.value), abs(poorest.value))
+        yield Transfer(poorest.name, richest.name, Money(transfer, currency))
+
+        richest = Balance(richest.name, richest.value - transfer)
+        poorest = Balance(poorest.name, poorest.value + transfer)
+        if round(richest.value, 10) != 0:
+            balances.append(richest)
+        if round(poorest.value, 10) != 0:
+            balances.append(poorest)
+        balances = balancesorted(balances)
+    if balances:
+        raise RuntimeError('balances left')
+
+
+def random_balances(rng, users, values=None):
+    """{name: Decimal} summing up to zero, with many ties if `values` is small"""
+    balances = {}
+    for i in range(users - 1):
+        value = rng.randint(-values, values) if values else rng.randint(-10**6, 10**6)
+        balances['user%d' % i] = Decimal(value).scaleb(-2)
+    balances['user%d' % (users - 1)] = -sum(balances.values())
+    return balances
+
+
+def transfers(settle, balances):
+    return [(t.giver, t.receiver, t.value.value, t.value.currency)
+            for t in settle('EUR', balances)]
+
+
+def test_same_transfers_as_resorting():
+    rng = random.Random(2)
+    for users in (2, 3, 5, 17, 200):
+        for values in (3, None):
+            balances = random_balances(rng, users, values)
+            assert (transfers(settle_currency, balances) ==
+                    transfers(settle_currency_resorting, balances))
+
+
+def test_zero_and_thirds():
+    third = Decimal(10) / 3
+    balances = {'a': -third, 'b': -third, 'c': -third, 'd': Decimal(10), 'e': Decimal(0)}
+    assert (transfers(settle_currency, balances) ==
+            transfers(settle_currency_resorting, balances))
+    assert all(t[0] != 'e' and t[1] != 'e' for t in transfers(settle_currency, balances))
+
+
+def settled(balances, transfers):
+    left = dict(balances)
+    for giver, receiver, value, _ in transfers:
+        left[giver] += value
+        left[receiver] -= value
+    return all(round(v, 10) == 0 for v in left.values())
+
+
+def test_scales_to_many_users():
+    rng = random.Random(1)
+    balances = random_balances(rng, 20000)
+    start = time.perf_counter()
+    result = transfers(settle_currency, balances)
+    elapsed = time.perf_counter() - start
+
+    assert len(result) < len(balances)
+    assert settled(balances, result)
+    # the re-sorting implementation takes minutes here
+    assert elapsed < 10
+
+
+def test_scaling_is_not_quadratic():
+    rng = random.Random(3)
+    def timed(users):
+        balances = random_balances(rng, users)
+        start = time.perf_counter()
+        list(settle_currency('EUR', balances))
+        return time.perf_counter() - start
+    timed(1000) # warm up
+    small, large = min(timed(2500) for _ in range(3)), min(timed(10000) for _ in range(3))
+    # 4 times the users, O(n log n) is ~4.5 times the time, O(n^2) 16 times
+    assert large < small * 10
+
+
+def test_time_budget_starts_after_balances(monkeypatch):
+    import settle.balance
+    # greedy needs 4 transfers here, optimal 3
+    balances = {'a': Decimal(-2), 'b': Decimal(-8), 'c': Decimal(9), 'd': Decimal(8),
+                'e': Decimal(-7)}
+    def slow_get_balances(group, query=None, jobs=None, rev=None):
+        time.sleep(0.3)
+        return {'EUR': balances}
+    monkeypatch.setattr(settle.balance, 'get_balances', slow_get_balances)
+
+    result = list(settle.balance.settle_balances(None, optimal=True, time_budget=0.2))
+    assert len(result) == 3
+    assert len(list(settle.balance.settle_balances(None))) == 4
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from decimal import Decimal
+from conftest import payment, write_payment
+from settle import profiling
+from settle.balance import get_balances
+from settle.cache import PaymentCache, cache_path
+from settle.group import Group
+from settle.reader import find_payment_files
+
+
+def age(*paths, seconds=60):
+    """Move the mtime of `paths` out of the racy window"""
+    t = time.time() - seconds
+    for path in paths:
+        os.utime(path, (t, t))
+
+
+def balances(group):
+    return {c: dict(v) for (c, v) in get_balances(group).items()}
+
+
+def cache_counts(group, monkeypatch):
+    monkeypatch.setattr(profiling, 'enabled', True)
+    profiling.counters.clear()
+    result = balances(group)
+    return result, profiling.counters['cache_hits'], profiling.counters['cache_misses']
+
+
+def test_cached_records_are_reused(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 10), 'b': payment('bob', 'alice', 4)})
+    age(*find_payment_files(g))
+    first = cache_counts(g, monkeypatch)
+    second = cache_counts(g, monkeypatch)
+    assert first == ({'EUR': {'alice': Decimal(6), 'bob': Decimal(-6)}}, 0, 2)
+    assert second == (first[0], 2, 0)
+
+
+def test_modified_file_is_read_again(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    path, = find_payment_files(g)
+    age(path)
+    balances(g)
+
+    write_payment(g.path(), 'a', payment('alice', 'bob', 12))
+    age(path, seconds=30)
+    assert cache_counts(g, monkeypatch) == (
+        {'EUR': {'alice': Decimal(12), 'bob': Decimal(-12)}}, 0, 1)
+
+
+def test_removed_file_is_pruned(make_group):
+    g = make_group(payments={'a': payment('alice', 'bob', 10), 'b': payment('bob', 'alice', 4)})
+    age(*find_payment_files(g))
+    balances(g)
+    os.unlink(g.path('payments', 'a'))
+    assert balances(g) == {'EUR': {'alice': Decimal(-4), 'bob': Decimal(4)}}
+    assert list(PaymentCache(g).entries) == [g.path('payments', 'b')]
+
+
+def test_recently_modified_file_is_not_cached(make_group):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    balances(g)
+    assert PaymentCache(g).entries == {}
+
+
+def test_changed_lists_drop_the_cache(make_group, monkeypatch):
+    g = make_group(lists='team: alice bob\n', payments={'a': payment('carol', '%team', 10)})
+    age(*find_payment_files(g))
+    assert balances(g) == {'EUR': {'alice': Decimal(-5), 'bob': Decimal(-5), 'carol': Decimal(10)}}
+
+    with open(g.path('lists'), 'w') as f:
+        f.write('team: alice\n')
+    g = Group.load('g')
+    assert cache_counts(g, monkeypatch) == (
+        {'EUR': {'alice': Decimal(-10), 'carol': Decimal(10)}}, 0, 1)
+
+
+def test_corrupt_cache_is_rebuilt(make_group):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    age(*find_payment_files(g))
+    balances(g)
+    with open(cache_path('g', 'payments'), 'wb') as f:
+        f.write(b'garbage')
+    assert balances(g) == {'EUR': {'alice': Decimal(10), 'bob': Decimal(-10)}}
+    assert len(PaymentCache(g).entries) == 1
+
+
+def test_cache_can_be_disabled(make_group, monkeypatch):
+    monkeypatch.setenv('SETTLE_CACHE', '0')
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    age(*find_payment_files(g))
+    balances(g)
+    assert not os.path.exists(cache_path('g', 'payments'))
+
+
+def test_localconfig_invalidates(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    age(*find_payment_files(g))
+    balances(g)
+    with open(g.path('localconfig'), 'w') as f:
+        f.write('default_currency: USD\n')
+    g = Group.load('g')
+    assert cache_counts(g, monkeypatch) == (
+        {'USD': {'alice': Decimal(10), 'bob': Decimal(-10)}}, 0, 1)
+
+    with open(g.path('localconfig'), 'w') as f:
+        f.write('engine: minor\n')
+    g = Group.load('g')
+    assert cache_counts(g, monkeypatch) == (
+        {'EUR': {'alice': Decimal(10), 'bob': Decimal(-10)}}, 0, 1)
+
+
+def test_caches_stay_out_of_the_group(make_group, home, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    age(*find_payment_files(g))
+    balances(g)
+    assert os.path.exists(home / '.cache' / 'settle' / 'g' / 'payments')
+    assert sorted(os.listdir(g.path())) == ['config', 'payments']
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(home / 'xdg'))
+    balances(g)
+    assert os.path.exists(home / 'xdg' / 'settle' / 'g' / 'payments')
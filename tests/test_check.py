@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import pytest
+from conftest import payment, write_payment
+import settle
+from settle import profiling
+from settle.check import check_group
+from settle.commands import Commands
+from settle.group import Group
+
+BROKEN = {
+    'parse': 'giver: alice\nthis is no payment\n',
+    'unknown-field': payment('alice', 'bob', 1) + 'colour: red\n',
+    'duplicate': 'giver: alice\ngiver: bob\nreceivers: carol\namount: 1\n',
+    'no-giver': 'receivers: bob\namount: 1\n',
+    'receivers': payment('alice', 'bob=1 carol*2', 3),
+    'undefined-list': payment('alice', '%nobody', 3),
+    'amount': payment('alice', 'bob', 'ten'),
+    'date': payment('alice', 'bob', 1, date='someday'),
+    'empty': '',
+}
+
+
+def age(group, *names, seconds=60):
+    """Move the mtime of payment files `names` (default: all) out of the racy window"""
+    t = time.time() - seconds
+    for f in names or os.listdir(group.path('payments')):
+        os.utime(group.path('payments', f), (t, t))
+
+
+def errors(group, **kwargs):
+    return {os.path.basename(f): e for (f, e) in check_group(group, **kwargs)}
+
+
+def test_error_kinds(make_group):
+    payments = dict(BROKEN, ok=payment('alice', 'bob', 1))
+    g = make_group(lists='team: alice bob\n', payments=payments)
+    found = errors(g)
+    assert sorted(found) == sorted(BROKEN)
+    assert found['parse'] == "Could not parse line 2: 'this is no payment\\n'"
+    assert found['unknown-field'] == "Unkown field name: 'colour'"
+    assert found['duplicate'].startswith("Key 'giver' already present")
+    assert found['no-giver'].startswith('Required field giver missing')
+    assert found['receivers'] == 'Different receiver modifiers found'
+    assert found['undefined-list'] == 'Undefined list: %nobody'
+    assert found['amount'] == "Invalid amount: 'ten'"
+    assert found['empty'].startswith('File is empty')
+
+
+def test_currency_spelling(make_group):
+    g = make_group(payments={
+        'a': payment('alice', 'bob', 1, currency='USD'),
+        'b': payment('alice', 'bob', 1, currency='USD'),
+        'c': payment('alice', 'bob', 1, currency='usd'),
+        'd': payment('alice', 'bob', 1, currency='eur'),
+        'e': payment('alice', 'bob', 1),
+    })
+    assert errors(g) == {'c': "Currency 'usd' is spelt 'USD' in 2 other payments",
+                         'd': "Currency 'eur' is spelt 'EUR' in 1 other payments"}
+
+
+def test_command_reports_all_errors(make_group, capsys):
+    make_group(payments=dict(BROKEN, ok=payment('alice', 'bob', 1)))
+    assert Commands().run(['g', 'check']) == 1
+    out, err = capsys.readouterr()
+    assert len(out.splitlines()) == len(BROKEN)
+    assert err == '%d errors in %d files\n' % (len(BROKEN), len(BROKEN))
+
+    make_group('clean', payments={'ok': payment('alice', 'bob', 1)})
+    assert Commands().run(['clean', 'check']) is None
+
+
+def test_incremental(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 1), 'b': payment('bob', 'alice', 2),
+                             'bad': payment('alice', 'bob', 'x')})
+    age(g)
+    monkeypatch.setattr(profiling, 'enabled', True)
+
+    def checked(**kwargs):
+        profiling.counters.clear()
+        found = errors(g, incremental=True, **kwargs)
+        return sorted(found), profiling.counters['check_skipped']
+
+    assert checked() == (['bad'], 0)
+    # files which passed are skipped, failed ones checked again
+    assert checked() == (['bad'], 2)
+
+    write_payment(g.path(), 'a', payment('alice', 'carol', 'y'))
+    age(g, 'a', seconds=30)
+    assert checked() == (['a', 'bad'], 1)
+
+    # the lists decide which receivers are valid
+    write_payment(g.path(), 'a', payment('alice', '%team', 1))
+    age(g, 'a', seconds=20)
+    assert checked() == (['a', 'bad'], 1)
+    with open(g.path('lists'), 'w') as f:
+        f.write('team: bob carol\n')
+    g = Group.load('g')
+    assert checked() == (['bad'], 0)
+
+    # without --incremental, everything is checked
+    profiling.counters.clear()
+    errors(g)
+    assert profiling.counters['check_skipped'] == 0
+
+
+def test_recently_modified_files_are_not_remembered(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 1)})
+    monkeypatch.setattr(profiling, 'enabled', True)
+    for _ in range(2):
+        profiling.counters.clear()
+        assert errors(g, incremental=True) == {}
+        assert profiling.counters['check_skipped'] == 0
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_parallel(make_group, monkeypatch, jobs):
+    monkeypatch.setattr(settle, 'PARALLEL_CHUNK_SIZE', 2)
+    payments = {'p%02d' % i: payment('alice', 'bob', i) for i in range(10)}
+    payments.update(BROKEN)
+    g = make_group(payments=payments)
+    assert sorted(errors(g, jobs=jobs)) == sorted(BROKEN)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from datetime import date
+from decimal import Decimal
+from conftest import payment, write_payment
+from settle import checkpoint
+from settle.balance import get_balances
+from settle.checkpoint import get_balances_as_of
+from settle.reader import PaymentQuery, find_payment_files
+
+
+def age(group, seconds=60):
+    t = time.time() - seconds
+    for f in find_payment_files(group):
+        os.utime(f, (t, t))
+
+
+def plain(balances):
+    return {c: {k: v for (k, v) in b.items() if v} for (c, b) in balances.items()}
+
+
+def monthly_payments():
+    payments = {}
+    for month in range(1, 13):
+        day = '2024-%02d-10' % month
+        payments['%s_alice_%08d' % (day, month)] = payment('alice', 'bob', month, date=day)
+    # file names without a date are read to find theirs
+    payments['bob-back'] = payment('bob', 'alice', 5, date='2024-03-01')
+    payments['undated'] = payment('bob', 'carol', 7)
+    return payments
+
+
+def spy_reads(monkeypatch):
+    reads = []
+    read_records = checkpoint.read_records
+    def spy(group, files, *args, **kwargs):
+        files = list(files)
+        reads.extend(os.path.basename(f) for (f, _) in files)
+        return read_records(group, files, *args, **kwargs)
+    monkeypatch.setattr(checkpoint, 'read_records', spy)
+    return reads
+
+
+def test_matches_until_query(make_group):
+    g = make_group(payments=monthly_payments())
+    age(g)
+    for as_of in (date(2023, 12, 31), date(2024, 3, 1), date(2024, 6, 9),
+                  date(2024, 6, 10), date(2025, 1, 1)):
+        expected = plain(get_balances(g, PaymentQuery(until=as_of)))
+        assert plain(get_balances_as_of(g, as_of)) == expected
+        # and again from the checkpoints
+        assert plain(get_balances_as_of(g, as_of)) == expected
+
+
+def test_checkpoint_skips_earlier_records(make_group, monkeypatch):
+    g = make_group(payments=monthly_payments())
+    age(g)
+    get_balances_as_of(g, date(2024, 12, 31))
+
+    reads = spy_reads(monkeypatch)
+    assert plain(get_balances_as_of(g, date(2024, 12, 31))) == {
+        'EUR': {'alice': Decimal(73), 'bob': Decimal(-73)}}
+    dated = [f for f in reads if f[0] == '2']
+    assert dated and all(f >= '2024-12' for f in dated)
+
+
+def test_changed_earlier_payment_invalidates(make_group):
+    g = make_group(payments=monthly_payments())
+    age(g)
+    get_balances_as_of(g, date(2024, 12, 31))
+
+    write_payment(g.path(), '2024-01-10_alice_00000001', payment('alice', 'bob', 100, date='2024-01-10'))
+    age(g, seconds=30)
+    assert plain(get_balances_as_of(g, date(2024, 12, 31))) == {
+        'EUR': {'alice': Decimal(172), 'bob': Decimal(-172)}}
+
+    os.unlink(g.path('payments', '2024-02-10_alice_00000002'))
+    assert plain(get_balances_as_of(g, date(2024, 12, 31))) == {
+        'EUR': {'alice': Decimal(170), 'bob': Decimal(-170)}}
+
+
+def test_misnamed_payment(make_group):
+    payments = monthly_payments()
+    payments['2024-02-01_carol_00000000'] = payment('carol', 'alice', 3, date='2024-11-01')
+    g = make_group(payments=payments)
+    age(g)
+    for as_of in (date(2024, 10, 31), date(2024, 11, 1), date(2024, 12, 31)):
+        expected = plain(get_balances(g, PaymentQuery(until=as_of)))
+        assert plain(get_balances_as_of(g, as_of)) == expected
+        assert plain(get_balances_as_of(g, as_of)) == expected
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import io
+import socket
+from conftest import payment
+from settle import util
+from settle.daemon import Daemon, forward
+
+
+def silent_daemon(home, monkeypatch):
+    """A socket accepting requests which are never answered"""
+    path = str(home / 'd.sock')
+    monkeypatch.setenv('SETTLE_SOCKET', path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    return sock
+
+
+def test_forward_without_daemon(home, monkeypatch):
+    monkeypatch.setenv('SETTLE_SOCKET', str(home / 'd.sock'))
+    assert forward(['g', 'print-balances']) is None
+
+
+def test_forward_falls_back_on_timeout(home, monkeypatch, capsys):
+    with silent_daemon(home, monkeypatch):
+        assert forward(['g', 'print-balances'], timeout=0.1) is None
+        assert forward(['g', 'new'], 'alice bob 1\n', timeout=0.1) == 1
+    assert capsys.readouterr().err == 'Error: the daemon did not answer in time\n'
+
+
+def test_debug_output_stays_out_of_responses(make_group, monkeypatch):
+    make_group(payments={'a': payment('alice', 'bob', 10)})
+    log = io.StringIO()
+    monkeypatch.setattr(util, '_debug_enabled', True)
+    monkeypatch.setattr(util, '_debug_stream', log)
+    response = Daemon().handle({'args': ['g', 'print-balances']})
+    assert response['status'] == 0 and response['stderr'] == ''
+    assert 'daemon: loading group g' in log.getvalue()
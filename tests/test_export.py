@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+from conftest import payment
+from settle.commands import Commands
+
+
+def export_group(make_group):
+    return make_group(payments={
+        'a': payment('alice', 'bob carol', 3, date='2024-01-10'),
+        'b': payment('bob', 'alice', 1, currency='USD'),
+    })
+
+
+def test_json(make_group, tmp_path):
+    export_group(make_group)
+    out = tmp_path / 'payments.json'
+    assert Commands().run(['g', 'export', 'payments', '--format', 'json', '-o', str(out)]) is None
+    rows = sorted(json.loads(out.read_text()), key=lambda r: r['giver'])
+    assert rows == [
+        {'giver': 'alice', 'receivers': 'bob carol', 'amount': '3', 'currency': 'EUR',
+         'date': '2024-01-10', 'comment': None,
+         'balances': [{'name': 'bob', 'value': '-1.5'}, {'name': 'carol', 'value': '-1.5'},
+                      {'name': 'alice', 'value': '3'}]},
+        {'giver': 'bob', 'receivers': 'alice', 'amount': '1', 'currency': 'USD',
+         'date': None, 'comment': None,
+         'balances': [{'name': 'alice', 'value': '-1'}, {'name': 'bob', 'value': '1'}]},
+    ]
+
+
+def test_ndjson(make_group, capsys):
+    export_group(make_group)
+    assert Commands().run(['g', 'export', 'balances']) is None
+    # one object per line, values as strings
+    rows = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted(rows, key=lambda r: (r['currency'], r['name'])) == [
+        {'name': 'alice', 'value': '3', 'currency': 'EUR'},
+        {'name': 'bob', 'value': '-1.5', 'currency': 'EUR'},
+        {'name': 'carol', 'value': '-1.5', 'currency': 'EUR'},
+        {'name': 'alice', 'value': '-1', 'currency': 'USD'},
+        {'name': 'bob', 'value': '1', 'currency': 'USD'},
+    ]
+
+
+def test_csv(make_group, capsys):
+    export_group(make_group)
+    assert Commands().run(['g', 'export', 'payments', '--format', 'csv', '--giver', 'alice']) is None
+    out = capsys.readouterr().out
+    assert out.splitlines()[0] == 'giver,receivers,amount,currency,date,comment,name,value'
+    # one line per balance entry
+    rows = list(csv.DictReader(io.StringIO(out)))
+    assert [(r['giver'], r['amount'], r['date'], r['comment'], r['name'], r['value'])
+            for r in rows] == [('alice', '3', '2024-01-10', '', 'bob', '-1.5'),
+                               ('alice', '3', '2024-01-10', '', 'carol', '-1.5'),
+                               ('alice', '3', '2024-01-10', '', 'alice', '3')]
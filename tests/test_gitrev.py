@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import shutil
+import subprocess
+from decimal import Decimal
+import pytest
+from conftest import payment, write_payment
+from settle import profiling
+from settle.balance import get_balances
+from settle.commands import Commands
+from settle.group import Group
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+
+
+def commit(group):
+    def git(*args):
+        subprocess.run(('git', '-C', group.path()) + args, check=True, stdout=subprocess.DEVNULL)
+    git('init', '-q')
+    git('add', '-A', '.')
+    git('-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q', '-m', 'x')
+
+
+def rev_balances(group, monkeypatch):
+    monkeypatch.setattr(profiling, 'enabled', True)
+    profiling.counters.clear()
+    balances = {c: dict(v) for (c, v) in get_balances(group, rev='HEAD').items()}
+    return balances, profiling.counters['cache_misses']
+
+
+def test_blobs_are_cached(make_group, monkeypatch):
+    g = make_group(lists='team: alice bob\n', payments={'a': payment('carol', '%team', 10)})
+    commit(g)
+    expected = {'EUR': {'alice': Decimal(-5), 'bob': Decimal(-5), 'carol': Decimal(10)}}
+    assert rev_balances(g, monkeypatch) == (expected, 1)
+    assert rev_balances(g, monkeypatch) == (expected, 0)
+
+
+def test_localconfig_invalidates(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', '10.5')})
+    commit(g)
+    rev_balances(g, monkeypatch)
+    # not versioned, but it configures how the payments are read
+    with open(g.path('localconfig'), 'w') as f:
+        f.write('default_currency: USD\n')
+    g = Group.load('g')
+    assert rev_balances(g, monkeypatch) == (
+        {'USD': {'alice': Decimal('10.5'), 'bob': Decimal('-10.5')}}, 1)
+
+
+def test_working_tree_changes_dont_matter(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    commit(g)
+    write_payment(g.path(), 'b', payment('bob', 'alice', 3))
+    with open(g.path('lists'), 'w') as f:
+        f.write('x: alice\n')
+    assert rev_balances(g, monkeypatch)[0] == {'EUR': {'alice': Decimal(10), 'bob': Decimal(-10)}}
+
+
+def test_bad_revision(make_group, capsys):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    commit(g)
+    assert Commands().run(['g', 'print-balances', '--rev', 'nope']) == 1
+    assert capsys.readouterr().err.startswith('Error: ')
+
+
+def test_sqlite_storage_is_rejected(make_group, capsys):
+    g = make_group(config='default_currency: EUR\nstorage: sqlite\n')
+    commit(g)
+    assert Commands().run(['g', 'print-balances', '--rev', 'HEAD']) == 1
+    assert capsys.readouterr().err == (
+        'Error: Payments in sqlite storage cannot be read from git revisions\n')
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from fractions import Fraction
+import pytest
+from settle import MAX_LIST_RESOLVER_RECURSION_DEPTH
+from settle.group import Group, ListResolveError
+
+
+def load(lists):
+    return Group.from_config('g', {}, lists)
+
+
+def test_nested_lists_are_flattened():
+    g = load({'team': 'alice bob*3', 'all': '%team carol'})
+    assert dict(g.list_vector('all')) == {
+        'alice': Fraction(1, 8), 'bob': Fraction(3, 8), 'carol': Fraction(1, 2)}
+    assert g.list_vector('all') is g.list_vector('all')
+
+
+def test_persons_are_merged():
+    g = load({'team': 'alice bob', 'all': '%team alice*2'})
+    # alice is listed once directly and once through %team
+    assert g.list_vector('all') == (('alice', Fraction(5, 6)), ('bob', Fraction(1, 6)))
+    receivers = g.parse_receivers('%team alice')
+    assert dict(receivers.vector()) == {'alice': Fraction(3, 4), 'bob': Fraction(1, 4)}
+
+
+def test_cycles_are_rejected():
+    with pytest.raises(ListResolveError, match=r'Cycle in list definitions: %a -> %b -> %a'):
+        load({'a': 'x %b', 'b': 'y %a'})
+    with pytest.raises(ListResolveError, match='Cycle'):
+        load({'a': 'x %a'})
+
+
+def test_undefined_lists_are_rejected():
+    with pytest.raises(ListResolveError, match='Undefined list: %nobody'):
+        load({'team': 'alice %nobody'})
+    g = load({'team': 'alice bob'})
+    with pytest.raises(ListResolveError, match='Undefined list: %nobody'):
+        g.parse_receivers('%team %nobody').vector()
+
+
+def test_deep_nesting_is_rejected():
+    depth = MAX_LIST_RESOLVER_RECURSION_DEPTH
+    lists = {'l%d' % i: 'p%d %%l%d' % (i, i + 1) for i in range(depth)}
+    lists['l%d' % depth] = 'last'
+    with pytest.raises(ListResolveError, match='nested too deeply'):
+        load(lists)
+    # one level less is fine
+    del lists['l0']
+    assert len(load(lists).list_vector('l1')) == depth
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+from decimal import Decimal
+import pytest
+from settle.balance import get_balances
+from settle.export import export_payments
+from settle.importer import import_payments, iter_rows
+from settle.storage import get_storage
+
+CSV = '''giver,receivers,amount,currency,date,comment
+alice,bob carol,30,,2024-01-05,dinner
+bob,alice,0.1,USD,2024-02-01 12:30,
+carol,alice=2 bob=1,,EUR,,split
+'''
+
+
+def fields(payments):
+    return sorted((p.giver, p.receivers.to_string(), p.amount, p.currency, p.datestr or None,
+                   p.comment or None) for p in payments)
+
+
+@pytest.mark.parametrize('storage', ['directory', 'sqlite'])
+def test_csv_round_trip(make_group, storage):
+    g = make_group(config='default_currency: EUR\nstorage: %s\n' % storage)
+    imported, errors = import_payments(g, iter_rows(io.StringIO(CSV), 'csv'), batch_size=2)
+    assert (imported, errors) == (3, [])
+    stored = list(get_storage(g).payments())
+    assert fields(stored) == [
+        ('alice', 'bob carol', Decimal(30), 'EUR', '2024-01-05', 'dinner'),
+        ('bob', 'alice', Decimal('0.1'), 'USD', '2024-02-01 12:30', None),
+        ('carol', 'alice=2 bob=1', Decimal(3), 'EUR', None, 'split'),
+    ]
+
+    # what is exported imports to the same payments
+    out = io.StringIO()
+    export_payments(stored, 'json', out)
+    jsonl = ''.join(json.dumps({k: v for (k, v) in row.items() if k != 'balances'}) + '\n'
+                    for row in json.loads(out.getvalue()))
+    g2 = make_group('g2', config='default_currency: EUR\nstorage: %s\n' % storage)
+    assert import_payments(g2, iter_rows(io.StringIO(jsonl), 'jsonl')) == (3, [])
+    assert fields(get_storage(g2).payments()) == fields(stored)
+    assert get_balances(g2) == get_balances(g)
+
+
+def test_jsonl_keeps_decimals(make_group):
+    g = make_group()
+    rows = iter_rows(io.StringIO('{"giver": "alice", "receivers": "bob", "amount": 0.1}\n'
+                                 '\n{"giver": "bob", "receivers": "alice", "amount": 0.2}\n'),
+                     'jsonl')
+    assert import_payments(g, rows) == (2, [])
+    assert {k: dict(v) for (k, v) in get_balances(g).items()} == {
+        'EUR': {'alice': Decimal('-0.1'), 'bob': Decimal('0.1')}}
+
+
+def test_invalid_rows_are_reported(make_group):
+    g = make_group()
+    text = ('{"giver": "alice", "receivers": "bob", "amount": 5}\n'
+            'not json\n'
+            '[1, 2]\n'
+            '{"giver": "alice", "amount": 5}\n'
+            '{"giver": "alice", "receivers": "bob", "amount": 5, "colour": "red"}\n')
+    imported, errors = import_payments(g, iter_rows(io.StringIO(text), 'jsonl'))
+    assert imported == 1
+    assert [lno for (lno, _) in errors] == [2, 3, 4, 5]
+    assert len(list(get_storage(g).payments())) == 1
+
+
+def test_dry_run_stores_nothing(make_group):
+    g = make_group()
+    assert import_payments(g, iter_rows(io.StringIO(CSV), 'csv'), dry_run=True) == (3, [])
+    assert list(get_storage(g).payments()) == []
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from conftest import payment, write_payment
+from settle import cache, index
+from settle.index import PersonIndex, statement
+from settle.payment import Payment
+from settle.reader import store_payment, store_payments
+
+
+def build_index(group):
+    idx = PersonIndex(group)
+    idx.reconcile()
+    idx.save()
+    return idx
+
+
+def test_store_payments_updates_index_once(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    build_index(g)
+    saves = []
+    save_cache_file = index.save_cache_file
+    monkeypatch.setattr(index, 'save_cache_file', lambda *args: saves.append(args) or save_cache_file(*args))
+    paths = store_payments([Payment(g, 'carol', 'alice', 1) for _ in range(5)])
+    assert len(saves) == 1
+    assert set(paths) <= set(PersonIndex(g).files)
+
+
+def test_store_payment_leaves_index_to_reconcile(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    build_index(g)
+    with monkeypatch.context() as m:
+        m.setattr(index, 'save_cache_file', None)
+        path = store_payment(Payment(g, 'carol', 'bob', 3))
+    assert path not in PersonIndex(g).files
+    assert [share for (p, share, balance) in statement(g, 'carol')] == [3]
+
+
+def test_recently_modified_files_are_read_again(make_group, monkeypatch):
+    g = make_group(payments={'a': payment('alice', 'bob', 10)})
+    path = g.path('payments', 'a')
+    idx = build_index(g)
+    assert idx.files[path][0] is None
+    assert idx.files_of('bob') == [path]
+
+    # changed within the same mtime, as coarse timestamps allow
+    st = os.stat(path)
+    write_payment(g.path(), 'a', payment('alice', 'eve', 10))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    later = time.time_ns() + 60 * 10 ** 9
+    monkeypatch.setattr(index.time, 'time_ns', lambda: later)
+    idx = build_index(g)
+    assert idx.files_of('bob') == [] and idx.files_of('eve') == [path]
+    assert idx.files[path][0] == cache.stat_key(os.stat(path))
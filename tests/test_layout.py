@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from conftest import payment
+from settle import profiling
+from settle.balance import get_balances
+from settle.commands import Commands
+from settle.group import Group
+from settle.payment import Payment
+from settle.reader import PaymentQuery, find_payment_files, migrate_layout, store_payments
+
+
+def test_store_payments_creates_shards_once(make_group, monkeypatch):
+    g = make_group(config='default_currency: EUR\npayments_layout: sharded\n')
+    payments = [Payment(g, 'alice', 'bob', '1', date=datetime(2024, i % 3 + 1, 5))
+                for i in range(30)] + [Payment(g, 'alice', 'bob', '1')]
+    created = []
+    makedirs = os.makedirs
+    def spy(path, *args, **kwargs):
+        created.append(path)
+        return makedirs(path, *args, **kwargs)
+    monkeypatch.setattr(os, 'makedirs', spy)
+
+    paths = store_payments(payments)
+    # os.makedirs also calls itself for missing parents
+    assert len(created) == len(set(created))
+    assert {g.path('payments'), g.path('payments', '2024', '01'), g.path('payments', '2024', '02'),
+            g.path('payments', '2024', '03')} <= set(created)
+    assert sorted(find_payment_files(g)) == sorted(paths)
+
+
+def layout_group(make_group):
+    payments = {'2024-%02d-05_alice_%08d' % (m, m): payment('alice', 'bob', m, date='2024-%02d-05' % m)
+                for m in range(1, 4)}
+    payments['custom'] = payment('bob', 'alice', 10, date='2023-12-24')
+    payments['undated_bob_abcd1234'] = payment('bob', 'carol', 5)
+    return make_group(payments=payments)
+
+
+def relpaths(group):
+    return sorted(os.path.relpath(f, group.path('payments')) for f in find_payment_files(group))
+
+
+def test_migrate_layout(make_group, capsys):
+    g = layout_group(make_group)
+    before = get_balances(g)
+    flat = relpaths(g)
+
+    assert Commands().run(['g', 'migrate-layout', '-n', 'sharded']) is None
+    assert capsys.readouterr().err == 'Would move 4 payment files\n'
+    assert relpaths(g) == flat
+
+    assert Commands().run(['g', 'migrate-layout', 'sharded']) is None
+    g = Group.load('g')
+    assert g.payments_layout == 'sharded'
+    assert relpaths(g) == ['2023/12/custom', '2024/01/2024-01-05_alice_00000001',
+                           '2024/02/2024-02-05_alice_00000002', '2024/03/2024-03-05_alice_00000003',
+                           'undated_bob_abcd1234']
+    assert get_balances(g) == before
+
+    assert migrate_layout(g, 'flat') == 4
+    g = Group.load('g')
+    assert g.payments_layout == 'flat'
+    assert relpaths(g) == flat
+    assert sorted(os.listdir(g.path('payments'))) == flat
+    assert get_balances(g) == before
+
+
+def test_sharded_discovery(make_group, monkeypatch):
+    g = layout_group(make_group)
+    migrate_layout(g, 'sharded')
+    # files in other directories are not payments
+    os.makedirs(g.path('payments', 'notes'))
+    with open(g.path('payments', 'notes', 'x'), 'w') as f:
+        f.write('giver: x\n')
+
+    monkeypatch.setattr(profiling, 'enabled', True)
+    profiling.counters.clear()
+    files = [os.path.basename(f) for f in
+             find_payment_files(g, PaymentQuery(since=date(2024, 2, 1), until=date(2024, 2, 29)))]
+    assert sorted(files) == ['2024-02-05_alice_00000002', 'undated_bob_abcd1234']
+    # 2023 is skipped as a whole, 2024/01 and 2024/03 by their month
+    assert profiling.counters['shards_skipped'] == 3
+    assert get_balances(g, PaymentQuery(since=date(2024, 2, 1))) == {
+        'EUR': {'alice': Decimal(5), 'bob': Decimal(-5)}}
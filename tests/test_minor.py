@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import pickle
+import random
+from decimal import Decimal
+from fractions import Fraction
+import pytest
+from conftest import payment
+from settle.balance import get_balances
+from settle.util import MinorMoney, Money, largest_remainder, to_minor
+
+
+def test_largest_remainder():
+    assert largest_remainder([Fraction(10, 3)] * 3) == [4, 3, 3]
+    assert largest_remainder([Fraction(-10, 3)] * 3) == [-3, -3, -4]
+    assert largest_remainder([Fraction(1, 2), Fraction(3, 2), Fraction(2)]) == [1, 1, 2]
+    assert largest_remainder([Fraction(5), Fraction(-5)]) == [5, -5]
+    assert largest_remainder([]) == []
+
+
+def test_largest_remainder_keeps_the_sum():
+    rnd = random.Random(1)
+    for _ in range(200):
+        weights = [rnd.randint(1, 9) for _ in range(rnd.randint(1, 12))]
+        total = rnd.randint(-10 ** 6, 10 ** 6)
+        exact = [Fraction(total * w, sum(weights)) for w in weights]
+        rounded = largest_remainder(exact)
+        assert sum(rounded) == total
+        assert all(abs(r - x) < 1 for (r, x) in zip(rounded, exact))
+
+
+def test_minor_money():
+    a = MinorMoney.from_decimal(Decimal('12.34'), 'EUR')
+    assert a.minor == 1234 and a.value == Decimal('12.34')
+    assert (a + MinorMoney(66, 'EUR')).minor == 1300
+    assert (a - MinorMoney(34, 'EUR')).minor == 1200
+    assert (-a).minor == -1234 and abs(-a).minor == 1234
+    assert pickle.loads(pickle.dumps(a)).minor == 1234
+    assert MinorMoney.from_decimal(Decimal(5), 'JPY').minor == 5
+    assert MinorMoney.from_decimal(Decimal('1.005'), 'KWD').minor == 1005
+    with pytest.raises(ValueError):
+        a + MinorMoney(1, 'USD')
+    with pytest.raises(ValueError):
+        to_minor(Decimal('0.001'), 'EUR')
+    # mixing with Decimal money falls back to Money
+    assert (a + Money(Decimal('0.005'), 'EUR')).value == Decimal('12.345')
+
+
+def test_minor_engine_splits_exactly(make_group):
+    g = make_group(config='default_currency: EUR\nengine: minor\n', payments={
+        'a': payment('alice', 'alice bob carol', 10),
+        'b': payment('bob', 'alice*2 carol', '0.01'),
+        'c': payment('carol', 'alice bob', 100, currency='JPY'),
+    })
+    balances = {c: dict(v) for (c, v) in get_balances(g).items()}
+    for values in balances.values():
+        assert sum(values.values()) == 0
+    assert balances['JPY'] == {'alice': Decimal(-50), 'bob': Decimal(-50), 'carol': Decimal(100)}
+    # 10.00 is split into 3.33, 3.33 and 3.34 (ties go to the first ones),
+    # the cent into 2/3 for alice (rounded to 1) and 1/3 for carol (to 0)
+    assert balances['EUR'] == {'alice': Decimal('6.66'), 'bob': Decimal('-3.32'),
+                               'carol': Decimal('-3.34')}
+
+
+def test_minor_engine_matches_decimal_engine(make_group):
+    rnd = random.Random(2)
+    people = ['p%d' % i for i in range(8)]
+    payments = {}
+    for i in range(100):
+        receivers = ' '.join(rnd.sample(people, rnd.randint(1, 8)))
+        payments['p%03d' % i] = payment(rnd.choice(people), receivers,
+                                        Decimal(rnd.randint(1, 100000)) / 100)
+    decimal = get_balances(make_group('d', payments=payments))
+    minor = get_balances(make_group('m', config='default_currency: EUR\nengine: minor\n',
+                                    payments=payments))
+    # every payment is off by less than a cent per person
+    for person in people:
+        assert abs(minor['EUR'][person] - decimal['EUR'][person]) < Decimal('1.00')
+    assert sum(minor['EUR'].values()) == 0
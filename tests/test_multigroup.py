@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from decimal import Decimal
+from conftest import payment
+from settle import multigroup
+from settle.multigroup import get_all_balances
+
+
+def pool_sizes(monkeypatch):
+    sizes = []
+    class Executor:
+        def __init__(self, jobs):
+            sizes.append(jobs)
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            pass
+        def map(self, func, names):
+            return map(func, names)
+    monkeypatch.setattr('concurrent.futures.ProcessPoolExecutor', Executor)
+    return sizes
+
+
+def test_jobs_default_to_cpus_per_group(make_group, monkeypatch):
+    for name in ('a', 'b', 'c'):
+        make_group(name, payments={'p': payment('alice', 'bob', 1)})
+    monkeypatch.setattr(multigroup.os, 'cpu_count', lambda: 2)
+    sizes = pool_sizes(monkeypatch)
+    totals, per_group, errors = get_all_balances()
+    assert sizes == [2]
+    assert dict(totals['EUR']) == {'alice': Decimal(3), 'bob': Decimal(-3)}
+    assert sorted(per_group) == ['a', 'b', 'c'] and errors == {}
+
+    monkeypatch.setattr(multigroup.os, 'cpu_count', lambda: 8)
+    get_all_balances()
+    assert sizes == [2, 3]
+
+
+def test_jobs_setting_is_respected(make_group, monkeypatch):
+    for name in ('a', 'b'):
+        make_group(name)
+    sizes = pool_sizes(monkeypatch)
+    monkeypatch.setenv('SETTLE_JOBS', '1')
+    get_all_balances()
+    get_all_balances(jobs=2)
+    assert sizes == [2]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+import pytest
+from conftest import payment
+from settle import profiling
+from settle.balance import get_balances
+from settle.checkpoint import get_balances_as_of
+from settle.reader import PaymentQuery, find_payment_files, read_all_records
+
+
+def plain(balances):
+    return {c: {k: v for (k, v) in b.items() if v} for (c, b) in balances.items()}
+
+
+def query_group(make_group):
+    payments = {}
+    for month in range(1, 7):
+        day = '2024-%02d-10' % month
+        payments['%s_alice_%08d' % (day, month)] = payment('alice', 'bob', month, date=day)
+        payments['%s_bob_%08d' % (day, month)] = payment('bob', 'carol', 10 * month, date=day)
+    # custom names, which have to be read
+    payments['undated'] = payment('carol', 'alice', 100)
+    payments['dinner_friday12'] = payment('alice', 'carol', 1000, date='2024-02-02')
+    return make_group(payments=payments)
+
+
+def read_files(group, monkeypatch, func):
+    monkeypatch.setattr(profiling, 'enabled', True)
+    monkeypatch.setenv('SETTLE_CACHE', '0')
+    profiling.counters.clear()
+    result = plain(func())
+    return result, profiling.counters['files_read'], profiling.counters['files_skipped']
+
+
+def test_match_filename():
+    q = PaymentQuery(since=date(2024, 2, 1), giver='alice')
+    assert q.match_filename('2024-02-10_alice_abcd1234') is True
+    assert q.match_filename('2024-01-10_alice_abcd1234') is False
+    assert q.match_filename('2024-02-10_bob_abcd1234') is False
+    # not generated, or no date to trust the name
+    assert q.match_filename('alice_abcd1234') is None
+    assert q.match_filename('dinner_friday12') is None
+    assert q.match_filename('2024-02-10_alice_ABCD1234') is None
+    assert PaymentQuery(receiver='bob').match_filename('2024-02-10_alice_abcd1234') is None
+
+
+def test_giver_prunes_files(make_group, monkeypatch):
+    g = query_group(make_group)
+    query = PaymentQuery(giver='alice')
+    assert read_files(g, monkeypatch, lambda: get_balances(g, query)) == (
+        {'EUR': {'alice': Decimal(1021), 'bob': Decimal(-21), 'carol': Decimal(-1000)}}, 8, 6)
+
+
+def test_dates_prune_files(make_group, monkeypatch):
+    g = query_group(make_group)
+    query = PaymentQuery(since=date(2024, 5, 1), giver='bob')
+    assert read_files(g, monkeypatch, lambda: get_balances(g, query)) == (
+        {'EUR': {'bob': Decimal(110), 'carol': Decimal(-110)}}, 4, 10)
+
+
+def test_as_of_prunes_files(make_group, monkeypatch):
+    g = query_group(make_group)
+    expected = plain(get_balances(g, PaymentQuery(until=date(2024, 2, 28))))
+    assert expected == {'EUR': {'alice': Decimal(1003), 'bob': Decimal(27),
+                                'carol': Decimal(-1030)}}
+    # the files of March to June are never opened
+    assert read_files(g, monkeypatch, lambda: get_balances_as_of(g, date(2024, 2, 28))) == (
+        expected, 6, 8)
+
+
+@pytest.mark.parametrize('query', [PaymentQuery(giver='alice'), PaymentQuery(giver='dinner'),
+                                   PaymentQuery(since=date(2024, 2, 1), until=date(2024, 2, 28))])
+def test_lookalike_custom_name(make_group, query):
+    g = query_group(make_group)
+    files = {os.path.basename(f) for f in find_payment_files(g, query)}
+    assert 'dinner_friday12' in files
+    # the same as checking every payment
+    expected = defaultdict(lambda: defaultdict(Decimal))
+    for record in read_all_records(g):
+        if query.match(record.giver, record.date, record.balances):
+            for user, money in record.balances:
+                expected[money.currency][user] += money.value
+    assert plain(get_balances(g, query)) == plain(expected)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import io
+import random
+import pytest
+from settle.reader import (ReaderError, _read_canonical, parse_text, read,
+                           write)
+
+CANONICAL = [
+    'giver: alice\nreceivers: bob carol\namount: 10\n',
+    'amount: 0.10\ncurrency: USD\ndate: 2024-01-05 12:30\ngiver: bob\nreceivers: alice=2 bob=1\n',
+    'giver: alice\nreceivers: bob\namount: 5\ncomment: a: b  c \n',
+    'giver: älice\nreceivers: bob\namount: 5\ncomment: €\r\n',
+    'giver: alice\n',
+]
+
+NOT_CANONICAL = [
+    # comments, blank lines and continuations
+    '# a payment\ngiver: alice\nreceivers: bob\namount: 10\n',
+    'giver: alice\n\nreceivers: bob\namount: 10\n',
+    'giver: alice\nreceivers: bob\namount: 10\n\n',
+    'giver: alice\nreceivers: bob\namount: 10\ncomment:\n    two\n    lines\n',
+    # other spacing
+    'giver:alice\nreceivers: bob\namount: 10\n',
+    'giver : alice\nreceivers: bob\namount: 10\n',
+    'giver:  alice\nreceivers: bob\namount: 10\n',
+    'giver:\talice\nreceivers: bob\namount: 10\n',
+    'giver: \xa0alice\nreceivers: bob\namount: 10\n',
+    # no trailing newline
+    'giver: alice\nreceivers: bob\namount: 10',
+    # other keys
+    'Giver: alice\nreceivers: bob\namount: 10\n',
+    'giver: alice\nreceivers: bob\namount: 10\ncolour: red\n',
+    '',
+]
+
+INVALID = [
+    'giver: alice\ngiver: bob\n',
+    'giver: alice\nreceivers bob\n',
+    'giver: alice\n  receivers: bob\n',
+    'giver: alice\ngiver:\n    bob\n',
+]
+
+
+def slow(text):
+    return read(io.StringIO(text))
+
+
+@pytest.mark.parametrize('text', CANONICAL)
+def test_canonical(text):
+    assert _read_canonical(text) is not None
+    assert _read_canonical(text) == slow(text)
+
+
+@pytest.mark.parametrize('text', NOT_CANONICAL)
+def test_not_canonical(text):
+    assert _read_canonical(text) is None
+    assert parse_text(text) == slow(text)
+
+
+@pytest.mark.parametrize('text', INVALID)
+def test_invalid(text):
+    assert _read_canonical(text) is None
+    with pytest.raises(ReaderError) as slow_error:
+        slow(text)
+    with pytest.raises(slow_error.type):
+        parse_text(text)
+
+
+@pytest.mark.parametrize('data', [
+    {'giver': 'alice', 'receivers': 'bob carol', 'amount': '10', 'currency': 'EUR'},
+    {'giver': 'alice', 'receivers': 'bob', 'amount': '1', 'date': '', 'comment': None},
+    {'giver': 'alice', 'receivers': 'bob', 'amount': '1', 'comment': 'two\nlines'},
+])
+def test_written_files(data):
+    f = io.StringIO()
+    write(f, data)
+    text = f.getvalue()
+    expected = {k: v for (k, v) in data.items() if v}
+    assert parse_text(text) == slow(text)
+    if '\n' not in ''.join(expected.values()):
+        assert _read_canonical(text) == expected
+
+
+def test_random_texts():
+    rnd = random.Random(0)
+    keys = ['giver', 'receivers', 'amount', 'comment', 'date', 'currency', 'Amount', 'x']
+    seps = [': ', ':', ' : ', ':  ', ':\t', ': \xa0']
+    values = ['alice', 'bob carol', '10.5', 'a: b', '', ' x', 'y ']
+    for _ in range(2000):
+        lines = []
+        for _ in range(rnd.randint(0, 5)):
+            kind = rnd.random()
+            if kind < 0.05:
+                lines.append('# comment')
+            elif kind < 0.1:
+                lines.append(rnd.choice(['', ' ', '    more']))
+            else:
+                lines.append(rnd.choice(keys) + rnd.choice(seps) + rnd.choice(values))
+        text = '\n'.join(lines) + rnd.choice(['\n', '\n', ''])
+        try:
+            expected = slow(text)
+        except ReaderError as e:
+            with pytest.raises(type(e)):
+                parse_text(text)
+            continue
+        assert parse_text(text) == expected
+        canonical = _read_canonical(text)
+        assert canonical is None or canonical == expected
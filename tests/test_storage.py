@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+import pytest
+from conftest import payment
+from settle.balance import get_balances
+from settle.reader import PaymentQuery
+from settle.storage import DirectoryStorage, Storage, get_storage, migrate_storage
+
+QUERIES = [None, PaymentQuery(since=date(2024, 2, 1)), PaymentQuery(until=date(2024, 2, 1)),
+           PaymentQuery(giver='alice'), PaymentQuery(receiver='carol')]
+
+
+def plain(balances):
+    return {c: {k: v for (k, v) in b.items() if v} for (c, b) in balances.items()}
+
+
+def test_storage_is_abstract(make_group):
+    g = make_group()
+    with pytest.raises(TypeError):
+        Storage(g)
+
+    class Incomplete(Storage):
+        def records(self, query=None, jobs=None):
+            return iter(())
+    with pytest.raises(TypeError):
+        Incomplete(g)
+    assert isinstance(get_storage(g), DirectoryStorage)
+
+
+def test_migration_keeps_payments(make_group):
+    g = make_group(lists='team: alice bob\n', payments={
+        'a': payment('alice', 'bob carol', 30, date='2024-01-05'),
+        'b': payment('bob', '%team', '0.10', date='2024-03-01', currency='USD'),
+        'c': payment('carol', 'alice=2 bob=1', 3),
+    })
+    expected = [plain(get_balances(g, query)) for query in QUERIES]
+    items = sorted(get_storage(g).items())
+
+    assert migrate_storage(g, 'sqlite') == 3
+    assert get_storage(g).name == 'sqlite'
+    assert get_storage(g).balances() is not None
+    assert [plain(get_balances(g, query)) for query in QUERIES] == expected
+    assert sorted(get_storage(g).items()) == items
+
+    assert migrate_storage(g, 'directory') == 3
+    assert get_storage(g).is_empty() is False
+    assert [plain(get_balances(g, query)) for query in QUERIES] == expected
+    assert sorted(get_storage(g).items()) == items
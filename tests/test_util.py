@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+from settle.commands import Commands
+from settle.util import SettingError, jobs_count
+
+
+def test_jobs_count(monkeypatch):
+    monkeypatch.delenv('SETTLE_JOBS', raising=False)
+    assert jobs_count() == 1
+    assert jobs_count(3) == 3
+    assert jobs_count(0) == (os.cpu_count() or 1)
+    monkeypatch.setenv('SETTLE_JOBS', '4')
+    assert jobs_count() == 4
+    assert jobs_count(2) == 2
+
+
+def test_invalid_jobs_count(monkeypatch):
+    monkeypatch.setenv('SETTLE_JOBS', 'abc')
+    with pytest.raises(SettingError, match='SETTLE_JOBS'):
+        jobs_count()
+
+
+def test_invalid_jobs_count_is_reported(make_group, monkeypatch, capsys):
+    make_group()
+    monkeypatch.setenv('SETTLE_JOBS', 'abc')
+    assert Commands().run(['g', 'print-balances']) == 1
+    assert capsys.readouterr().err == "Error: $SETTLE_JOBS must be a whole number, not 'abc'\n"
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import pickle
+import random
+from decimal import Decimal
+import pytest
+from conftest import payment
+from settle.balance import get_balances
+from settle.reader import PaymentRecord
+from settle.util import MinorMoney, SettingError
+
+np = pytest.importorskip('numpy')
+from settle.vectorized import sum_minor
+
+
+def python_sums(records):
+    minor = {}
+    for record in records:
+        for user, money in record.balances:
+            totals = minor.setdefault(money.currency, {})
+            totals[user] = totals.get(user, 0) + money.minor
+    return minor
+
+
+def ordered(sums):
+    return [(c, list(v.items())) for (c, v) in sums.items()]
+
+
+def random_payments(shared, count=3000, seed=0):
+    rnd = random.Random(seed)
+    people = ['p%d' % i for i in range(12)]
+    pool = ['%flat', '%flat p9', '=', '%all']
+    payments = {}
+    for i in range(count):
+        currency = rnd.choice(['EUR', 'EUR', 'USD', 'JPY'])
+        amount = Decimal(rnd.randint(1, 10 ** 6)) / (1 if currency == 'JPY' else 100)
+        if shared:
+            receivers = rnd.choice(pool)
+            if receivers == '=':
+                receivers = 'p1=%s p2=%s' % (amount, amount)
+                amount *= 2
+        else:
+            receivers = ' '.join(rnd.sample(people, rnd.randint(1, 6)))
+        payments['x%05d' % i] = payment(rnd.choice(people), receivers, amount, currency=currency)
+    return payments
+
+
+def minor_records(make_group, payments):
+    from settle.storage import get_storage
+    g = make_group(config='default_currency: EUR\nengine: minor\n',
+                   lists='flat: p0 p1 p2 p3\nall: %flat p4 p5*2 p6\n', payments=payments)
+    # as they come back from the cache
+    return pickle.loads(pickle.dumps(list(get_storage(g).records()), pickle.HIGHEST_PROTOCOL))
+
+
+@pytest.mark.parametrize('shared', [True, False])
+def test_matches_python(make_group, shared):
+    records = minor_records(make_group, random_payments(shared))
+    assert ordered(sum_minor(records)) == ordered(python_sums(records))
+
+
+def test_plain_records(make_group):
+    # e.g. archive summaries and records cached by older versions
+    records = minor_records(make_group, random_payments(True, count=50))
+    records[10:10] = [PaymentRecord(None, None, None, [
+        ('zoe', MinorMoney(5, 'GBP')), ('p1', MinorMoney(-3, 'EUR')), ('zoe', MinorMoney(-5, 'GBP'))])]
+    records += [PaymentRecord(r.file, r.giver, r.datestr, list(r.balances)) for r in records[:20]]
+    assert ordered(sum_minor(records)) == ordered(python_sums(records))
+
+
+def test_beyond_int64(make_group):
+    # the sums of a vector overflow int64, and one payment does right away
+    payments = {'x%02d' % i: payment('p0', '%flat', '36' + '0' * 15) for i in range(12)}
+    payments['y'] = payment('p2', '%flat', '9' * 30)
+    records = minor_records(make_group, payments)
+    assert [r.balances.names is None for r in records].count(True) == 1
+    assert ordered(sum_minor(records)) == ordered(python_sums(records))
+
+
+def test_backends_agree(make_group, monkeypatch):
+    payments = random_payments(True, count=500, seed=1)
+    g = make_group(config='default_currency: EUR\nengine: minor\n',
+                   lists='flat: p0 p1 p2 p3\nall: %flat p4 p5*2 p6\n', payments=payments)
+    results = []
+    for backend in ('python', 'numpy'):
+        monkeypatch.setenv('SETTLE_BACKEND', backend)
+        results.append(ordered(get_balances(g)))
+    assert results[0] == results[1]
+
+
+def test_unknown_backend(make_group, monkeypatch):
+    g = make_group(config='default_currency: EUR\nengine: minor\n',
+                   payments={'a': payment('alice', 'bob', 1)})
+    monkeypatch.setenv('SETTLE_BACKEND', 'fortran')
+    with pytest.raises(SettingError):
+        get_balances(g)